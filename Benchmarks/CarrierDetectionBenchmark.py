@@ -0,0 +1,58 @@
+"""
+Throughput of the carrier detection of tracking numbers, on a generated mix of UPS, Fedex and USPS tracking numbers
+with valid check digits.
+
+Run from the main directory:
+    python -m Benchmarks.CarrierDetectionBenchmark --count 1000000
+"""
+import argparse
+import random
+import time
+
+from TrackingSiteModules.CarrierDetection import classify_tracking_numbers, detect_carrier
+
+DIGITS = '0123456789'
+ALPHANUMERIC = '0123456789ABCDEFGHJKLMNPRSTUVWXYZ'
+
+# Tracking number formats: (prefix, characters, count of random characters after the prefix), check digit excluded
+FORMATS = [
+    ('1Z', ALPHANUMERIC, 15),  # UPS
+    ('', DIGITS, 11),  # Fedex Express
+    ('', DIGITS, 14),  # Fedex Ground
+    ('9400', DIGITS, 17),  # USPS
+    ('9205', DIGITS, 17),  # USPS
+]
+
+
+def generate_tracking_number(rng):
+    """
+    :param rng: random.Random
+    :return: Random tracking number of one of FORMATS, with a valid check digit
+    """
+    prefix, characters, count = rng.choice(FORMATS)
+    body = prefix + ''.join(rng.choice(characters) for _ in range(count))
+    for check_digit in DIGITS:
+        if detect_carrier(body + check_digit):
+            return body + check_digit
+    raise ValueError(f"No check digit found for {body}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000000, help='Tracking numbers to classify')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tracking_numbers = [generate_tracking_number(rng) for _ in range(args.count)]
+
+    for strict in (True, False):
+        start = time.perf_counter()
+        groups = classify_tracking_numbers(tracking_numbers, strict=strict)
+        elapsed = time.perf_counter() - start
+        counts = ', '.join(f"{carrier}: {len(group)}" for carrier, group in groups.items())
+        print(f"strict={strict!s:<5} {args.count / elapsed:>12,.0f} tracking numbers/s ({elapsed:.2f} s)  {counts}")
+
+
+if __name__ == "__main__":
+    main()
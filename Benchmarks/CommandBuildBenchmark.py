@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of curl command construction.
+Compares the former approach (growing shell strings, then shlex.split on the full command)
+with the argument list built from the compiled headers and cookie arguments.
+
+Run from the main directory:
+    python -m Benchmarks.CommandBuildBenchmark --iterations 20000
+"""
+import argparse
+import shlex
+import timeit
+
+from CoreLibrary.PyCurlRequest import CurlRequests
+from CoreLibrary.CurlTransports import SubprocessCurlTransport
+
+REQUEST_URL = 'https://www.ups.com/track/api/Track/GetStatus?loc=en_US'
+REQUEST_DATA = '{"Locale":"en_US","TrackingNumber":["1Z0000000000000000"],"Requester":"wt","consumerHub":""}'
+HEADERS_DICT = {
+    "Connection": "keep-alive",
+    "sec-ch-ua": "\"Google Chrome\";v=\"87\", \" Not;A Brand\";v=\"99\", \"Chromium\";v=\"87\"",
+    "Accept": "application/json, text/plain, */*",
+    "sec-ch-ua-mobile": "?0",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36",
+    "Content-Type": "application/json",
+    "Origin": "https://www.ups.com",
+    "Sec-Fetch-Site": "same-origin",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Dest": "empty",
+    "Accept-Language": "en-US,en;q=0.9",
+    "X-XSRF-TOKEN": "CfDJ8Jcj9GhlwkdBikuRYzfhrpI5Rn0X1d0WqvB7xJ9yq3r4"
+}
+COOKIES_DICT = {f"cookie_{index}": "x" * 40 for index in range(20)}
+
+
+def legacy_args():
+    """
+    Command construction as it was done before: string concatenation and a shlex.split round-trip
+    """
+    curl_headers = ""
+    for key, value in HEADERS_DICT.items():
+        if not curl_headers:
+            curl_headers = f'-H "{key}: {value}" '
+        else:
+            curl_headers = f'{curl_headers}  -H "{key}: {value}" '
+
+    cookies_as_single_str = ""
+    for key, value in COOKIES_DICT.items():
+        if not cookies_as_single_str:
+            cookies_as_single_str = f'{key}={value}'
+        else:
+            cookies_as_single_str = f'{cookies_as_single_str}; {key}={value}'
+    curl_cookie_header = f' -H "cookie: {cookies_as_single_str}" '
+
+    referer = 'https://www.ups.com/track?loc=null&tracknum=1Z0000000000000000&requester=WT/trackdetails'
+    full_cmd = f'curl "{REQUEST_URL}"  {curl_headers} -H "Referer: {referer}" {curl_cookie_header}  --data-binary \'{REQUEST_DATA}\' '
+    return shlex.split(full_cmd)
+
+
+def compiled_args():
+    """
+    Command construction of CurlRequests. A new instance per request, like the carrier classes do
+    """
+    requester = CurlRequests(cookies_dict=COOKIES_DICT, headers_dict=HEADERS_DICT, transport=SubprocessCurlTransport())
+    referer = {"Referer": 'https://www.ups.com/track?loc=null&tracknum=1Z0000000000000000&requester=WT/trackdetails'}
+    return requester.build_curl_args(REQUEST_URL, REQUEST_DATA, False, None, None, None, False, False, False, False, referer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help='Number of commands built with each approach')
+    args = parser.parse_args()
+
+    legacy = timeit.timeit(legacy_args, number=args.iterations)
+    compiled = timeit.timeit(compiled_args, number=args.iterations)
+
+    print(f"{'legacy':>10}: {legacy / args.iterations * 1e6:8.2f} us per command")
+    print(f"{'compiled':>10}: {compiled / args.iterations * 1e6:8.2f} us per command")
+    print(f"{'speedup':>10}: {legacy / compiled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
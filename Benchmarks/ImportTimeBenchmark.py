@@ -0,0 +1,101 @@
+"""
+Cold start benchmark. Imports each module in a fresh interpreter with python -X importtime and reports
+the cumulative import time, best of several runs.
+
+With --check, it also works as a regression check and exits with status 1 if a module:
+  - imports a heavy dependency that should only be loaded on first use (pycurl, sqlite3, PIL, requests ...)
+  - takes longer to import than its budget (scaled with --budget-scale on slower machines)
+
+Run from the main directory:
+    python -m Benchmarks.ImportTimeBenchmark --runs 5 --check
+"""
+import argparse
+import subprocess
+import sys
+
+# Module -> import time budget in milliseconds
+IMPORT_BUDGETS_MS = {
+    'TrackingSiteModules': 60,
+    'CoreLibrary.PyCurlRequest': 90,
+    'TrackingSiteModules.UPSTrackingCurl': 100,
+    'TrackingSiteModules.FedexTrackingCurl': 100,
+    'TrackingSiteModules.USPSTrackingCurl': 100,
+    'DropapkModules.DropapkCurl': 90,
+}
+
+# Imported on first use only. None of them may show up when importing the modules above
+LAZY_MODULES = ('pycurl', 'sqlite3', 'PIL', 'requests', 'concurrent.futures', 'shlex', 'asyncio', 'email.utils')
+
+
+def measure_import(module_name):
+    """
+    :param module_name:
+    :return: tuple of (cumulative import time in milliseconds, set of all the modules imported along)
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode:
+        raise RuntimeError(f"Could not import {module_name}:\n{result.stderr}")
+
+    cumulative_us = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module_name:
+            cumulative_us = int(cumulative)
+    return cumulative_us / 1000, imported
+
+
+def lazy_modules_imported(imported):
+    """
+    :param imported: Set of imported module names
+    :return: Sorted list of the LAZY_MODULES (or their submodules) that were imported
+    """
+    found = set()
+    for name in imported:
+        for lazy_module in LAZY_MODULES:
+            if name == lazy_module or name.startswith(lazy_module + '.'):
+                found.add(lazy_module)
+    return sorted(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per module, the best run is kept')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if a budget is exceeded or a lazy dependency is imported')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='Multiplies every budget, for slower machines')
+    parser.add_argument('modules', nargs='*', help='Modules to measure. Defaults to the modules with a budget')
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':<40} {'best ms':>9} {'budget ms':>10}  eager heavy imports")
+    for module_name in args.modules or IMPORT_BUDGETS_MS:
+        best_ms = None
+        imported = set()
+        for _ in range(max(1, args.runs)):
+            elapsed_ms, imported = measure_import(module_name)
+            best_ms = elapsed_ms if best_ms is None else min(best_ms, elapsed_ms)
+
+        eager = lazy_modules_imported(imported)
+        budget = IMPORT_BUDGETS_MS.get(module_name)
+        budget_ms = budget * args.budget_scale if budget is not None else None
+        budget_text = f"{budget_ms:.0f}" if budget_ms is not None else '-'
+        print(f"{module_name:<40} {best_ms:>9.1f} {budget_text:>10}  {', '.join(eager) or '-'}")
+
+        if eager:
+            failures.append(f"{module_name} imports {', '.join(eager)} at import time")
+        if budget_ms is not None and best_ms > budget_ms:
+            failures.append(f"{module_name} takes {best_ms:.1f} ms to import, budget is {budget_ms:.0f} ms")
+
+    if args.check and failures:
+        print()
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares requests per second of the subprocess (curl binary) and libcurl (pycurl) transports.
+A small local http server is started so that only the cost of the transport itself is measured.
+
+Run from the main directory:
+    python -m Benchmarks.TransportBenchmark --requests 200
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from CoreLibrary.CurlTransports import LibcurlTransport, SubprocessCurlTransport, libcurl_available
+from CoreLibrary.PyCurlRequest import CurlRequests
+
+
+class BenchmarkHandler(BaseHTTPRequestHandler):
+    """
+    Returns a small JSON document, like the carrier tracking apis do
+    """
+    protocol_version = 'HTTP/1.1'
+    body = b'{"trackDetails": [{"trackingNumber": "1Z0000000000000000", "packageStatus": "Delivered"}]}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server():
+    """
+    :return: Running server, listening on a free local port
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BenchmarkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_transport(transport, url, request_count):
+    """
+    Sends request_count requests through the transport
+    :return: requests per second
+    """
+    requester = CurlRequests(cookies_dict={'session': 'benchmark'}, headers_dict={'Accept': 'application/json'}, transport=transport)
+    start = time.perf_counter()
+    for _ in range(request_count):
+        requester.send_curl_request(request_url=url, data='{"TrackingNumber": ["1Z0000000000000000"]}')
+    elapsed = time.perf_counter() - start
+    return request_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests sent through each transport')
+    args = parser.parse_args()
+
+    server = start_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/track"
+
+    transports = [SubprocessCurlTransport()]
+    if libcurl_available():
+        transports.append(LibcurlTransport())
+    else:
+        print("pycurl is not installed. Only the subprocess transport will be measured")
+
+    results = {}
+    for transport in transports:
+        results[transport.name] = run_transport(transport, url, args.requests)
+        print(f"{transport.name:>12}: {results[transport.name]:8.1f} requests/sec")
+
+    if len(results) > 1:
+        print(f"{'speedup':>12}: {results['libcurl'] / results['subprocess']:8.1f}x")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
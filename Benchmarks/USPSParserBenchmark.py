@@ -0,0 +1,95 @@
+"""
+Throughput benchmark of the USPS tracking page parser, against the recorded sample pages of Benchmarks/SamplePages.
+Compares a scrape of the full page with the standard library html.parser (what consumers of the raw page did)
+with USPSTrackingParser, which only runs precompiled patterns over the tracking section.
+Reports pages per second and the memory allocated while parsing a page (peak, tracemalloc).
+
+Run from the main directory:
+    python -m Benchmarks.USPSParserBenchmark --iterations 500
+"""
+import argparse
+import glob
+import os
+import timeit
+import tracemalloc
+from html.parser import HTMLParser
+
+from TrackingSiteModules.USPSTrackingParser import parse_tracking_page
+
+SAMPLE_PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SamplePages')
+
+
+class FullPageScraper(HTMLParser):
+    """
+    Baseline: walks every tag of the page and keeps the text of the tracking elements
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.field = None
+        self.events = []
+        self.status = None
+
+    def handle_starttag(self, tag, attrs):
+        css_class = dict(attrs).get('class') or ''
+        if css_class.startswith('tb-step'):
+            self.events.append({})
+        elif css_class.startswith('tb-') or (tag == 'strong' and self.status is None):
+            self.field = css_class or 'banner'
+
+    def handle_data(self, data):
+        if self.field is None or not data.strip():
+            return
+        if self.field == 'banner':
+            self.status = data.strip()
+        elif self.events:
+            self.events[-1][self.field] = ' '.join(data.split())
+        self.field = None
+
+
+def scrape_full_page(page):
+    scraper = FullPageScraper()
+    scraper.feed(page)
+    scraper.close()
+    return {'status': scraper.status, 'events': scraper.events}
+
+
+def peak_memory(parse, page):
+    """
+    :param parse:
+    :param page:
+    :return: Peak bytes allocated while parsing the page once
+    """
+    tracemalloc.start()
+    parse(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500, help='Times each page is parsed with each approach')
+    parser.add_argument('--pages', default=os.path.join(SAMPLE_PAGES_DIR, 'usps_*.html'), help='Glob of the pages to parse')
+    args = parser.parse_args()
+
+    pages = {os.path.basename(path): open(path, encoding='utf-8').read() for path in sorted(glob.glob(args.pages))}
+    if not pages:
+        parser.error(f"No page matches {args.pages}")
+
+    print(f"{'page':<26} {'KB':>6} {'full page/s':>12} {'parser/s':>10} {'speedup':>8} {'full page mem':>14} {'parser mem':>11}")
+    total_full = total_parser = 0
+    for name, page in pages.items():
+        full = timeit.timeit(lambda: scrape_full_page(page), number=args.iterations)
+        fast = timeit.timeit(lambda: parse_tracking_page(page), number=args.iterations)
+        total_full += full
+        total_parser += fast
+        print(f"{name:<26} {len(page) / 1024:>6.1f} {args.iterations / full:>12.0f} {args.iterations / fast:>10.0f} {full / fast:>7.1f}x "
+              f"{peak_memory(scrape_full_page, page) / 1024:>11.1f} KB {peak_memory(parse_tracking_page, page) / 1024:>8.1f} KB")
+
+    parsed_pages = args.iterations * len(pages)
+    print(f"{'all pages':<26} {'':>6} {parsed_pages / total_full:>12.0f} {parsed_pages / total_parser:>10.0f} {total_full / total_parser:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
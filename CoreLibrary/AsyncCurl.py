@@ -0,0 +1,156 @@
+import asyncio
+import weakref
+
+from CoreLibrary.CurlTransports import load_pycurl
+
+# Loaded by the first AsyncCurlMulti: host_semaphores is used by async requests on any transport
+pycurl = None
+
+
+class HostSemaphores:
+    """
+    Limits the number of requests in flight to the same host from one event loop,
+    so thousands of concurrent lookups can share a loop without flooding a single site
+    """
+
+    def __init__(self, default_limit=16):
+        """
+        :param default_limit: Maximum concurrent requests per host, unless set otherwise with set_limit
+        """
+        self.default_limit = default_limit
+        self.host_limits = {}
+        self.loop_semaphores = weakref.WeakKeyDictionary()  # event loop -> {host: asyncio.Semaphore}
+
+    def set_limit(self, host, limit):
+        """
+        Changes the concurrency limit of a host. Applies to semaphores created after the call
+        :param host: host[:port]
+        :param limit:
+        :return:
+        """
+        self.host_limits[host] = limit
+        for semaphores in self.loop_semaphores.values():
+            semaphores.pop(host, None)
+
+    def get(self, host):
+        """
+        :param host: host[:port]
+        :return: asyncio.Semaphore of the host for the running event loop
+        """
+        semaphores = self.loop_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.host_limits.get(host, self.default_limit))
+            semaphores[host] = semaphore
+        return semaphore
+
+
+host_semaphores = HostSemaphores()
+
+
+class AsyncCurlMulti:
+    """
+    Runs libcurl transfers on an asyncio event loop through a curl multi handle.
+    libcurl tells us which sockets to watch and when to time out, and the loop calls back into libcurl,
+    so no thread is needed per request
+    """
+
+    def __init__(self, loop):
+        global pycurl
+        pycurl = load_pycurl()
+        self.loop = loop
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer)
+        self.watched_sockets = {}  # fd -> what libcurl wants to wait for
+        self.timer = None
+        self.futures = {}  # curl handle -> future of its transfer
+
+    def on_socket(self, what, sock_fd, multi, socketp):
+        """
+        Called by libcurl to tell which events to wait for on a socket
+        """
+        watched = self.watched_sockets.pop(sock_fd, None)
+        if watched in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self.loop.remove_reader(sock_fd)
+        if watched in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self.loop.remove_writer(sock_fd)
+
+        if what == pycurl.POLL_REMOVE:
+            return
+
+        if what in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self.loop.add_reader(sock_fd, self.on_socket_ready, sock_fd, pycurl.CSELECT_IN)
+        if what in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self.loop.add_writer(sock_fd, self.on_socket_ready, sock_fd, pycurl.CSELECT_OUT)
+        self.watched_sockets[sock_fd] = what
+
+    def on_timer(self, timeout_ms):
+        """
+        Called by libcurl to set the single timeout it needs. -1 removes the timer
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if timeout_ms >= 0:
+            self.timer = self.loop.call_later(timeout_ms / 1000, self.on_socket_ready, pycurl.SOCKET_TIMEOUT, 0)
+
+    def on_socket_ready(self, sock_fd, event):
+        """
+        Lets libcurl make progress on a socket (or on its timeout), then collects the finished transfers
+        """
+        if sock_fd == pycurl.SOCKET_TIMEOUT:
+            self.timer = None
+        self.multi.socket_action(sock_fd, event)
+        self.collect_finished_transfers()
+
+    def collect_finished_transfers(self):
+        while True:
+            queued, succeeded, failed = self.multi.info_read()
+            for handle in succeeded:
+                self.finish(handle, None)
+            for handle, code, message in failed:
+                self.finish(handle, pycurl.error(code, message))
+            if not queued:
+                return
+
+    def finish(self, handle, error):
+        future = self.futures.pop(handle, None)
+        self.multi.remove_handle(handle)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    async def perform(self, handle):
+        """
+        Runs the transfer of a configured curl easy handle. Raises pycurl.error like handle.perform() does
+        :param handle: pycurl.Curl
+        :return:
+        """
+        future = self.loop.create_future()
+        self.futures[handle] = future
+        self.multi.add_handle(handle)
+        try:
+            await future
+        finally:
+            if self.futures.pop(handle, None) is not None:
+                # Cancelled before the transfer finished
+                self.multi.remove_handle(handle)
+
+
+multi_per_loop = weakref.WeakKeyDictionary()
+
+
+def get_async_multi():
+    """
+    :return: AsyncCurlMulti of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    multi = multi_per_loop.get(loop)
+    if multi is None:
+        multi = AsyncCurlMulti(loop)
+        multi_per_loop[loop] = multi
+    return multi
@@ -0,0 +1,411 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+
+from CoreLibrary.FileLock import FileLock, lock_file_path
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cookies (
+    namespace TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    host_only INTEGER NOT NULL,
+    secure INTEGER NOT NULL,
+    http_only INTEGER NOT NULL,
+    expires REAL,
+    created REAL NOT NULL,
+    PRIMARY KEY (namespace, domain, path, name)
+)
+"""
+
+COLUMNS = 'domain, path, name, value, host_only, secure, http_only, expires, created'
+
+HTTP_ONLY_PREFIX = '#HttpOnly_'
+
+
+class StoredCookie:
+    """
+    A cookie as kept in the jar
+    """
+
+    def __init__(self, domain, path, name, value, host_only=True, secure=False, http_only=False, expires=None, created=None):
+        """
+        :param domain: Domain without leading dot
+        :param path:
+        :param name:
+        :param value:
+        :param host_only: True if the cookie is only sent to its exact domain, False if it is also sent to subdomains
+        :param secure:
+        :param http_only:
+        :param expires: Unix time the cookie expires at, None for session cookies
+        :param created: Unix time the cookie was stored
+        """
+        self.domain = domain
+        self.path = path
+        self.name = name
+        self.value = value
+        self.host_only = bool(host_only)
+        self.secure = bool(secure)
+        self.http_only = bool(http_only)
+        self.expires = expires
+        self.created = created
+
+    def is_expired(self, now):
+        return self.expires is not None and self.expires <= now
+
+    def matches(self, request_url):
+        """
+        Checks the domain, path and secure flag of the cookie against a request, like a browser does
+        :param request_url:
+        :return: bool
+        """
+        parts = urlsplit(request_url)
+        host = (parts.hostname or '').lower()
+        if self.host_only:
+            if host != self.domain:
+                return False
+        elif host != self.domain and not host.endswith('.' + self.domain):
+            return False
+
+        if self.secure and parts.scheme != 'https':
+            return False
+
+        request_path = parts.path or '/'
+        if request_path == self.path:
+            return True
+        return request_path.startswith(self.path) and (self.path.endswith('/') or request_path[len(self.path)] == '/')
+
+    def netscape_line(self):
+        """
+        :return: Line of the Netscape cookie file format read by curl -b
+        """
+        domain = self.domain if self.host_only else '.' + self.domain
+        if self.http_only:
+            domain = HTTP_ONLY_PREFIX + domain
+        include_subdomains = 'FALSE' if self.host_only else 'TRUE'
+        secure = 'TRUE' if self.secure else 'FALSE'
+        expires = int(self.expires) if self.expires is not None else 0
+        return f"{domain}\t{include_subdomains}\t{self.path}\t{secure}\t{expires}\t{self.name}\t{self.value}"
+
+    def __repr__(self):
+        return f"<StoredCookie {self.name} for {self.domain}{self.path}>"
+
+
+def parse_expires(set_cookie, now):
+    """
+    :param set_cookie: SetCookie
+    :param now:
+    :return: Unix time the cookie expires at, or None for a session cookie. Max-Age takes precedence over Expires
+    """
+    max_age = set_cookie.attributes.get('max-age')
+    if isinstance(max_age, str):
+        try:
+            return now + int(max_age)
+        except ValueError:
+            pass
+
+    expires = set_cookie.attributes.get('expires')
+    if isinstance(expires, str):
+        from email.utils import parsedate_to_datetime
+        try:
+            # Some servers write the date with dashes: Wed, 21-Oct-2015 07:28:00 GMT
+            return parsedate_to_datetime(expires.replace('-', ' ')).timestamp()
+        except (TypeError, ValueError, IndexError):
+            logger.debug("Could not parse cookie expiry date: %s", expires)
+    return None
+
+
+def default_path(request_url):
+    """
+    :param request_url:
+    :return: Path a cookie without a Path attribute applies to: the directory of the request path
+    """
+    path = urlsplit(request_url).path
+    if not path.startswith('/') or path.count('/') == 1:
+        return '/'
+    return path[:path.rfind('/')]
+
+
+class CookieJar:
+    """
+    Cookie store shared by every thread and process of the machine, backed by SQLite.
+    Cookies are kept per namespace (usually the carrier, eg: "ups_curl") with their domain, path and expiry,
+    and only the cookies matching a request are returned for it. SQLite does the locking and every write is a
+    transaction, so concurrent workers never see a half written jar.
+    The jar can be exported to, and imported back from, the Netscape cookie file format used by curl -b and -c
+    """
+    shared_jar = None
+    shared_jar_lock = threading.Lock()
+
+    def __init__(self, database_path=None, busy_timeout=30):
+        """
+        :param database_path: SQLite file. Defaults to the CURL_COOKIE_JAR environment variable,
+        or curl_cookies.sqlite in the current directory
+        :param busy_timeout: Seconds to wait for another process holding the jar locked
+        """
+        self.database_path = database_path or os.environ.get('CURL_COOKIE_JAR', 'curl_cookies.sqlite')
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+
+    @classmethod
+    def shared(cls):
+        """
+        Process wide jar used by default by the carrier tracking classes
+        :return: CookieJar
+        """
+        with cls.shared_jar_lock:
+            if cls.shared_jar is None:
+                cls.shared_jar = cls()
+            return cls.shared_jar
+
+    def connection(self):
+        """
+        :return: SQLite connection of the calling thread. Connections are never shared between threads or processes
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self.database_path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction. Takes the write lock up front, so two processes cannot both read then write
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def store_response(self, namespace, response, request_url, replace=False):
+        """
+        Stores the cookies set by every response of a request, redirects included.
+        Each hop is matched to its own url, so cookies without a Domain attribute get the right host
+        :param namespace:
+        :param response: CurlResponse
+        :param request_url: Url the request was sent to
+        :param replace: Remove the cookies already in the namespace first, eg: when a new session is started
+        :return: Number of cookies stored
+        """
+        now = time.time()
+        hop_url = request_url
+        stored = 0
+        with self.transaction() as connection:
+            if replace:
+                connection.execute('DELETE FROM cookies WHERE namespace = ?', (namespace,))
+            for hop in response.header_hops:
+                for set_cookie in hop.set_cookies:
+                    self.store_set_cookie(connection, namespace, set_cookie, hop_url, now)
+                    stored += 1
+                location = hop.get('location')
+                if location:
+                    hop_url = urljoin(hop_url, location)
+            self.purge_expired(connection, now)
+        logger.debug("Stored %s cookies in jar %s", stored, namespace)
+        return stored
+
+    def store_set_cookie(self, connection, namespace, set_cookie, request_url, now):
+        """
+        :param connection: Connection of the current transaction
+        :param namespace:
+        :param set_cookie: SetCookie
+        :param request_url: Url of the response that set the cookie
+        :param now:
+        :return:
+        """
+        host = (urlsplit(request_url).hostname or '').lower()
+        domain = set_cookie.domain
+        if isinstance(domain, str) and domain.strip('.'):
+            domain = domain.strip('.').lower()
+            host_only = False
+        else:
+            domain = host
+            host_only = True
+
+        path = set_cookie.path if isinstance(set_cookie.path, str) and set_cookie.path.startswith('/') else default_path(request_url)
+        expires = parse_expires(set_cookie, now)
+        if expires is not None and expires <= now:
+            # Expiry in the past is how servers delete a cookie
+            connection.execute('DELETE FROM cookies WHERE namespace = ? AND domain = ? AND path = ? AND name = ?', (namespace, domain, path, set_cookie.name))
+            return
+
+        connection.execute(
+            f'INSERT OR REPLACE INTO cookies (namespace, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (namespace, domain, path, set_cookie.name, set_cookie.value, int(host_only), int('secure' in set_cookie.attributes), int('httponly' in set_cookie.attributes), expires, now)
+        )
+
+    def save_dict(self, namespace, cookies_dict, domain, path='/', max_age=None):
+        """
+        Stores a flat dict of cookies, for callers that only know names and values
+        :param namespace:
+        :param cookies_dict: dict of cookie name: value
+        :param domain: Domain the cookies apply to, subdomains included, eg: "ups.com"
+        :param path:
+        :param max_age: Seconds the cookies are valid for. Session cookies if None
+        :return:
+        """
+        now = time.time()
+        expires = now + max_age if max_age is not None else None
+        domain = domain.strip('.').lower()
+        with self.transaction() as connection:
+            for name, value in cookies_dict.items():
+                connection.execute(
+                    f'INSERT OR REPLACE INTO cookies (namespace, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (namespace, domain, path, name, str(value), 0, 0, 0, expires, now)
+                )
+            self.purge_expired(connection, now)
+
+    def purge_expired(self, connection, now):
+        connection.execute('DELETE FROM cookies WHERE expires IS NOT NULL AND expires <= ?', (now,))
+
+    def cookies(self, namespace, request_url=None):
+        """
+        :param namespace:
+        :param request_url: Only return the cookies that would be sent to this url. All cookies if None
+        :return: List of StoredCookie that have not expired, most specific path first
+        """
+        now = time.time()
+        rows = self.connection().execute(
+            f'SELECT {COLUMNS} FROM cookies WHERE namespace = ? AND (expires IS NULL OR expires > ?) ORDER BY length(path) DESC, created',
+            (namespace, now)
+        ).fetchall()
+        cookies = [StoredCookie(*row) for row in rows]
+        if request_url is not None:
+            cookies = [cookie for cookie in cookies if cookie.matches(request_url)]
+        return cookies
+
+    def bootstrap_lock(self, namespace, timeout=60):
+        """
+        Lock shared by every process using the jar, held while new cookies are obtained for a namespace,
+        so only one process at a time hits the site for them
+        :param namespace:
+        :param timeout: Seconds to wait for the process holding the lock, after which the caller goes ahead anyway
+        :return: FileLock, to use in a with block
+        """
+        return FileLock(lock_file_path(self.database_path, namespace), timeout=timeout)
+
+    def last_saved(self, namespace):
+        """
+        :param namespace:
+        :return: Unix time cookies were last stored in the namespace, None if it is empty
+        """
+        row = self.connection().execute('SELECT max(created) FROM cookies WHERE namespace = ?', (namespace,)).fetchone()
+        return row[0]
+
+    def load(self, namespace, request_url=None, max_age=None):
+        """
+        :param namespace:
+        :param request_url: Only return the cookies that would be sent to this url. All cookies if None
+        :param max_age: Return nothing if the namespace was last saved more than max_age seconds ago
+        :return: dict of cookie name: value. The most specific path wins when several cookies share a name
+        """
+        if max_age is not None:
+            last_saved = self.last_saved(namespace)
+            if last_saved is None or time.time() - last_saved >= max_age:
+                return {}
+
+        cookies_dict = {}
+        for cookie in self.cookies(namespace, request_url):
+            cookies_dict.setdefault(cookie.name, cookie.value)
+        return cookies_dict
+
+    def clear(self, namespace=None):
+        """
+        :param namespace: Namespace to empty. Every namespace if None
+        :return:
+        """
+        with self.transaction() as connection:
+            if namespace is None:
+                connection.execute('DELETE FROM cookies')
+            else:
+                connection.execute('DELETE FROM cookies WHERE namespace = ?', (namespace,))
+
+    def export_netscape(self, file_path, namespace, request_url=None):
+        """
+        Writes the cookies of a namespace to a Netscape cookie file, for curl -b.
+        The file is written next to its destination and renamed over it, so curl never reads a partial file
+        :param file_path:
+        :param namespace:
+        :param request_url: Only export the cookies that would be sent to this url
+        :return: Number of cookies written
+        """
+        cookies = self.cookies(namespace, request_url)
+        lines = ['# Netscape HTTP Cookie File'] + [cookie.netscape_line() for cookie in cookies]
+        directory = os.path.dirname(os.path.abspath(file_path))
+        temp_fd, temp_path = tempfile.mkstemp(prefix='.cookies_', dir=directory)
+        try:
+            with os.fdopen(temp_fd, 'w') as temp_file:
+                temp_file.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return len(cookies)
+
+    def import_netscape(self, file_path, namespace):
+        """
+        Stores the cookies of a Netscape cookie file, as written by curl -c.
+        The file is the whole cookie state after the request, so it replaces the namespace
+        :param file_path:
+        :param namespace:
+        :return: Number of cookies imported
+        """
+        now = time.time()
+        cookies = []
+        with open(file_path) as cookie_file:
+            for line in cookie_file:
+                line = line.rstrip('\n')
+                http_only = line.startswith(HTTP_ONLY_PREFIX)
+                if http_only:
+                    line = line[len(HTTP_ONLY_PREFIX):]
+                elif not line or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) != 7:
+                    continue
+                domain, include_subdomains, path, secure, expires, name, value = fields
+                expires = int(expires) or None
+                cookies.append((domain.strip('.').lower(), path, name, value, int(include_subdomains != 'TRUE'), int(secure == 'TRUE'), int(http_only), expires, now))
+
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM cookies WHERE namespace = ?', (namespace,))
+            connection.executemany(f'INSERT OR REPLACE INTO cookies (namespace, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(namespace,) + cookie for cookie in cookies])
+            self.purge_expired(connection, now)
+        return len(cookies)
+
+    @contextmanager
+    def cookie_file(self, namespace):
+        """
+        Lends the cookies of a namespace to curl: exports them to a temporary Netscape cookie file, and imports
+        whatever curl wrote to it back into the jar when the block exits.
+        eg: with jar.cookie_file("ups_curl") as cookie_file:
+                CurlRequests({}, {}, cookie_file=cookie_file).send_curl_request(link)
+        :param namespace:
+        :return: Path of the cookie file
+        """
+        temp_fd, file_path = tempfile.mkstemp(prefix='curl_cookies_', suffix='.txt')
+        os.close(temp_fd)
+        try:
+            self.export_netscape(file_path, namespace)
+            yield file_path
+            self.import_netscape(file_path, namespace)
+        finally:
+            if os.path.exists(file_path):
+                os.unlink(file_path)
@@ -0,0 +1,123 @@
+class SetCookie:
+    """
+    A cookie set by the server with a Set-Cookie header
+    """
+
+    def __init__(self, name, value, attributes):
+        """
+        :param name:
+        :param value:
+        :param attributes: dict of the cookie attributes, with lower case names (eg: "domain", "path", "max-age", "secure")
+        """
+        self.name = name
+        self.value = value
+        self.attributes = attributes
+
+    @classmethod
+    def parse(cls, header_value):
+        """
+        :param header_value: Value of a Set-Cookie header, eg: "id=abc; Path=/; Max-Age=3600; HttpOnly"
+        :return: SetCookie, or None if the header has no cookie name
+        """
+        parts = header_value.split(';')
+        name, sep, value = parts[0].partition('=')
+        name = name.strip()
+        if not sep or not name:
+            return None
+
+        attributes = {}
+        for part in parts[1:]:
+            attribute_name, sep, attribute_value = part.partition('=')
+            attribute_name = attribute_name.strip().lower()
+            if attribute_name:
+                attributes[attribute_name] = attribute_value.strip() if sep else True
+        return cls(name, value.strip(), attributes)
+
+    @property
+    def domain(self):
+        return self.attributes.get('domain')
+
+    @property
+    def path(self):
+        return self.attributes.get('path')
+
+    def __repr__(self):
+        return f"<SetCookie {self.name}>"
+
+
+class HeaderHop:
+    """
+    Status line and headers of one response. A request that follows redirects has one hop per response
+    """
+
+    def __init__(self, status_line):
+        self.status_line = status_line
+        parts = status_line.split(None, 2)
+        self.http_version = parts[0] if parts else ''
+        try:
+            self.status_code = int(parts[1])
+        except (IndexError, ValueError):
+            self.status_code = None
+        self.reason = parts[2] if len(parts) > 2 else ''
+        self.header_list = []  # list of (name, value), in the order the server sent them
+
+    def get(self, name, default=None):
+        """
+        :param name: Header name, case insensitive
+        :param default:
+        :return: Value of the last header with this name
+        """
+        name = name.lower()
+        for header_name, value in reversed(self.header_list):
+            if header_name.lower() == name:
+                return value
+        return default
+
+    def get_all(self, name):
+        """
+        :param name: Header name, case insensitive
+        :return: List of the values of every header with this name
+        """
+        name = name.lower()
+        return [value for header_name, value in self.header_list if header_name.lower() == name]
+
+    @property
+    def set_cookies(self):
+        """
+        :return: List of SetCookie set by this response
+        """
+        cookies = []
+        for header_value in self.get_all('set-cookie'):
+            cookie = SetCookie.parse(header_value)
+            if cookie is not None:
+                cookies.append(cookie)
+        return cookies
+
+    def __repr__(self):
+        return f"<HeaderHop {self.status_line}>"
+
+
+def parse_header_hops(raw_headers):
+    """
+    Parses the headers written by curl (with -D, or received by a libcurl header callback)
+    :param raw_headers: bytes. Every response of a redirected request, one after the other
+    :return: List of HeaderHop, one per response
+    """
+    hops = []
+    for line in raw_headers.decode('latin-1').split('\n'):
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        if line.startswith('HTTP/'):
+            hops.append(HeaderHop(line))
+        elif not hops:
+            continue
+        elif line[0] in ' \t' and hops[-1].header_list:
+            # Obsolete folded header, continues the previous value
+            name, value = hops[-1].header_list[-1]
+            hops[-1].header_list[-1] = (name, f"{value} {line.strip()}")
+        else:
+            name, sep, value = line.partition(':')
+            if sep:
+                hops[-1].header_list.append((name.strip(), value.strip()))
+    return hops
@@ -0,0 +1,53 @@
+import json
+import logging
+import sys
+
+LIBRARY_LOGGERS = ('CoreLibrary', 'TrackingSiteModules', 'DropapkModules')
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Attributes every log record has. Anything else was passed with "extra" and is added to the JSON output
+STANDARD_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Formats each log record as a single JSON object, including the fields passed with "extra"
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO, json_format=False, stream=None):
+    """
+    Shows the logs of the library. Nothing is output unless this is called (or logging is configured by the application).
+    Server responses and full curl commands are only logged at DEBUG level
+    :param level: logging level, eg: logging.DEBUG
+    :param json_format: Output one JSON object per line instead of text
+    :param stream: Defaults to stderr
+    :return: The handler added to the library loggers
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonLogFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    handler.curl_browser_handler = True
+
+    for name in LIBRARY_LOGGERS:
+        logger = logging.getLogger(name)
+        for existing_handler in list(logger.handlers):
+            if getattr(existing_handler, 'curl_browser_handler', False):
+                logger.removeHandler(existing_handler)
+        logger.addHandler(handler)
+        logger.setLevel(level)
+
+    return handler
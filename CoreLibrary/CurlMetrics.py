@@ -0,0 +1,264 @@
+import threading
+
+# Variables of curl --write-out, in the order they are written by the subprocess transport
+TIMING_VARIABLES = ('time_namelookup', 'time_connect', 'time_appconnect', 'time_pretransfer', 'time_starttransfer', 'time_total', 'size_download')
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class CurlTiming:
+    """
+    Timing variables of one request, as reported by curl. All times are in seconds since the start of the request,
+    so they are cumulative: time_connect includes time_namelookup, and so on
+    """
+
+    def __init__(self, time_namelookup=0.0, time_connect=0.0, time_appconnect=0.0, time_pretransfer=0.0, time_starttransfer=0.0, time_total=0.0, size_download=0):
+        self.time_namelookup = time_namelookup
+        self.time_connect = time_connect
+        self.time_appconnect = time_appconnect
+        self.time_pretransfer = time_pretransfer
+        self.time_starttransfer = time_starttransfer
+        self.time_total = time_total
+        self.size_download = size_download
+
+    @classmethod
+    def from_write_out(cls, write_out):
+        """
+        :param write_out: Values of TIMING_VARIABLES separated by spaces, as written by curl -w
+        :return: CurlTiming, or None if the values cannot be parsed
+        """
+        values = write_out.split()
+        if len(values) != len(TIMING_VARIABLES):
+            return None
+        try:
+            times = [float(value) for value in values[:-1]]
+            size_download = int(float(values[-1]))
+        except ValueError:
+            return None
+        return cls(*times, size_download=size_download)
+
+    def stages(self):
+        """
+        Splits the cumulative times into the time spent in each stage of the request.
+        "tls" is left out for requests that did no TLS handshake (plain http, or a reused connection)
+        :return: dict of stage name: seconds
+        """
+        stages = {
+            'dns': self.time_namelookup,
+            'connect': max(self.time_connect - self.time_namelookup, 0.0),
+        }
+        if self.time_appconnect:
+            stages['tls'] = max(self.time_appconnect - self.time_connect, 0.0)
+        stages['server'] = max(self.time_starttransfer - self.time_pretransfer, 0.0)
+        stages['transfer'] = max(self.time_total - self.time_starttransfer, 0.0)
+        stages['total'] = self.time_total
+        return stages
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in TIMING_VARIABLES}
+
+    def __repr__(self):
+        return f"<CurlTiming total={self.time_total:.3f}s>"
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def cumulative_counts(self):
+        """
+        :return: List of the number of observations <= each bucket bound
+        """
+        counts = []
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def merge(self, other):
+        """
+        Adds the observations of another histogram with the same buckets
+        :param other: Histogram
+        :return:
+        """
+        for index, count in enumerate(other.bucket_counts):
+            self.bucket_counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating linearly within the bucket it falls in, the same way
+        Prometheus histogram_quantile does
+        :param q: Between 0 and 1, eg: 0.99
+        :return: seconds, or None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower_bound = 0.0
+        previous_count = 0
+        for upper_bound, count in zip(self.buckets, self.cumulative_counts()):
+            if count >= rank:
+                in_bucket = count - previous_count
+                if not in_bucket:
+                    return upper_bound
+                return lower_bound + (upper_bound - lower_bound) * (rank - previous_count) / in_bucket
+            lower_bound = upper_bound
+            previous_count = count
+        # Above the last bucket
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    In process registry of the request metrics, labelled by host and carrier.
+    Safe to use from several threads. Exported in the Prometheus text format with export_prometheus
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.stage_histograms = {}  # (host, carrier, stage) -> Histogram
+        self.request_counts = {}  # (host, carrier, outcome) -> count
+        self.downloaded_bytes = {}  # (host, carrier) -> bytes
+
+    def record(self, host, carrier, response):
+        """
+        Records the outcome of a request, and its timing if curl reported one
+        :param host: host[:port] the request was sent to
+        :param carrier: Carrier (or any name of the caller) the request was sent for, None if unknown
+        :param response: CurlResponse
+        :return:
+        """
+        carrier = carrier or ''
+        if response.timed_out:
+            outcome = 'timeout'
+        elif response.error is not None or response.status_code is None:
+            # No response received: the request could not be sent, or curl itself failed (eg: connection refused)
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+
+        with self.lock:
+            key = (host, carrier, outcome)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+            timing = response.timing
+            if timing is None or outcome != 'ok':
+                # Times of failed transfers would skew the latency of the stages that did complete
+                return
+            for stage, seconds in timing.stages().items():
+                key = (host, carrier, stage)
+                histogram = self.stage_histograms.get(key)
+                if histogram is None:
+                    histogram = self.stage_histograms[key] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            self.downloaded_bytes[(host, carrier)] = self.downloaded_bytes.get((host, carrier), 0) + timing.size_download
+
+    def histogram(self, stage='total', host=None, carrier=None):
+        """
+        :param stage: One of the CurlTiming.stages names
+        :param host: Only include requests to this host. All hosts if None
+        :param carrier: Only include requests for this carrier. All carriers if None
+        :return: Histogram merging every matching label set
+        """
+        merged = Histogram(self.buckets)
+        with self.lock:
+            for (histogram_host, histogram_carrier, histogram_stage), histogram in self.stage_histograms.items():
+                if histogram_stage != stage:
+                    continue
+                if host is not None and histogram_host != host:
+                    continue
+                if carrier is not None and histogram_carrier != carrier:
+                    continue
+                merged.merge(histogram)
+        return merged
+
+    def quantile(self, q, stage='total', host=None, carrier=None):
+        """
+        :param q: eg: 0.5 for p50, 0.99 for p99
+        :param stage:
+        :param host:
+        :param carrier:
+        :return: seconds, or None if no matching request was timed
+        """
+        return self.histogram(stage, host, carrier).quantile(q)
+
+    def reset(self):
+        with self.lock:
+            self.stage_histograms.clear()
+            self.request_counts.clear()
+            self.downloaded_bytes.clear()
+
+    def export_prometheus(self):
+        """
+        :return: All the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            lines.append('# HELP curl_requests_total Requests sent, by outcome (ok, error, timeout). ok means a response was received, whatever its status')
+            lines.append('# TYPE curl_requests_total counter')
+            for (host, carrier, outcome), count in sorted(self.request_counts.items()):
+                lines.append(f'curl_requests_total{format_labels(host=host, carrier=carrier, outcome=outcome)} {count}')
+
+            lines.append('# HELP curl_downloaded_bytes_total Bytes downloaded (size_download)')
+            lines.append('# TYPE curl_downloaded_bytes_total counter')
+            for (host, carrier), size in sorted(self.downloaded_bytes.items()):
+                lines.append(f'curl_downloaded_bytes_total{format_labels(host=host, carrier=carrier)} {size}')
+
+            lines.append('# HELP curl_request_stage_seconds Time spent in each stage of a request (dns, connect, tls, server, transfer, total)')
+            lines.append('# TYPE curl_request_stage_seconds histogram')
+            for (host, carrier, stage), histogram in sorted(self.stage_histograms.items()):
+                for upper_bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    labels = format_labels(host=host, carrier=carrier, stage=stage, le=format_value(upper_bound))
+                    lines.append(f'curl_request_stage_seconds_bucket{labels} {count}')
+                labels = format_labels(host=host, carrier=carrier, stage=stage, le='+Inf')
+                lines.append(f'curl_request_stage_seconds_bucket{labels} {histogram.count}')
+                labels = format_labels(host=host, carrier=carrier, stage=stage)
+                lines.append(f'curl_request_stage_seconds_sum{labels} {format_value(histogram.sum)}')
+                lines.append(f'curl_request_stage_seconds_count{labels} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    return repr(float(value))
+
+
+def format_labels(**labels):
+    """
+    :return: Prometheus label set, eg: {host="www.ups.com",stage="dns"}
+    """
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+metrics_registry = MetricsRegistry()
+
+
+def get_metrics_registry():
+    """
+    :return: Registry CurlRequests records into when it is not given one
+    """
+    return metrics_registry
@@ -0,0 +1,279 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Responses telling that the site wants fewer requests: too many requests, banned (the carrier sites answer 403 to
+# clients they consider abusive), and overloaded
+THROTTLE_STATUS_CODES = frozenset((403, 429, 503))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    host TEXT PRIMARY KEY,
+    rate REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    last_decrease REAL NOT NULL
+)
+"""
+
+
+def retry_after_seconds(response):
+    """
+    :param response: CurlResponse
+    :return: Seconds of the Retry-After header of the response, None if it has none (or it is an HTTP date)
+    """
+    headers = response.headers
+    value = headers.get('retry-after') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+class HostBucket:
+    """
+    Token bucket of one host. Tokens are refilled at `rate` per second, one is taken per request.
+    Requests that find no token take one anyway and wait until it is refilled, so the tokens can go negative:
+    a queue of requests, each told when its turn comes
+    """
+    __slots__ = ('rate', 'tokens', 'updated', 'blocked_until', 'last_decrease')
+
+    def __init__(self, rate, tokens, updated, blocked_until=0.0, last_decrease=0.0):
+        self.rate = rate
+        self.tokens = tokens
+        self.updated = updated  # Unix time the tokens were last refilled
+        self.blocked_until = blocked_until  # No request before this Unix time (Retry-After)
+        self.last_decrease = last_decrease
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"<HostBucket {self.rate:.2f}/s {self.tokens:.2f} tokens>"
+
+
+class RateLimiter:
+    """
+    Limits the requests sent to each host with a token bucket, and adapts the rate of each host to what the site
+    tolerates, AIMD style like TCP congestion control. Until a host first throttles, every successful response
+    raises its rate by one (slow start), up to `slow_start_limit` times its starting rate only: the carrier sites ban
+    rather than slow down, so the ceiling is not looked for by overshooting it. Past that, every successful
+    response raises the rate a little (by `increase` requests per second over each second at full rate), and
+    a throttling response (403, 429, 503) cuts it by `decrease`, at most once per `decrease_interval`. A Retry-After header pauses the host as long as it asks.
+    The buckets are shared by all the threads of the process, and with a database_path by all the processes
+    of the machine, so a fleet of workers stays under the tolerance of the carrier as a whole.
+    eg: limiter = RateLimiter(rate=5, host_rates={"www.ups.com": 10})
+        curl = CurlRequests(cookies_dict={}, headers_dict={}, rate_limiter=limiter)
+    """
+    shared_limiter = None
+    shared_limiter_lock = threading.Lock()
+
+    def __init__(self, rate=5, min_rate=0.5, max_rate=10, burst=1.0, increase=0.5, decrease=0.5, decrease_interval=1.0, host_rates=None,
+                 database_path=None, busy_timeout=30, slow_start_limit=2.0):
+        """
+        :param rate: Starting requests per second of each host
+        :param min_rate: The rate is never cut below this
+        :param max_rate: The rate never grows above this
+        :param burst: Seconds of requests at the current rate that can be sent at once after an idle period
+        :param increase: Requests per second added to the rate for each second of successful requests at the full rate
+        :param decrease: The rate is multiplied by this on a throttling response
+        :param decrease_interval: Seconds after a decrease during which throttling responses do not cut the rate again:
+        they were usually sent before the decrease
+        :param host_rates: dict of host -> starting rate, overriding rate
+        :param database_path: SQLite file the buckets are kept in, to share them between processes.
+        Defaults to the CURL_RATE_LIMIT_DB environment variable. In memory, for this process only, if neither is set
+        :param busy_timeout: Seconds to wait for another process holding the database locked
+        :param slow_start_limit: Slow start stops at this many times the starting rate of the host. 1 or less for none:
+        the rate only grows by `increase` from the start
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.host_rates = dict(host_rates or {})
+        self.slow_start_limit = slow_start_limit
+        self.database_path = database_path or os.environ.get('CURL_RATE_LIMIT_DB')
+        self.busy_timeout = busy_timeout
+        self.buckets = {}  # host -> HostBucket, without a database
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.throttled = 0  # Rate decreases, all hosts together
+
+    @classmethod
+    def shared(cls):
+        """
+        Process wide limiter used by default by the carrier tracking classes
+        :return: RateLimiter
+        """
+        with cls.shared_limiter_lock:
+            if cls.shared_limiter is None:
+                cls.shared_limiter = cls()
+            return cls.shared_limiter
+
+    def connection(self):
+        """
+        :return: SQLite connection of the calling thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self.database_path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def new_bucket(self, host, now):
+        rate = self.host_rates.get(host, self.rate)
+        return HostBucket(rate, self.capacity(rate), now)
+
+    def capacity(self, rate):
+        return max(1.0, rate * self.burst)
+
+    @contextmanager
+    def bucket(self, host):
+        """
+        Bucket of a host, locked for the calling thread (and process, with a database) until the block ends.
+        Changes made to it in the block are kept
+        :param host:
+        :return: HostBucket
+        """
+        now = time.time()
+        if not self.database_path:
+            with self.lock:
+                bucket = self.buckets.get(host)
+                if bucket is None:
+                    bucket = self.buckets[host] = self.new_bucket(host, now)
+                yield bucket
+            return
+
+        connection = self.connection()
+        # Takes the write lock up front, so two processes cannot both read then write
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT rate, tokens, updated, blocked_until, last_decrease FROM rate_limits WHERE host = ?', (host,)).fetchone()
+            bucket = HostBucket(*row) if row else self.new_bucket(host, now)
+            yield bucket
+            connection.execute('INSERT OR REPLACE INTO rate_limits (host, rate, tokens, updated, blocked_until, last_decrease) VALUES (?, ?, ?, ?, ?, ?)',
+                               (host, bucket.rate, bucket.tokens, bucket.updated, bucket.blocked_until, bucket.last_decrease))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def reserve(self, host):
+        """
+        Takes a token of the host for a request
+        :param host: host[:port]
+        :return: Seconds to wait before sending the request
+        """
+        with self.bucket(host) as bucket:
+            now = time.time()
+            capacity = self.capacity(bucket.rate)
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * bucket.rate)
+            bucket.updated = now
+            bucket.tokens -= 1
+            wait = -bucket.tokens / bucket.rate if bucket.tokens < 0 else 0.0
+            if bucket.blocked_until > now + wait:
+                # The token is used once the host is unblocked
+                wait = bucket.blocked_until - now
+                bucket.tokens = min(bucket.tokens, 0.0)
+        return wait
+
+    def acquire(self, host):
+        """
+        Waits for the turn of a request to the host
+        :param host: host[:port]
+        :return: Seconds waited
+        """
+        wait = self.reserve(host)
+        if wait > 0:
+            logger.debug("Waiting %.3f seconds for the rate limit of %s", wait, host)
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, host):
+        """
+        Asyncio version of acquire, the event loop keeps running while waiting
+        :param host:
+        :return: Seconds waited
+        """
+        import asyncio
+
+        if self.database_path:
+            # The SQLite transaction can wait up to busy_timeout for another process, so it runs in the default executor
+            wait = await asyncio.get_running_loop().run_in_executor(None, self.reserve, host)
+        else:
+            wait = self.reserve(host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def record(self, host, response):
+        """
+        Adapts the rate of a host to a response it sent
+        :param host: host[:port]
+        :param response: CurlResponse
+        :return:
+        """
+        status_code = response.status_code
+        if status_code is None:
+            # No answer from the site, nothing to learn about its rate limit
+            return
+
+        throttled = status_code in THROTTLE_STATUS_CODES
+        with self.bucket(host) as bucket:
+            now = time.time()
+            if not throttled:
+                slow_start_ceiling = min(self.max_rate, self.slow_start_limit * self.host_rates.get(host, self.rate))
+                if not bucket.last_decrease and bucket.rate < slow_start_ceiling:
+                    bucket.rate = min(slow_start_ceiling, bucket.rate + 1.0)
+                else:
+                    bucket.rate = min(self.max_rate, bucket.rate + self.increase / bucket.rate)
+                return
+
+            retry_after = retry_after_seconds(response)
+            if retry_after:
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            if now - bucket.last_decrease < self.decrease_interval:
+                return
+            previous_rate = bucket.rate
+            bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+            bucket.last_decrease = now
+            # Drop the tokens saved at the previous rate, the next requests are spaced at the new one
+            bucket.tokens = min(bucket.tokens, 0.0)
+
+        with self.lock:
+            self.throttled += 1
+        logger.warning("%s answered %s. Rate limit lowered from %.2f to %.2f requests per second", host, status_code, previous_rate, bucket.rate)
+
+    def set_rate(self, host, rate):
+        """
+        Sets the current rate of a host. It keeps adapting from there
+        :param host:
+        :param rate: Requests per second
+        :return:
+        """
+        with self.bucket(host) as bucket:
+            bucket.rate = min(max(rate, self.min_rate), self.max_rate)
+
+    def stats(self):
+        """
+        :return: dict of host -> state of its bucket, eg: {"www.ups.com": {"rate": 7.5, "tokens": 0.2, ...}}
+        """
+        if not self.database_path:
+            with self.lock:
+                return {host: bucket.as_dict() for host, bucket in self.buckets.items()}
+        rows = self.connection().execute('SELECT host, rate, tokens, updated, blocked_until, last_decrease FROM rate_limits').fetchall()
+        return {row[0]: HostBucket(*row[1:]).as_dict() for row in rows}
@@ -0,0 +1,201 @@
+import gzip
+import json
+
+from CoreLibrary.CurlHeaders import parse_header_hops
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# First byte (after whitespace) of any JSON document
+JSON_FIRST_BYTES = frozenset(b'{["-0123456789tfn')
+WHITESPACE = b' \t\r\n'
+NOT_DECODED = object()
+
+
+class CurlResponse:
+    """
+    Response of CurlRequests.send_request.
+    Holds the raw output of curl and only does the work a caller asks for: the body is decompressed on first access
+    of .content, decoded on .text and parsed on .json(). Whether the body is gzipped is sniffed from its magic bytes
+    and JSON parsing is skipped for bodies that cannot be JSON, like HTML pages.
+    The response headers are captured separately from the body, whether or not include was used:
+    status_code and headers are those of the final response, header_hops has one entry per response of a redirected request
+    """
+
+    def __init__(self, raw, content_type=None, timed_out=False, error=None, header_hops=None, timing=None):
+        """
+        :param raw: Raw bytes output by curl
+        :param content_type: Content type of the response, if known. Taken from the headers otherwise
+        :param timed_out: True if the request timed out
+        :param error: Description of the error if the request could not be sent
+        :param header_hops: List of HeaderHop, one per response received (see CoreLibrary.CurlHeaders)
+        :param timing: CurlTiming of the transfer (see CoreLibrary.CurlMetrics), None if curl did not report one
+        """
+        self.raw = raw
+        self.timing = timing
+        self.header_hops = header_hops or []
+        if content_type is None and self.headers is not None:
+            content_type = self.headers.get('content-type')
+        self.content_type = content_type
+        self.timed_out = timed_out
+        self.error = error
+        self.decompressed = None
+        self.decoded = NOT_DECODED
+
+    @classmethod
+    def from_output(cls, stdout, stderr, raw_headers=b'', timing=None, content_type=None):
+        """
+        :param stdout: curl stdout
+        :param stderr: curl stderr
+        :param raw_headers: Response headers, as written by curl -D
+        :param timing: CurlTiming
+        :param content_type:
+        :return: CurlResponse
+        """
+        if stdout:
+            # If both stdout and stderr exist, there is a valid response/ output data we need to see.
+            # Stderr in this case will just be diagnostics. So will only grab stdout
+            raw = stdout
+        elif stderr:
+            raw = stderr
+        else:
+            raw = b''
+        return cls(raw, content_type=content_type, header_hops=parse_header_hops(raw_headers), timing=timing)
+
+    @classmethod
+    def failed(cls, error, timed_out=False):
+        """
+        Response of a request that could not be completed
+        :param error:
+        :param timed_out:
+        :return: CurlResponse
+        """
+        return cls(b'', timed_out=timed_out, error=str(error))
+
+    @property
+    def ok(self):
+        return self.error is None and not self.timed_out
+
+    @property
+    def headers(self):
+        """
+        :return: HeaderHop of the final response, or None if no response was received
+        """
+        if self.header_hops:
+            return self.header_hops[-1]
+        return None
+
+    @property
+    def status_code(self):
+        """
+        :return: HTTP status of the final response, or None if no response was received
+        """
+        if self.headers is None:
+            return None
+        return self.headers.status_code
+
+    @property
+    def set_cookies(self):
+        """
+        :return: List of SetCookie set by every response, redirects included, in the order they were received
+        """
+        return [cookie for hop in self.header_hops for cookie in hop.set_cookies]
+
+    def cookies_dict(self):
+        """
+        :return: dict of cookie name: value set by the responses. A cookie set more than once keeps its last value
+        """
+        return {cookie.name: cookie.value for cookie in self.set_cookies}
+
+    @property
+    def is_gzipped(self):
+        return self.raw[:2] == GZIP_MAGIC
+
+    @property
+    def content(self):
+        """
+        :return: Body bytes, decompressed if the server sent them gzipped
+        """
+        if self.decompressed is None:
+            self.decompressed = self.raw
+            if self.is_gzipped:
+                try:
+                    self.decompressed = gzip.decompress(self.raw)
+                except (OSError, EOFError):
+                    # Corrupt or truncated, keep the raw bytes
+                    pass
+        return self.decompressed
+
+    def decode_content(self):
+        """
+        :return: Body as a string, or None if it is not valid utf-8
+        """
+        if self.decoded is NOT_DECODED:
+            try:
+                self.decoded = self.content.decode()
+            except UnicodeDecodeError:
+                self.decoded = None
+        return self.decoded
+
+    @property
+    def text(self):
+        """
+        :return: Body as a string. Bytes that are not valid utf-8 are replaced
+        """
+        text = self.decode_content()
+        if text is None:
+            return self.content.decode(errors='replace')
+        return text
+
+    def may_be_json(self):
+        """
+        Cheap check, done before trying to parse the body, that rules out bodies that cannot be JSON
+        :return: bool
+        """
+        if self.content_type is not None:
+            content_type = self.content_type.lower()
+            if 'html' in content_type or 'xml' in content_type:
+                return False
+
+        content = self.content
+        start = 0
+        while start < len(content) and content[start] in WHITESPACE:
+            start += 1
+        return start < len(content) and content[start] in JSON_FIRST_BYTES
+
+    def json(self):
+        """
+        :return: Body parsed as JSON
+        :raises ValueError: if the body is not JSON
+        """
+        if not self.may_be_json():
+            raise ValueError("Response body is not JSON")
+        text = self.decode_content()
+        if text is None:
+            raise ValueError("Response body is not valid utf-8")
+        return json.loads(text)
+
+    def as_dict(self):
+        """
+        Compatibility shim for the response send_curl_request has always returned:
+        the JSON loaded body if the server returned JSON, otherwise {"response": body}.
+        {"Timeout": True} for timeouts and {} for requests that could not be sent
+        :return:
+        """
+        if self.timed_out:
+            return {'Timeout': True}
+        if self.error is not None:
+            return {}
+
+        if self.may_be_json():
+            try:
+                return self.json()
+            except ValueError:
+                pass
+
+        text = self.decode_content()
+        return {"response": self.content if text is None else text}
+
+    def __repr__(self):
+        if self.status_code is not None:
+            return f"<CurlResponse [{self.status_code}] [{len(self.raw)} bytes]>"
+        return f"<CurlResponse [{len(self.raw)} bytes]>"
@@ -0,0 +1,112 @@
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth asking again for: throttled, or the site (or a gateway in front of it) failed for a moment
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+class RetryPolicy:
+    """
+    When to send a request again and how long to wait first. Waits grow exponentially with the attempts,
+    with full jitter (a random wait between 0 and the exponential bound), so clients that failed together
+    do not all come back at the same moment. A Retry-After header of the response is honored, up to max_backoff.
+    eg: curl = CurlRequests(cookies_dict={}, headers_dict={}, retry_policy=RetryPolicy(max_attempts=4))
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=10, retry_status_codes=RETRY_STATUS_CODES, retry_timeouts=True, retry_errors=True):
+        """
+        :param max_attempts: Attempts in total, the first one included. 1 for no retry
+        :param backoff: Bound of the wait before the first retry, in seconds. Doubles with each retry
+        :param max_backoff: Longest wait between two attempts, in seconds
+        :param retry_status_codes: Response statuses that are retried
+        :param retry_timeouts: Retry requests that timed out
+        :param retry_errors: Retry requests that got no response (eg: connection refused, proxy unreachable)
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_status_codes = frozenset(retry_status_codes)
+        self.retry_timeouts = retry_timeouts
+        self.retry_errors = retry_errors
+
+    def should_retry(self, response, attempt):
+        """
+        :param response: CurlResponse of the attempt
+        :param attempt: Number of the attempt, 1 for the first one
+        :return: True if the request should be sent again
+        """
+        if attempt >= self.max_attempts:
+            return False
+        if response.timed_out:
+            return self.retry_timeouts
+        if response.error is not None or response.status_code is None:
+            return self.retry_errors
+        return response.status_code in self.retry_status_codes
+
+    def delay(self, response, attempt):
+        """
+        :param response: CurlResponse of the failed attempt
+        :param attempt: Number of the failed attempt, 1 for the first one
+        :return: Seconds to wait before the next attempt
+        """
+        from CoreLibrary.CurlRateLimiter import retry_after_seconds
+
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2 ** (attempt - 1), self.max_backoff))
+
+
+class HedgePolicy:
+    """
+    Hedged requests: if a request has not answered after the usual latency of its host (a high quantile, p95 by default,
+    from the metrics registry of the requester), the same request is sent again and the first good answer is used.
+    Only the slowest requests get a duplicate, about 1 in 20 at p95, and they no longer wait for the slow attempt,
+    which bounds the tail latency.
+    Hedged requests must be safe to send twice, which tracking queries are
+    eg: curl = CurlRequests(cookies_dict={}, headers_dict={}, carrier="ups_curl", hedge_policy=HedgePolicy())
+    """
+
+    def __init__(self, quantile=0.95, min_delay=0.05, max_delay=None, min_samples=20, default_delay=None):
+        """
+        :param quantile: Quantile of the latency of the host after which the duplicate is sent
+        :param min_delay: Never send the duplicate sooner than this, in seconds
+        :param max_delay: Never wait longer than this before sending the duplicate, in seconds. No bound if None
+        :param min_samples: Requests of the host that must have been timed before its quantile is trusted
+        :param default_delay: Seconds to wait before the duplicate while the host has fewer samples.
+        None to not hedge until then
+        """
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+
+    def delay(self, metrics_registry, host, carrier=None):
+        """
+        :param metrics_registry: MetricsRegistry the latencies of the requests are recorded in
+        :param host: host[:port] of the request
+        :param carrier: Carrier the request is sent for. The latencies of every carrier are used if None
+        :return: Seconds to wait before sending the duplicate, or None to not send one
+        """
+        histogram = metrics_registry.histogram('total', host, carrier)
+        if histogram.count < self.min_samples:
+            delay = self.default_delay
+        else:
+            delay = histogram.quantile(self.quantile)
+        if delay is None:
+            return None
+        delay = max(delay, self.min_delay)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+
+def is_usable_response(response):
+    """
+    :param response: CurlResponse of one of the attempts of a hedged request
+    :return: True if it can be used without waiting for the other attempt
+    """
+    return response.ok and response.status_code is not None and response.status_code < 500
@@ -0,0 +1,137 @@
+import threading
+import time
+
+from CoreLibrary.CurlTransports import LibcurlTransport, SubprocessCurlTransport, libcurl_available, load_pycurl
+
+
+class CurlSessionPool:
+    """
+    Keeps libcurl handles alive per host so consecutive requests to the same site reuse the open
+    connection instead of doing a new TCP and TLS handshake every time.
+    All handles of a pool share one TLS session cache and DNS cache, so even a new connection to a host
+    the pool has already talked to resumes the TLS session.
+
+    Without pycurl, connections cannot outlive the curl process, and the pool falls back to the subprocess transport
+    """
+    shared_pool = None
+    shared_pool_lock = threading.Lock()
+
+    def __init__(self, max_handles_per_host=4, idle_timeout=60):
+        """
+        :param max_handles_per_host: Number of idle handles (each with its open connection) kept per host.
+        Concurrent requests above this number still work, their handles are closed after use
+        :param idle_timeout: Seconds a handle can stay unused in the pool before it is closed
+        """
+        self.max_handles_per_host = max_handles_per_host
+        self.idle_timeout = idle_timeout
+        self.idle_handles = {}  # host -> list of (handle, last used time)
+        self.lock = threading.Lock()
+        self.last_eviction = time.monotonic()
+
+        if libcurl_available():
+            pycurl = load_pycurl()
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.transport = LibcurlTransport(session_pool=self)
+        else:
+            self.share = None
+            self.transport = SubprocessCurlTransport()
+
+    @classmethod
+    def shared(cls):
+        """
+        Process wide pool used by default by the carrier tracking classes
+        :return: CurlSessionPool
+        """
+        with cls.shared_pool_lock:
+            if cls.shared_pool is None:
+                cls.shared_pool = cls()
+            return cls.shared_pool
+
+    def acquire(self, host):
+        """
+        Gets an idle handle for the host, or a new one if there is none.
+        The handle is reset before being returned, which clears its options but keeps its connections
+        :param host: host[:port] of the request
+        :return: pycurl.Curl
+        """
+        handle = None
+        with self.lock:
+            self.evict_idle_handles()
+            handles = self.idle_handles.get(host)
+            if handles:
+                handle, last_used = handles.pop()
+
+        pycurl = load_pycurl()
+        if handle is None:
+            handle = pycurl.Curl()
+            handle.setopt(pycurl.SHARE, self.share)
+        else:
+            # pycurl keeps the share attached through a reset
+            handle.reset()
+
+        if hasattr(pycurl, 'MAXAGE_CONN'):
+            handle.setopt(pycurl.MAXAGE_CONN, int(self.idle_timeout))
+        return handle
+
+    def release(self, host, handle):
+        """
+        Returns a handle to the pool once its request is done
+        :param host:
+        :param handle:
+        :return:
+        """
+        with self.lock:
+            handles = self.idle_handles.setdefault(host, [])
+            if len(handles) < self.max_handles_per_host:
+                handles.append((handle, time.monotonic()))
+                return
+
+        handle.close()
+
+    def evict_idle_handles(self, force=False):
+        """
+        Closes handles that have not been used for idle_timeout seconds. Must be called with the lock held.
+        Runs at most once a second unless forced
+        :param force:
+        :return:
+        """
+        now = time.monotonic()
+        if not force and now - self.last_eviction < 1:
+            return
+        self.last_eviction = now
+
+        for host in list(self.idle_handles):
+            keep = []
+            for handle, last_used in self.idle_handles[host]:
+                if now - last_used > self.idle_timeout:
+                    handle.close()
+                else:
+                    keep.append((handle, last_used))
+
+            if keep:
+                self.idle_handles[host] = keep
+            else:
+                del self.idle_handles[host]
+
+    def idle_handle_count(self, host=None):
+        """
+        :param host: If given, only count the handles of this host
+        :return: Number of idle handles currently kept
+        """
+        with self.lock:
+            if host is not None:
+                return len(self.idle_handles.get(host, []))
+            return sum(len(handles) for handles in self.idle_handles.values())
+
+    def close(self):
+        """
+        Closes every idle handle of the pool
+        :return:
+        """
+        with self.lock:
+            for handles in self.idle_handles.values():
+                for handle, last_used in handles:
+                    handle.close()
+            self.idle_handles = {}
@@ -0,0 +1,373 @@
+import codecs
+import logging
+import queue
+import threading
+import zlib
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Exit code of the curl binary when --max-time expired
+CURL_TIMEOUT_EXIT_CODE = 28
+
+
+def transfer_response(raw_headers, error, timed_out, timing=None):
+    """
+    :param raw_headers: Response headers of every hop, as written by curl -D
+    :param error: curl error, None if the transfer succeeded
+    :param timed_out:
+    :param timing: CurlTiming, None if unknown
+    :return: CurlResponse without body, for the bookkeeping of a streamed request (metrics, rate limiter, proxy pool)
+    """
+    from CoreLibrary.CurlHeaders import parse_header_hops
+    from CoreLibrary.CurlResponse import CurlResponse
+
+    return CurlResponse(b'', timed_out=timed_out, error=error, header_hops=parse_header_hops(raw_headers), timing=timing)
+
+
+class GzipChunkDecoder:
+    """
+    Decompresses a response chunk by chunk. Whether the response is gzipped is decided from its first two bytes,
+    responses that are not gzipped are passed through as they are.
+    Decompressed output is produced in pieces of at most max_output bytes, however compressible the response is
+    """
+
+    def __init__(self, max_output=65536):
+        self.max_output = max_output
+        self.head = b''
+        self.decompressor = None
+        self.sniffed = False
+
+    def decode(self, chunk):
+        """
+        :param chunk: Raw bytes of the response
+        :return: Generator of decoded bytes
+        """
+        if not self.sniffed:
+            self.head += chunk
+            if len(self.head) < len(GZIP_MAGIC):
+                return
+            chunk, self.head = self.head, b''
+            self.sniffed = True
+            if chunk.startswith(GZIP_MAGIC):
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if self.decompressor is None:
+            yield chunk
+            return
+
+        while chunk:
+            data = self.decompressor.decompress(chunk, self.max_output)
+            if data:
+                yield data
+            chunk = self.decompressor.unconsumed_tail
+
+    def flush(self):
+        """
+        :return: Generator of whatever is left once the response is complete
+        """
+        if not self.sniffed:
+            self.sniffed = True
+            if self.head:
+                yield self.head
+        elif self.decompressor is not None:
+            data = self.decompressor.flush()
+            if data:
+                yield data
+
+
+class SubprocessChunkSource:
+    """
+    Raw response chunks read from the stdout of a running curl process
+    """
+
+    def __init__(self, process, stderr_file, chunk_size, transport=None, header_path=None):
+        """
+        :param process: Running curl process
+        :param stderr_file: File curl writes its stderr to
+        :param chunk_size:
+        :param transport: SubprocessCurlTransport that started curl
+        :param header_path: File curl writes the response headers to (-D). Removed once read
+        """
+        self.process = process
+        self.stderr_file = stderr_file
+        self.chunk_size = chunk_size
+        self.transport = transport
+        self.header_path = header_path
+        self.raw_headers = b''
+        self.error = None
+        self.timed_out = False
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.process.stdout.read1(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            self.process.wait()
+            if self.process.returncode:
+                self.stderr_file.seek(0)
+                # The error is on the last line, after the progress meter. There is none if curl was killed
+                errors = [line for line in self.stderr_file.read().decode(errors='replace').splitlines() if line.startswith('curl:')]
+                self.error = errors[-1] if errors else f"curl exited with {self.process.returncode}"
+                self.timed_out = self.process.returncode == CURL_TIMEOUT_EXIT_CODE
+        finally:
+            # Read to the end, or abandoned: the pipe and the stderr file are released without waiting for close
+            self.close()
+
+    def read_headers(self):
+        """
+        :return: Response headers written by curl so far. The header file is removed on the first call
+        """
+        if self.header_path is not None:
+            header_path, self.header_path = self.header_path, None
+            self.raw_headers = self.transport.read_header_file(header_path)
+        return self.raw_headers
+
+    def response(self):
+        """
+        :return: CurlResponse without body describing the transfer, once it ended.
+        No timing: curl -w would write it in the middle of the streamed response
+        """
+        return transfer_response(self.read_headers(), self.error, self.timed_out)
+
+    def close(self):
+        """
+        Stops curl if it is still running and releases the pipe and the files. Can be called more than once
+        :return:
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.stderr_file.close()
+        self.read_headers()
+
+
+class LibcurlChunkSource:
+    """
+    Raw response chunks produced by a libcurl transfer running in a background thread.
+    The queue between the transfer and the reader is bounded, so a slow reader pauses the download
+    instead of letting the response pile up in memory
+    """
+    end_of_response = object()
+
+    def __init__(self, transport, requester, options, chunk_size, max_queued_chunks=16, close_timeout=5):
+        """
+        :param transport: LibcurlTransport
+        :param requester: CurlRequests sending the request
+        :param options: Request options (see CurlRequests.build_request_options)
+        :param chunk_size:
+        :param max_queued_chunks: Chunks received and not read yet, past which the download pauses
+        :param close_timeout: Seconds close waits for the transfer thread to stop
+        """
+        self.transport = transport
+        self.requester = requester
+        self.options = options
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=max_queued_chunks)
+        self.closed = threading.Event()
+        self.error = None
+        self.timed_out = False
+        self.raw_headers = b''
+        self.timing = None  # Only for transfers that completed
+        self.close_timeout = close_timeout
+        self.thread = threading.Thread(target=self.run_transfer, daemon=True)
+        self.thread.start()
+
+    def write_chunk(self, chunk):
+        """
+        libcurl write callback. Returning 0 aborts the transfer, which is what happens once the stream is closed
+        """
+        while not self.closed.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return None
+            except queue.Full:
+                continue
+        return 0
+
+    def check_closed(self, download_total, downloaded, upload_total, uploaded):
+        """
+        libcurl progress callback, called about once a second even while no data arrives.
+        Returning non zero aborts the transfer, so a stalled transfer stops soon after the stream is closed
+        """
+        return 1 if self.closed.is_set() else 0
+
+    def run_transfer(self):
+        pooled = not self.requester.cookie_file
+        host, handle = self.transport.acquire_handle(self.options['request_url'], pooled)
+        headers = None
+        try:
+            self.transport.setup_handle(handle, self.requester, self.options)
+            headers = self.transport.capture_headers(handle)
+            handle.setopt(pycurl.BUFFERSIZE, min(self.chunk_size, 512 * 1024))
+            handle.setopt(pycurl.WRITEFUNCTION, self.write_chunk)
+            handle.setopt(pycurl.NOPROGRESS, 0)
+            handle.setopt(pycurl.XFERINFOFUNCTION, self.check_closed)
+            handle.perform()
+            self.timing = self.transport.transfer_timing(handle)
+        except pycurl.error as e:
+            if not self.closed.is_set():
+                code, message = e.args
+                self.error = f"curl: ({code}) {message}"
+                self.timed_out = code == pycurl.E_OPERATION_TIMEDOUT
+        finally:
+            if headers is not None:
+                self.raw_headers = headers.getvalue()
+            self.transport.release_handle(host, handle, pooled)
+            self.put_end_of_response()
+
+    def put_end_of_response(self):
+        while not self.closed.is_set():
+            try:
+                self.chunks.put(self.end_of_response, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is self.end_of_response:
+                return
+            yield chunk
+
+    def response(self):
+        """
+        :return: CurlResponse without body describing the transfer, once it ended
+        """
+        return transfer_response(self.raw_headers, self.error, self.timed_out, self.timing)
+
+    def close(self):
+        self.closed.set()
+        self.thread.join(self.close_timeout)
+        if self.thread.is_alive():
+            logger.warning("Transfer of %s still running %s seconds after the stream was closed", self.options['request_url'], self.close_timeout)
+
+
+class CurlResponseStream:
+    """
+    Response of CurlRequests.stream_curl_request. Iterating over it gives the (decompressed) response chunks
+    as curl receives them, so responses of any size can be processed or saved with bounded memory.
+    Also usable as a read only binary file object. If the transfer failed, the curl error is set in "error" once
+    the whole response has been read
+    """
+
+    def __init__(self, source, chunk_size=65536, on_finish=None):
+        """
+        :param source: Chunk source of the transport (SubprocessChunkSource or LibcurlChunkSource)
+        :param chunk_size: Maximum size of the chunks
+        :param on_finish: Called once with a CurlResponse without body describing the transfer (status, headers,
+        error ...), when the response has been read to the end or the stream is closed, whichever comes first
+        """
+        self.source = source
+        self.decoder = GzipChunkDecoder(max_output=chunk_size)
+        self.chunk_iterator = None
+        self.buffer = b''
+        self.closed = False
+        self.on_finish = on_finish
+        self.finished = False
+
+    @property
+    def error(self):
+        return self.source.error
+
+    def __iter__(self):
+        if self.buffer:
+            buffer, self.buffer = self.buffer, b''
+            yield buffer
+        for chunk in self.decoded_chunks():
+            yield chunk
+
+    def decoded_chunks(self):
+        if self.chunk_iterator is None:
+            self.chunk_iterator = self.generate_decoded_chunks()
+        return self.chunk_iterator
+
+    def generate_decoded_chunks(self):
+        for chunk in self.source:
+            for data in self.decoder.decode(chunk):
+                yield data
+        self.finish()
+        for data in self.decoder.flush():
+            yield data
+
+    def finish(self):
+        """
+        Hands the outcome of the transfer to on_finish, the first time it is called
+        :return:
+        """
+        if not self.finished:
+            self.finished = True
+            if self.on_finish is not None:
+                self.on_finish(self.source.response())
+
+    def read(self, size=-1):
+        """
+        :param size: Maximum number of bytes to read. Reads to the end of the response if negative
+        :return: bytes, empty once the response is exhausted
+        """
+        if size is None or size < 0:
+            return b''.join(self)
+
+        chunks = self.decoded_chunks()
+        while len(self.buffer) < size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def iter_text(self, encoding='utf-8'):
+        """
+        Decodes the chunks into text, handling characters split between two chunks
+        :param encoding:
+        :return: Generator of strings
+        """
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        for chunk in self:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def save(self, file_path):
+        """
+        Writes the rest of the response to a file, one chunk at a time
+        :param file_path:
+        :return: Number of bytes written
+        """
+        written = 0
+        with open(file_path, 'wb') as output_file:
+            for chunk in self:
+                output_file.write(chunk)
+                written += len(chunk)
+        return written
+
+    def close(self):
+        """
+        Stops the transfer if it is still running and releases its resources
+        :return:
+        """
+        if not self.closed:
+            self.closed = True
+            self.source.close()
+            self.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
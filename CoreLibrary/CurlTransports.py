@@ -0,0 +1,492 @@
+import logging
+import os
+import subprocess
+import tempfile
+from io import BytesIO
+from urllib.parse import quote, urlsplit
+
+from CoreLibrary.CurlMetrics import TIMING_VARIABLES, CurlTiming
+
+# Imported on first use by load_pycurl. pycurl and the libcurl it loads take longer to import
+# than the rest of the package, and short lived scripts using the subprocess transport never need them
+pycurl = None
+pycurl_import_attempted = False
+
+logger = logging.getLogger(__name__)
+
+
+class CurlTransport:
+    """
+    Base class for the backends used by CurlRequests to actually send a request.
+    A transport receives the CurlRequests instance (for its headers and cookies) and the request options,
+    and returns the raw (stdout, stderr) bytes the curl binary would have produced for the same request,
+    along with the response headers, captured separately from the body (what curl -D writes),
+    and the timing curl reported for the transfer
+    """
+    name = 'base'
+
+    def perform(self, requester, options):
+        """
+        :param requester: CurlRequests instance sending the request
+        :param options: dict of the send_curl_request options (request_url, data, form_data, proxy ...)
+        :return: tuple of (stdout, stderr, headers, timing). timing is a CurlTiming, or None if curl did not report one
+        """
+        raise NotImplementedError
+
+    def open_stream(self, requester, options, chunk_size):
+        """
+        Starts the request without reading the whole response
+        :param requester:
+        :param options:
+        :param chunk_size: Maximum size of the chunks read from the response
+        :return: Chunk source iterating over the raw response chunks (see CoreLibrary.CurlStream)
+        """
+        raise NotImplementedError
+
+    async def perform_async(self, requester, options):
+        """
+        Asyncio version of perform. Transports that cannot wait on the event loop run perform in the default executor
+        :param requester:
+        :param options:
+        :return: tuple of (stdout, stderr, headers, timing). timing is a CurlTiming, or None if curl did not report one
+        """
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self.perform, requester, options)
+
+
+class SubprocessCurlTransport(CurlTransport):
+    """
+    Original transport. Forks the curl binary for every request.
+    Always available, so it is used as the fallback when libcurl cannot be loaded in process
+    """
+    name = 'subprocess'
+    # Written by curl after the body (-w), so the timing can be split from the output
+    write_out_marker = b'#curl-timing#'
+
+    def build_args(self, requester, options):
+        """
+        :param requester:
+        :param options:
+        :return: curl command as a list of arguments
+        """
+        args = requester.build_curl_args(options['request_url'], options['data'], options['add_compression'], options['proxy'], options['specified_method'], options['form_data'], options['page_redirects'], options['include'], options['url_encode_data'], options['download_file'], options['extra_headers'])
+        logger.debug("Sending command as args: %s", args)
+        return args
+
+    def dump_headers_to_file(self, args):
+        """
+        Makes curl write the response headers to a temporary file (-D), so they come back separately from the body
+        :param args: curl command, modified in place
+        :return: Path of the header file
+        """
+        header_fd, header_path = tempfile.mkstemp(prefix='curl_headers_')
+        os.close(header_fd)
+        args[1:1] = ['-D', header_path]
+        return header_path
+
+    def add_write_out(self, args):
+        """
+        Makes curl write its timing variables after the body
+        :param args: curl command, modified in place
+        :return:
+        """
+        variables = ' '.join(f"%{{{variable}}}" for variable in TIMING_VARIABLES)
+        args[1:1] = ['-w', f"{self.write_out_marker.decode()} {variables}"]
+
+    def split_write_out(self, stdout):
+        """
+        :param stdout: curl stdout, ending with what add_write_out asked for
+        :return: tuple of (stdout without the timing, CurlTiming or None)
+        """
+        body, marker, write_out = stdout.rpartition(self.write_out_marker)
+        if not marker:
+            return stdout, None
+        return body, CurlTiming.from_write_out(write_out.decode(errors='replace'))
+
+    def read_header_file(self, header_path):
+        """
+        :param header_path: Path returned by dump_headers_to_file. The file is removed
+        :return: headers bytes
+        """
+        try:
+            with open(header_path, 'rb') as header_file:
+                return header_file.read()
+        finally:
+            os.unlink(header_path)
+
+    def perform(self, requester, options):
+        args = self.build_args(requester, options)
+        self.add_write_out(args)
+        header_path = self.dump_headers_to_file(args)
+
+        try:
+            if options['download_file']:
+                # No timeout enforced for downloads
+                response = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=options['shell_needed'])
+            else:
+                # For getting simple html or json response, a default timeout of 8 seconds is enforced
+                response = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=options['timeout'], shell=options['shell_needed'])
+        finally:
+            headers = self.read_header_file(header_path)
+
+        stdout, timing = self.split_write_out(response.stdout)
+        return stdout, response.stderr, headers, timing
+
+    async def perform_async(self, requester, options):
+        """
+        Runs curl with asyncio.create_subprocess_exec, so the event loop is not blocked while waiting for it.
+        The command is never run through a shell here, shell_needed is ignored
+        """
+        import asyncio
+        args = self.build_args(requester, options)
+        self.add_write_out(args)
+        header_path = self.dump_headers_to_file(args)
+
+        # Same as the blocking version: no timeout enforced for downloads
+        timeout = None if options['download_file'] else options['timeout']
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise subprocess.TimeoutExpired(args, timeout)
+            except asyncio.CancelledError:
+                # eg: the slower attempt of a hedged request
+                process.kill()
+                await process.wait()
+                raise
+        finally:
+            headers = self.read_header_file(header_path)
+
+        stdout, timing = self.split_write_out(stdout)
+        return stdout, stderr, headers, timing
+
+    def open_stream(self, requester, options, chunk_size):
+        """
+        Starts curl without waiting for it, so its output can be read as it is produced.
+        stderr goes to a temporary file, so curl never blocks on a full stderr pipe
+        :return: SubprocessChunkSource
+        """
+        from CoreLibrary.CurlStream import SubprocessChunkSource
+
+        args = self.build_args(requester, options)
+        # Without it curl buffers what it writes to the pipe, and the chunks come late
+        args[1:1] = ['--no-buffer']
+        if options['timeout']:
+            args[1:1] = ['--max-time', str(options['timeout'])]
+        header_path = self.dump_headers_to_file(args)
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_file)
+        return SubprocessChunkSource(process, stderr_file, chunk_size, transport=self, header_path=header_path)
+
+
+class LibcurlTransport(CurlTransport):
+    """
+    Drives libcurl in process through pycurl. Same inputs and same output as the subprocess transport,
+    without paying a fork/exec for every request
+    """
+    name = 'libcurl'
+
+    def __init__(self, session_pool=None):
+        """
+        :param session_pool: CurlSessionPool to take handles from, so connections are kept alive between requests.
+        Without it, every request uses a new handle (and a new connection)
+        """
+        if load_pycurl() is None:
+            raise RuntimeError("pycurl is not installed. Use SubprocessCurlTransport instead")
+        self.user_agent = f"curl/{pycurl.version_info()[1]}"
+        self.session_pool = session_pool
+
+    def prepare_handle(self, handle):
+        """
+        Sets the defaults the curl binary uses on a curl easy handle
+        :param handle: pycurl.Curl
+        :return: pycurl.Curl
+        """
+        handle.setopt(pycurl.USERAGENT, self.user_agent)
+        handle.setopt(pycurl.NOSIGNAL, 1)
+        return handle
+
+    def header_lines(self, requester, extra_headers):
+        """
+        Header lines exactly as they would be passed with -H to the curl binary
+        :param requester:
+        :param extra_headers: dict of per request headers
+        :return: list of "name: value" strings
+        """
+        if requester.curl_headers is None:
+            requester.build_headers()
+        if requester.curl_cookie_header is None:
+            requester.build_cookie_header()
+
+        # The compiled arguments alternate "-H" and the header line
+        lines = list(requester.curl_headers[1::2])
+        if extra_headers:
+            lines.extend(f"{key}: {value}" for key, value in extra_headers.items())
+        lines.append(requester.curl_cookie_header[1])
+        return lines
+
+    def form_body(self, form_data, url_encode_data):
+        """
+        Joins the form fields into the single body curl sends for them
+        :param form_data: A single "name=value" field, or a list of them
+        :param url_encode_data: The fields are sent with --data-urlencode instead of -d
+        :return: String body
+        """
+        fields = []
+        for field in form_data_fields(form_data):
+            if url_encode_data:
+                name, sep, content = field.partition('=')
+                field = f"{name}={quote(content, safe='')}" if sep else quote(field, safe='')
+            fields.append(field)
+
+        return '&'.join(fields)
+
+    def download_file_name(self, request_url):
+        """
+        Same file name curl uses for the -O option: the last segment of the url path
+        :param request_url:
+        :return:
+        """
+        file_name = os.path.basename(urlsplit(request_url).path)
+        return file_name or 'curl_response'
+
+    def acquire_handle(self, request_url, pooled=True):
+        """
+        Takes a handle from the session pool if there is one, otherwise creates a new handle
+        :param request_url:
+        :param pooled: False to always use a new handle
+        :return: tuple of (host, handle)
+        """
+        host = urlsplit(request_url).netloc
+        if self.session_pool is None or not pooled:
+            return host, self.prepare_handle(pycurl.Curl())
+        return host, self.prepare_handle(self.session_pool.acquire(host))
+
+    def release_handle(self, host, handle, pooled=True):
+        if self.session_pool is None or not pooled:
+            handle.close()
+        else:
+            self.session_pool.release(host, handle)
+
+    def perform(self, requester, options):
+        # The cookie engine of a handle keeps its cookies through a reset, so handles that used a cookie file are not pooled
+        pooled = not requester.cookie_file
+        host, handle = self.acquire_handle(options['request_url'], pooled)
+        output = None
+        try:
+            self.setup_handle(handle, requester, options)
+            headers = self.capture_headers(handle)
+            output = self.open_output(handle, options)
+            stderr = self.run_transfer(handle)
+            return self.output_bytes(output), stderr, headers.getvalue(), self.transfer_timing(handle)
+        finally:
+            if output is not None:
+                output.close()
+            self.release_handle(host, handle, pooled)
+
+    async def perform_async(self, requester, options):
+        """
+        Runs the transfer on the curl multi handle of the running event loop (see CoreLibrary.AsyncCurl)
+        """
+        from CoreLibrary.AsyncCurl import get_async_multi
+
+        pooled = not requester.cookie_file
+        host, handle = self.acquire_handle(options['request_url'], pooled)
+        output = None
+        try:
+            self.setup_handle(handle, requester, options)
+            headers = self.capture_headers(handle)
+            output = self.open_output(handle, options)
+            try:
+                await get_async_multi().perform(handle)
+                stderr = b''
+            except pycurl.error as e:
+                stderr = self.transfer_error(e)
+            return self.output_bytes(output), stderr, headers.getvalue(), self.transfer_timing(handle)
+        finally:
+            if output is not None:
+                output.close()
+            self.release_handle(host, handle, pooled)
+
+    def open_stream(self, requester, options, chunk_size):
+        """
+        Runs the transfer in a background thread, handing the response chunks over through a bounded queue
+        :return: LibcurlChunkSource
+        """
+        from CoreLibrary.CurlStream import LibcurlChunkSource
+        return LibcurlChunkSource(self, requester, options, chunk_size)
+
+    def setup_handle(self, handle, requester, options):
+        """
+        Sets all the request options on the easy handle
+        :param handle: pycurl.Curl
+        :param requester:
+        :param options:
+        :return:
+        """
+        request_url = options['request_url']
+        handle.setopt(pycurl.URL, request_url)
+        handle.setopt(pycurl.HTTPHEADER, self.header_lines(requester, options['extra_headers']))
+        handle.setopt(pycurl.FOLLOWLOCATION, 1 if options['page_redirects'] is True else 0)
+        handle.setopt(pycurl.HEADER, 1 if options['include'] else 0)
+
+        if requester.cookie_file:
+            # Written when the handle is closed, like curl -c
+            handle.setopt(pycurl.COOKIEFILE, requester.cookie_file)
+            handle.setopt(pycurl.COOKIEJAR, requester.cookie_file)
+
+        if options['proxy']:
+            handle.setopt(pycurl.PROXY, options['proxy'])
+
+        if options['add_compression']:
+            handle.setopt(pycurl.ACCEPT_ENCODING, '')
+
+        if options['data']:
+            handle.setopt(pycurl.POSTFIELDS, options['data'])
+        elif options['form_data']:
+            handle.setopt(pycurl.POSTFIELDS, self.form_body(options['form_data'], options['url_encode_data']))
+
+        if options['specified_method']:
+            logger.debug("Applying specified method: %s", options['specified_method'])
+            handle.setopt(pycurl.CUSTOMREQUEST, options['specified_method'])
+
+        if options['timeout'] and not options['download_file']:
+            # Same default timeout as the subprocess transport. Downloads have no timeout
+            handle.setopt(pycurl.TIMEOUT_MS, int(options['timeout'] * 1000))
+
+        logger.debug("Sending request in process with libcurl to %s", request_url)
+
+    def capture_headers(self, handle):
+        """
+        Collects the response headers of every hop, separately from the body like curl -D does
+        :param handle:
+        :return: BytesIO the headers are written to
+        """
+        headers = BytesIO()
+        handle.setopt(pycurl.HEADERFUNCTION, headers.write)
+        return headers
+
+    def open_output(self, handle, options):
+        """
+        :param handle:
+        :param options:
+        :return: File object the response is written to. The file named like curl -O does for downloads
+        """
+        if options['download_file']:
+            output = open(self.download_file_name(options['request_url']), 'wb')
+        else:
+            output = BytesIO()
+        handle.setopt(pycurl.WRITEDATA, output)
+        return output
+
+    def output_bytes(self, output):
+        """
+        :param output: File object returned by open_output
+        :return: What the curl binary would have written on stdout. Nothing for downloads, which go to a file
+        """
+        if isinstance(output, BytesIO):
+            return output.getvalue()
+        return b''
+
+    def run_transfer(self, handle):
+        """
+        Performs the transfer
+        :param handle:
+        :return: stderr bytes
+        """
+        try:
+            handle.perform()
+        except pycurl.error as e:
+            return self.transfer_error(e)
+        return b''
+
+    def transfer_timing(self, handle):
+        """
+        :param handle: Handle of a finished transfer
+        :return: CurlTiming, with the same values curl -w would have written
+        """
+        return CurlTiming(
+            time_namelookup=handle.getinfo(pycurl.NAMELOOKUP_TIME),
+            time_connect=handle.getinfo(pycurl.CONNECT_TIME),
+            time_appconnect=handle.getinfo(pycurl.APPCONNECT_TIME),
+            time_pretransfer=handle.getinfo(pycurl.PRETRANSFER_TIME),
+            time_starttransfer=handle.getinfo(pycurl.STARTTRANSFER_TIME),
+            time_total=handle.getinfo(pycurl.TOTAL_TIME),
+            size_download=int(handle.getinfo(pycurl.SIZE_DOWNLOAD)),
+        )
+
+    def transfer_error(self, error):
+        """
+        Errors are returned the way the curl binary reports them on stderr,
+        except for timeouts, which are raised like the subprocess transport does
+        :param error: pycurl.error
+        :return: stderr bytes
+        """
+        code, message = error.args
+        if code == pycurl.E_OPERATION_TIMEDOUT:
+            raise TimeoutError(message)
+        return f"curl: ({code}) {message}\n".encode()
+
+
+def form_data_fields(form_data):
+    """
+    :param form_data: A single "name=value" field, or a list of them
+    :return: List of fields
+    """
+    if isinstance(form_data, (list, tuple)):
+        return list(form_data)
+    return [form_data]
+
+
+def load_pycurl():
+    """
+    Imports pycurl the first time it is needed
+    :return: pycurl module, or None if it is not installed
+    """
+    global pycurl, pycurl_import_attempted
+    if not pycurl_import_attempted:
+        try:
+            import pycurl as pycurl_module
+            pycurl = pycurl_module
+        except ImportError:
+            logger.debug("pycurl is not installed, requests are sent with the curl binary")
+        pycurl_import_attempted = True
+    return pycurl
+
+
+def libcurl_available():
+    """
+    :return: True if the in process libcurl transport can be used
+    """
+    return load_pycurl() is not None
+
+
+default_transport = None
+
+
+def get_default_transport():
+    """
+    Transport used by CurlRequests when none is passed in.
+    Uses libcurl in process when pycurl is installed, otherwise falls back to forking the curl binary
+    :return: CurlTransport
+    """
+    global default_transport
+    if default_transport is None:
+        if libcurl_available():
+            default_transport = LibcurlTransport()
+        else:
+            default_transport = SubprocessCurlTransport()
+    return default_transport
+
+
+def set_default_transport(transport):
+    """
+    Overrides the transport used by CurlRequests instances created without one
+    :param transport: CurlTransport instance, or None to go back to automatic selection
+    :return:
+    """
+    global default_transport
+    default_transport = transport
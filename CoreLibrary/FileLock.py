@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import os
+import re
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SAFE_LOCK_NAME = re.compile(r'[\w.-]{1,100}', re.ASCII)
+
+
+class FileLock:
+    """
+    Exclusive lock held on a file, shared by all the processes of the machine (and all the threads of a process,
+    since each acquire opens the file again). The lock is released by the OS if its holder dies.
+    Where fcntl is not available (Windows), the lock is a no-op and only the in-process locking of the callers applies
+    """
+
+    def __init__(self, path, timeout=60, poll_interval=0.05):
+        """
+        :param path: Lock file. Created if it does not exist, never removed
+        :param timeout: Seconds to wait for the lock. None to wait forever
+        :param poll_interval: Seconds between two attempts to take the lock
+        """
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.lock_file = None
+
+    def acquire(self):
+        """
+        :return: True if the lock was taken, False if the timeout expired first
+        """
+        if fcntl is None:
+            return True
+
+        lock_file = open(self.path, 'a')
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.lock_file = lock_file
+                return True
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    lock_file.close()
+                    return False
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    @property
+    def locked(self):
+        return self.lock_file is not None
+
+    def __enter__(self):
+        if not self.acquire():
+            # Better to do the work twice than to never do it because a holder is stuck
+            logger.warning("Timed out waiting for lock %s after %s seconds. Continuing without it", self.path, self.timeout)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def lock_file_path(base_path, name):
+    """
+    :param base_path: File the lock is about, eg: the cookie jar database
+    :param name: eg: the carrier. Names that are not safe in a file name (eg: with a proxy url) are hashed
+    :return: Path of the lock file, next to base_path
+    """
+    if not SAFE_LOCK_NAME.fullmatch(name):
+        name = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    directory = os.path.dirname(os.path.abspath(base_path))
+    return os.path.join(directory, f".{os.path.basename(base_path)}.{name}.lock")
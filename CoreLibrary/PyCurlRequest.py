@@ -1,7 +1,40 @@
-import shlex
+import logging
 import subprocess
-import json
-import gzip
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit
+from CoreLibrary.CurlTransports import get_default_transport, form_data_fields
+from CoreLibrary.CurlResponse import CurlResponse
+from CoreLibrary.CurlMetrics import get_metrics_registry
+from CoreLibrary.CurlProxyPool import format_proxy_url
+from CoreLibrary.CurlRetry import is_usable_response
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=512)
+def compile_header_args(header_items):
+    """
+    Compiles the curl arguments of a headers profile once. Carrier requests reuse the same few profiles,
+    so the arguments are only formatted the first time a profile is seen
+    :param header_items: tuple of (name, value) pairs
+    :return: Immutable tuple of curl arguments
+    """
+    args = []
+    for key, value in header_items:
+        args.extend(('-H', f'{key}: {value}'))
+    return tuple(args)
+
+
+@lru_cache(maxsize=512)
+def compile_cookie_args(cookie_items):
+    """
+    Compiles the cookie header of a set of cookies once
+    :param cookie_items: tuple of (name, value) pairs
+    :return: tuple of (cookie string, immutable tuple of curl arguments)
+    """
+    cookies_as_single_str = '; '.join(f'{key}={value}' for key, value in cookie_items)
+    return cookies_as_single_str, ('-H', f'cookie: {cookies_as_single_str}')
 
 
 class CurlRequests:
@@ -9,16 +42,44 @@ class CurlRequests:
     Alternative to using python requests where curl works but equivalent python request code does not get a result
     """
 
-    def __init__(self, cookies_dict: dict, headers_dict):
+    def __init__(self, cookies_dict: dict, headers_dict, transport=None, session_pool=None, carrier=None, metrics_registry=None, cookie_file=None, proxy_pool=None, proxy_session=None, rate_limiter=None, retry_policy=None, hedge_policy=None):
         """
         :param cookies_dict:
         :param headers_dict: Use Classes from "CurlSiteTemplates" to get default curl_headers for certain sites. If you know the curl_headers, you can just supply them as a dictionary
         If you dont have a dict of either parameter, you can pass and empty dict into the constructor and set the curl "curl_headers" and "curl_cookie_header" manually
+        :param transport: CurlTransport used to send the requests (see CoreLibrary.CurlTransports).
+        Defaults to libcurl in process when pycurl is installed, otherwise the curl binary is forked for each request
+        :param session_pool: CurlSessionPool keeping connections alive between requests. Ignored if a transport is given
+        :param carrier: Name the requests are recorded under in the metrics, eg: "ups_curl"
+        :param metrics_registry: MetricsRegistry the timing of every request is recorded in (see CoreLibrary.CurlMetrics).
+        Defaults to the process wide registry
+        :param cookie_file: Netscape cookie file curl reads cookies from (-b) and writes the received cookies to (-c),
+        in addition to the cookies dict. See CookieJar.cookie_file in CoreLibrary.CurlCookieJar
+        :param proxy_pool: ProxyPool (see CoreLibrary.CurlProxyPool) the proxy of each request is chosen from,
+        unless the request is given a proxy. The outcome of each request is recorded in the pool
+        :param proxy_session: Sticky session key: the requests go through the proxy the pool pinned to this key
+        :param rate_limiter: RateLimiter (see CoreLibrary.CurlRateLimiter) each request waits for its turn in,
+        and whose rate for the host adapts to the response. No limit if None
+        :param retry_policy: RetryPolicy (see CoreLibrary.CurlRetry) of the failed requests. Each request is sent once if None
+        :param hedge_policy: HedgePolicy (see CoreLibrary.CurlRetry): slow requests are sent a second time and the first
+        good response is used. Only for requests that are safe to send twice
         """
         self.cookies_dict = cookies_dict
         self.headers_dict = headers_dict
+        if transport is None and session_pool is not None:
+            transport = session_pool.transport
+        self.session_pool = session_pool
+        self.transport = transport or get_default_transport()
+        self.carrier = carrier
+        self.metrics_registry = metrics_registry or get_metrics_registry()
+        self.cookie_file = cookie_file
+        self.proxy_pool = proxy_pool
+        self.proxy_session = proxy_session
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.hedge_policy = hedge_policy
         self.cookies_as_single_str = ""
-        self.curl_headers = ""
+        self.curl_headers = None
         self.curl_cookie_header = None
 
         self.set_headers_dict_if_empty()
@@ -31,10 +92,10 @@ class CurlRequests:
         :return:
         """
         if not self.headers_dict:
-            print(f"INFO: Caught empty headers dict passed into instance. Special case")
+            logger.debug("Caught empty headers dict passed into instance. Special case")
             self.headers_dict = self.regular_browser_headers_dict()
         else:
-            print(f"INFO: Headers dict was passed into instance already.")
+            logger.debug("Headers dict was passed into instance already.")
 
         return
 
@@ -63,131 +124,151 @@ class CurlRequests:
 
     def build_headers(self):
         """
-        Formats the header dictionary into the format used by curl requests
-        :return:String representing formatted curl_headers for curl command
+        Formats the header dictionary into the arguments used by curl requests.
+        The arguments are compiled once per headers profile and shared by every instance using the same headers
+        :return: Tuple of curl arguments, eg: ("-H", "Accept: */*", "-H", "Origin: https://www.ups.com")
         """
-        for key, value in self.headers_dict.items():
-            if not self.curl_headers:
-                self.curl_headers = f'-H "{key}: {value}" '
-            else:
-                self.curl_headers = f'{self.curl_headers}  -H "{key}: {value}" '
-
+        self.curl_headers = compile_header_args(tuple(self.headers_dict.items()))
         return self.curl_headers
 
     def build_cookie_header(self):
         """
-        Formats the cookie dictionary into the format used by the curl request
-        :return: String representing formatted cookies_as_single_str for curl command
+        Formats the cookie dictionary into the cookie header arguments used by the curl request
+        :return: Tuple of curl arguments, eg: ("-H", "cookie: name=value; name2=value2")
         """
-        for key, value in self.cookies_dict.items():
-            if not self.cookies_as_single_str:
-                self.cookies_as_single_str = f'{key}={value}'
-            else:
-                self.cookies_as_single_str = f'{self.cookies_as_single_str}; {key}={value}'
-
-        self.curl_cookie_header = f' -H "cookie: {self.cookies_as_single_str}" '
+        self.cookies_as_single_str, self.curl_cookie_header = compile_cookie_args(tuple(self.cookies_dict.items()))
         return self.curl_cookie_header
 
     def build_body_data(self, data):
         """
-        Formats the body data into the format used by curl requests.
-        Used internally by the build_full_curl_cmd method
+        Formats the body data into the arguments used by curl requests.
+        The data is passed as is, quotes in it need no escaping
         :param data:
-        :return: String representing formatted body/data portion of curl command
+        :return: List of curl arguments for the body/data portion of the curl command
         """
-        return f" --data-binary '{data}' "
+        return ['--data-binary', data]
 
     def build_form_data(self, form_data, url_encode_data):
         """
-        Formats form data into the proper format for curl.
-        This involes appending the proper tag
-        :param form_data:
-        :return:
+        Formats form data into the arguments used by curl.
+        This involes prepending the proper tag to every field
+        :param form_data: A single "name=value" field, or a list of them
+        :param url_encode_data: Send the fields with --data-urlencode instead of -d
+        :return: List of curl arguments
         """
-        if url_encode_data:
-            return f"--data-urlencode {form_data}"
-        return f" -d {form_data}"
+        option = '--data-urlencode' if url_encode_data else '-d'
+        args = []
+        for field in form_data_fields(form_data):
+            args.extend((option, field))
+        return args
 
-    def build_full_curl_cmd(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file):
+    def build_extra_headers(self, extra_headers):
         """
-        Builds the full curl request. Used by the send_curl_request method. (Not externally)
-        :param proxy:
-        :param include:
-        :param page_redirects:
-        :param specified_method:
-        :param add_compression:
-        :param request_url:
-        :param data:
-        :param form_data: curl form data
-        :return: String representin curl command
+        Formats per request headers, sent in addition to the ones of the headers dict
+        :param extra_headers: dict of headers
+        :return: List of curl arguments
+        """
+        args = []
+        if extra_headers:
+            for key, value in extra_headers.items():
+                args.extend(('-H', f'{key}: {value}'))
+        return args
+
+    def build_curl_args(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, extra_headers=None):
+        """
+        Builds the full curl request as a list of arguments, ready to be run without going through a shell.
+        Only the per request parts are built here, the headers and cookie arguments are reused as compiled
+        :return: List of curl arguments
         """
         "proxy: Should be specified as follows in example: http://38.109.22.251:21270"
+        args = ['curl']
 
         if download_file:
-            download_file_option = " -O "
-        else:
-            download_file_option = ""
+            args.append('-O')
 
         # Add location header for pages that redirect
         if page_redirects is True:
-            location_option = " --location "
-        else:
-            location_option = ""
+            args.append('--location')
 
         # Add option to include connection information
         if include:
-            include_option = " -i "
-        else:
-            include_option = ""
+            args.append('-i')
 
         # Add proxy information to curl request
         if proxy:
-            proxy_option = f" --proxy {proxy} "
-        else:
-            proxy_option = ""
+            args.extend(('--proxy', proxy))
+
+        args.append(request_url)
+
+        # Add specified method if one is specified
+        if specified_method:
+            logger.debug("Applying specified method: %s", specified_method)
+            args.extend(('-X', specified_method))
 
         # Build curl headers
-        if not self.curl_headers:
+        if self.curl_headers is None:
             self.build_headers()
+        args.extend(self.curl_headers)
+        args.extend(self.build_extra_headers(extra_headers))
 
         # Build cookie header
-        if not self.curl_cookie_header:
+        if self.curl_cookie_header is None:
             self.build_cookie_header()
-
-        curl_command_prefix = f"curl{download_file_option}{location_option}{include_option}{proxy_option}"
-
-        # Add specified method if one is specified
-        if specified_method:
-            print(f"INFO: Applying specified method to prefix: {specified_method}")
-            specified_method_flag = f"-X '{specified_method}'"
-        else:
-            specified_method_flag = ""
+        args.extend(self.curl_cookie_header)
+        if self.cookie_file:
+            args.extend(('-b', self.cookie_file, '-c', self.cookie_file))
 
         # If data needs to be sent, with request, add it to the request
-        request_url = f'\"{request_url}\"'
         if data:
-            body = self.build_body_data(data)
-            full_cmd = f'{curl_command_prefix} {request_url} {specified_method_flag} {self.curl_headers} {self.curl_cookie_header} {body}'
+            args.extend(self.build_body_data(data))
         elif form_data:
-            form_data = self.build_form_data(form_data, url_encode_data)
-            full_cmd = f'{curl_command_prefix} {request_url} {specified_method_flag} {self.curl_headers} {self.curl_cookie_header} {form_data}'
-        else:
-            full_cmd = f'{curl_command_prefix} {request_url} {specified_method_flag} {self.curl_headers} {self.curl_cookie_header}'
+            args.extend(self.build_form_data(form_data, url_encode_data))
 
         # Add compression if need. Never really used
         if add_compression:
-            full_cmd = full_cmd + " --compressed"
+            args.append('--compressed')
+
+        return args
+
+    def build_full_curl_cmd(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, extra_headers=None):
+        """
+        Builds the full curl request as a shell command string. Only used for display, eg to copy the request to a terminal.
+        Requests themselves are sent with the argument list of build_curl_args
+        :return: String representing curl command
+        """
+        import shlex
 
-        print(f"INFO: Full command formed:\n\t{full_cmd}\n\nINFO: Ready to send")
+        args = self.build_curl_args(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, extra_headers)
+        full_cmd = shlex.join(args)
+        logger.debug("Full command formed: %s", full_cmd)
         return full_cmd
 
-    def send_curl_request(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, verbose=True, url_encode_data=False, download_file=False, timeout=8, shell_needed=False):
+    def build_request_options(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers=None):
+        """
+        Groups the arguments of send_curl_request into the options dict passed to the transport
+        :return: dict of request options
+        """
+        return {
+            'request_url': request_url,
+            'data': data,
+            'add_compression': add_compression,
+            'proxy': proxy,
+            'specified_method': specified_method,
+            'form_data': form_data,
+            'page_redirects': page_redirects,
+            'include': include,
+            'url_encode_data': url_encode_data,
+            'download_file': download_file,
+            'timeout': timeout,
+            'shell_needed': shell_needed,
+            'extra_headers': extra_headers
+        }
 
+    def send_request(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, url_encode_data=False, download_file=False, timeout=8, shell_needed=False, extra_headers=None):
         """
         Will build and send a curl request to the specified request url using the curl_headers and dict supplied
         in the init method and optional data supplied in this method
-        :param verbose:
-        :param form_data:
+        :param form_data: A single "name=value" field, or a list of fields, each sent with its own -d
         :param page_redirects:
         :param include:
         :param request_url:
@@ -195,67 +276,331 @@ class CurlRequests:
         :param add_compression:Always set to False. Output can be received without compression even when running curl from terminal requires compression to receive output (eg html document)
         :param proxy: Should be specified as follows in example: http://38.109.22.251:21270
         :param specified_method: If no method specified, will send a default curl request
-        :return:
+        :param extra_headers: dict of headers for this request only, sent after the headers dict of the instance
+        :return: CurlResponse. The body is only decompressed, decoded or parsed when asked for.
+        With a retry policy, the response of the last attempt
         """
-        full_cmd = self.build_full_curl_cmd(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file)
-        args = shlex.split(full_cmd)
-        print(f"INFO: Sending command as args:\n\t{args}\n\n")
-        response = {}
-        try:
-            if download_file:
-                # No timeout enforced for downloads
-                response = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell_needed)
-            else:
-                # For getting simple html or json response, a default timeout of 8 seconds is enforced
-                response = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, shell=shell_needed)
-
-            stderr = response.stderr
-            stdout = response.stdout
-
-            if stdout and stderr:
-                # If both stdout and stderr exist, there is a valid response/ output data we need to see.
-                # Stderr in this case will just be diagnostics. So will only grab stdout
-                response = stdout
-            elif stderr:
-                response = stderr
-            elif stdout:
-                response = stdout
+        attempt = 1
+        while True:
+            if self.hedge_policy is not None and not download_file:
+                response = self.send_hedged(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
             else:
-                response = b''
+                response = self.send_attempt(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+            if self.retry_policy is None or not self.retry_policy.should_retry(response, attempt):
+                return response
+            delay = self.retry_policy.delay(response, attempt)
+            logger.warning("Attempt %s of request to %s failed (%s). Retrying in %.2f seconds", attempt, request_url, describe_failure(response), delay, extra={'request_url': request_url})
+            time.sleep(delay)
+            attempt += 1
+
+    def send_attempt(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers):
+        """
+        Sends the request once. Same arguments as send_request
+        :return: CurlResponse
+        """
+        pool_proxy = self.choose_proxy(proxy)
+        if pool_proxy is not None:
+            proxy = format_proxy_url(pool_proxy)
+        options = self.build_request_options(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(urlsplit(request_url).netloc)
+        start = time.perf_counter()
+        try:
+            stdout, stderr, headers, timing = self.transport.perform(self, options)
+            response = CurlResponse.from_output(stdout, stderr, headers, timing)
 
-            # Try decompressing data
-            try:
-                print(f"INFO: Trying to decompress the data")
-                response = gzip.decompress(response)
-                print(f"INFO: Successfully decompressed data")
-            except Exception as e:
-                print(f"ERROR: Data decompression failed. DETAILS {e}")
+        except (TimeoutError, subprocess.TimeoutExpired) as e:
+            logger.error("Error while sending request to %s: %s", request_url, e, extra={'request_url': request_url})
+            response = CurlResponse.failed(e, timed_out=True)
 
-            try:
-                print(f"INFO: Trying regular decoding.")
-                response = response.decode()
-                print(f"INFO: Successfully decoded data")
-            except Exception as e:
-                print(f"ERROR: Regular decoding failed ! DETAILS {e}")
+        except Exception as e:
+            logger.error("Error while sending request to %s: %s", request_url, e, extra={'request_url': request_url})
+            response = CurlResponse.failed(e)
+
+        self.record_outcome(request_url, response, pool_proxy, time.perf_counter() - start)
+        return response
+
+    def send_hedged(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers):
+        """
+        Sends the request, and sends it again if it has not answered after the hedge delay of its host.
+        The first usable response is returned, the other attempt is left to finish in the background
+        :return: CurlResponse
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+        host = urlsplit(request_url).netloc
+        delay = self.hedge_policy.delay(self.metrics_registry, host, self.carrier)
+        if delay is None:
+            return self.send_attempt(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+
+        # Build the shared headers once, before the attempts use this instance from two threads
+        if self.curl_headers is None:
+            self.build_headers()
+        if self.curl_cookie_header is None:
+            self.build_cookie_header()
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            first = executor.submit(self.send_attempt, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+            if wait([first], timeout=delay).done:
+                return first.result()
+            logger.debug("No response from %s after %.3f seconds. Sending a hedged request", host, delay)
+            second = executor.submit(self.send_attempt, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+            response = None
+            for future in as_completed([first, second]):
+                response = future.result()
+                if is_usable_response(response):
+                    break
+            return response
+        finally:
+            executor.shutdown(wait=False)
+
+    def choose_proxy(self, proxy):
+        """
+        :param proxy: Proxy given to the request
+        :return: Proxy chosen from the proxy pool, or None if the request has its own proxy or there is no pool
+        """
+        if proxy or self.proxy_pool is None:
+            return None
+        return self.proxy_pool.choose(self.proxy_session)
+
+    def record_metrics(self, request_url, response):
+        """
+        Records the outcome and the timing of a request in the metrics registry
+        :param request_url:
+        :param response: CurlResponse
+        :return:
+        """
+        self.metrics_registry.record(urlsplit(request_url).netloc, self.carrier, response)
+        if response.timing is not None:
+            logger.debug("Timing of request to %s: %s", request_url, response.timing.as_dict())
+
+    def record_outcome(self, request_url, response, pool_proxy=None, elapsed=None):
+        """
+        Records the outcome of a request in the metrics registry, the rate limiter and the proxy pool
+        :param request_url:
+        :param response: CurlResponse
+        :param pool_proxy: Proxy of the pool the request went through, None if it did not use the pool
+        :param elapsed: Seconds the request took
+        :return:
+        """
+        self.record_metrics(request_url, response)
+        if self.rate_limiter is not None:
+            self.rate_limiter.record(urlsplit(request_url).netloc, response)
+        if pool_proxy is not None:
+            self.proxy_pool.record_response(pool_proxy, response, elapsed)
+
+    def send_curl_request(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, verbose=False, url_encode_data=False, download_file=False, timeout=8, shell_needed=False, extra_headers=None):
 
-            # Convert JSON string to actual JSON (If response is JSON string)
+        """
+        Same as send_request, but returns the response as a dict
+        :param verbose: Log the server response at INFO level instead of DEBUG
+        :return: JSON loaded response, or {"response": response} if the server did not return JSON
+        """
+        response = self.send_request(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers).as_dict()
+        # Only formatted if the level is enabled
+        logger.log(logging.INFO if verbose else logging.DEBUG, "Server response: %s", response)
+        return response
+
+    async def send_request_async(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, url_encode_data=False, download_file=False, timeout=8, shell_needed=False, extra_headers=None):
+        """
+        Asyncio version of send_request. Same arguments and same response.
+        The event loop is never blocked: libcurl transfers run on a curl multi handle driven by the loop,
+        and the curl binary is run with asyncio.create_subprocess_exec.
+        Requests to the same host are limited by the per host semaphores of CoreLibrary.AsyncCurl.host_semaphores
+        :return: CurlResponse
+        """
+        import asyncio
+
+        attempt = 1
+        while True:
+            if self.hedge_policy is not None and not download_file:
+                response = await self.send_hedged_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+            else:
+                response = await self.send_attempt_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+            if self.retry_policy is None or not self.retry_policy.should_retry(response, attempt):
+                return response
+            delay = self.retry_policy.delay(response, attempt)
+            logger.warning("Attempt %s of request to %s failed (%s). Retrying in %.2f seconds", attempt, request_url, describe_failure(response), delay, extra={'request_url': request_url})
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send_attempt_async(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers):
+        """
+        Asyncio version of send_attempt
+        :return: CurlResponse
+        """
+        from CoreLibrary.AsyncCurl import host_semaphores
+
+        pool_proxy = self.choose_proxy(proxy)
+        if pool_proxy is not None:
+            proxy = format_proxy_url(pool_proxy)
+        options = self.build_request_options(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(urlsplit(request_url).netloc)
+        async with host_semaphores.get(urlsplit(request_url).netloc):
+            start = time.perf_counter()
             try:
-                print(f"INFO: Converting any JSON string response to actual JSON")
-                response = json.loads(response)
-                print(f"INFO: JSON loads applied successfully to response. Returning JSON loaded response.")
+                stdout, stderr, headers, timing = await self.transport.perform_async(self, options)
+                response = CurlResponse.from_output(stdout, stderr, headers, timing)
+
+            except (TimeoutError, subprocess.TimeoutExpired) as e:
+                logger.error("Error while sending request to %s: %s", request_url, e, extra={'request_url': request_url})
+                response = CurlResponse.failed(e, timed_out=True)
+
             except Exception as e:
-                print(f"ERROR: Could not apply JSON loads to decoded response. Server is not returning JSON formatted response. DETAILS: {e}")
-                # Conversion will fail if not JSON formatted string.
-                # Make our own JSON (dictionary) and put the entire response as the value of the "response" key
-                response = {"response": response}
+                logger.error("Error while sending request to %s: %s", request_url, e, extra={'request_url': request_url})
+                response = CurlResponse.failed(e)
+            elapsed = time.perf_counter() - start
 
-        except TimeoutError as e:
-            print(f"ERROR: Occurred while send request: DETAILS {e}")
-            response['Timeout'] = True
+        self.record_outcome(request_url, response, pool_proxy, elapsed)
+        return response
 
+    async def send_hedged_async(self, request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers):
+        """
+        Asyncio version of send_hedged. The slower attempt is cancelled once a usable response arrives
+        :return: CurlResponse
+        """
+        import asyncio
+
+        host = urlsplit(request_url).netloc
+        delay = self.hedge_policy.delay(self.metrics_registry, host, self.carrier)
+        if delay is None:
+            return await self.send_attempt_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+
+        first = asyncio.ensure_future(self.send_attempt_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        logger.debug("No response from %s after %.3f seconds. Sending a hedged request", host, delay)
+        pending = {first, asyncio.ensure_future(self.send_attempt_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers))}
+        response = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if is_usable_response(response):
+                        return response
+            return response
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def send_curl_request_async(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, verbose=False, url_encode_data=False, download_file=False, timeout=8, shell_needed=False, extra_headers=None):
+        """
+        Asyncio version of send_curl_request. Same arguments and same response
+        :return: JSON loaded response, or {"response": response} if the server did not return JSON
+        """
+        response = await self.send_request_async(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, download_file, timeout, shell_needed, extra_headers)
+        response = response.as_dict()
+        # Only formatted if the level is enabled
+        logger.log(logging.INFO if verbose else logging.DEBUG, "Server response: %s", response)
+        return response
+
+    def stream_curl_request(self, request_url, data=None, add_compression=False, proxy=None, specified_method=None, form_data=None, page_redirects=False, include=False, url_encode_data=False, timeout=None, extra_headers=None, chunk_size=65536):
+        """
+        Sends the request like send_curl_request, but does not hold the response in memory.
+        Returns a stream over the response chunks as curl receives them. Gzipped responses are decompressed chunk by chunk.
+        Use it for large pages and file downloads, eg: curl.stream_curl_request(link).save("file.webm")
+        :param timeout: Maximum time for the whole transfer, in seconds. No limit by default
+        :param chunk_size: Maximum size of the chunks read from curl
+        :return: CurlResponseStream. Close it (or use it in a with block) if the response is not read to the end.
+        The outcome is recorded in the metrics, the rate limiter and the proxy pool once the response is read to the end or the stream is closed
+        """
+        from CoreLibrary.CurlStream import CurlResponseStream
+
+        pool_proxy = self.choose_proxy(proxy)
+        if pool_proxy is not None:
+            proxy = format_proxy_url(pool_proxy)
+        options = self.build_request_options(request_url, data, add_compression, proxy, specified_method, form_data, page_redirects, include, url_encode_data, False, timeout, False, extra_headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(urlsplit(request_url).netloc)
+        start = time.perf_counter()
+        source = self.transport.open_stream(self, options, chunk_size)
+        # Recorded once the response is read to the end or the stream is closed
+        return CurlResponseStream(source, chunk_size, on_finish=lambda response: self.record_outcome(request_url, response, pool_proxy, time.perf_counter() - start))
+
+    def send_many(self, request_specs, max_concurrency=8, stream=False):
+        """
+        Sends several requests concurrently, at most max_concurrency at a time.
+        Each request spec is a dict of send_curl_request arguments (request_url is required). A spec can also contain
+        "headers_dict" and/or "cookies_dict" to use for that request instead of the ones of this instance.
+        A request that fails or times out gets the same result send_curl_request gives for it, without affecting the others.
+        A request that raises (eg: invalid arguments) gets the result of a request that could not be sent
+        :param request_specs: list of dicts, eg: [{"request_url": url, "data": data, "headers_dict": headers}, ...]
+        :param max_concurrency: Maximum number of requests in flight at the same time
+        :param stream: If True, returns a generator of (index in request_specs, response) as each request completes
+        :return: list of responses, in the same order as request_specs
+        """
+        request_specs = list(request_specs)
+        if stream:
+            return self.stream_many(request_specs, max_concurrency)
+
+        results = [None] * len(request_specs)
+        for index, response in self.stream_many(request_specs, max_concurrency):
+            results[index] = response
+        return results
+
+    def stream_many(self, request_specs, max_concurrency):
+        """
+        Generator used by send_many. Yields (index, response) in completion order
+        :param request_specs:
+        :param max_concurrency:
+        :return:
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        # Build the shared headers once, before the worker threads use this instance
+        if self.curl_headers is None:
+            self.build_headers()
+        if self.curl_cookie_header is None:
+            self.build_cookie_header()
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = {executor.submit(self.send_spec, spec): index for index, spec in enumerate(request_specs)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def copy_with(self, **changes):
+        """
+        :param changes: Constructor arguments to change, eg: headers_dict={...}
+        :return: New CurlRequests with the same transport, pools, limiter, policies ... as this one, except the changes
+        """
+        arguments = dict(cookies_dict=self.cookies_dict, headers_dict=self.headers_dict, transport=self.transport, session_pool=self.session_pool, carrier=self.carrier, metrics_registry=self.metrics_registry, cookie_file=self.cookie_file,
+                         proxy_pool=self.proxy_pool, proxy_session=self.proxy_session, rate_limiter=self.rate_limiter, retry_policy=self.retry_policy, hedge_policy=self.hedge_policy)
+        arguments.update(changes)
+        return CurlRequests(**arguments)
+
+    def send_spec(self, spec):
+        """
+        Sends the request described by a single request spec of send_many
+        :param spec:
+        :return: Response, as returned by send_curl_request. A request that raises while it is built or sent
+        (eg: invalid arguments) gets the response of a request that could not be sent
+        """
+        spec = dict(spec)
+        changes = {}
+        for name in ('headers_dict', 'cookies_dict'):
+            value = spec.pop(name, None)
+            if value is not None:
+                changes[name] = value
+        requester = self.copy_with(**changes) if changes else self
+
+        try:
+            return requester.send_curl_request(**spec)
         except Exception as e:
-            print(f"ERROR: Occurred while send request: DETAILS {e}")
+            logger.error("Error while sending request to %s: %s", spec.get('request_url'), e, extra={'request_url': spec.get('request_url')})
+            return CurlResponse(b'', error=str(e) or e.__class__.__name__).as_dict()
 
-        if verbose:
-            print(f"INFO:\t\nServer Response: {response}")
-        return response
+
+def describe_failure(response):
+    """
+    :param response: CurlResponse
+    :return: Short description of why a request failed, for the logs
+    """
+    if response.timed_out:
+        return 'timed out'
+    if response.status_code is not None:
+        return f"status {response.status_code}"
+    return response.error or 'no response'
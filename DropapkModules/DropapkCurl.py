@@ -1,10 +1,9 @@
+import logging
 import re
-import json
 import sys
 from CoreLibrary.PyCurlRequest import CurlRequests
-from PIL import Image
-import requests
-from io import BytesIO
+
+logger = logging.getLogger(__name__)
 
 
 class DropakInfo:
@@ -12,9 +11,24 @@ class DropakInfo:
     Download items from dropapk hosting site without browser and javascript ads
     """
 
-    def __init__(self, cookies_dict, proxy=None):
+    def __init__(self, cookies_dict, proxy=None, proxy_pool=None):
+        """
+        :param cookies_dict:
+        :param proxy: IP:PORT or HOST:PORT
+        :param proxy_pool: ProxyPool (see CoreLibrary.CurlProxyPool) to take the proxy from, when no proxy is given.
+        All the stages of a download go through the same proxy of the pool, the site ties its cookies to the address
+        """
         self.cookies_dict = cookies_dict
         self.proxy = proxy
+        self.proxy_pool = proxy_pool
+        # Sticky session key of this downloader in the pool
+        self.proxy_session = f"dropapk-{id(self)}"
+
+    def curl_requests(self, cookies_dict, headers_dict):
+        """
+        :return: CurlRequests drawing its proxy from the proxy pool, if there is one
+        """
+        return CurlRequests(cookies_dict=cookies_dict, headers_dict=headers_dict, proxy_pool=self.proxy_pool, proxy_session=self.proxy_session)
 
     def format_proxy(self):
         """
@@ -22,7 +36,7 @@ class DropakInfo:
         """
         if self.proxy:
             curl_proxy = f"http://{self.proxy}"  # IP:PORT or HOST:PORT
-            print(f"INFO: Proxy set for request: {curl_proxy}")
+            logger.debug("Proxy set for request: %s", curl_proxy)
             return curl_proxy
         return None
 
@@ -34,7 +48,7 @@ class DropakInfo:
         headers_dict = self.get_stage_one_headers()
         self.set_cookies_dict(download_link)
 
-        requester = CurlRequests(self.cookies_dict, headers_dict=headers_dict)
+        requester = self.curl_requests(self.cookies_dict, headers_dict)
         curl_proxy = self.format_proxy()
 
         if curl_proxy:
@@ -63,14 +77,14 @@ class DropakInfo:
 
             try:
                 value = regex.search(file_info).group(1)
-                print(f"INFO: {name} value found: {value}")
+                logger.debug("%s value found: %s", name, value)
             except:
-                print(f"ERROR: Could not get {name} value")
+                logger.warning("Could not get %s value", name)
                 value = ""
 
             download_info[name] = value
 
-        print(json.dumps(download_info, indent=2))
+        logger.debug("Download info: %s", download_info)
         return download_info
 
     def extract_captcha_info_from_stage_two_response(self, download_link):
@@ -85,9 +99,9 @@ class DropakInfo:
         captcha_link_regex = re.compile(r'(https://dropapk.to/captchas/.+?jpg)')
         try:
             captcha_link = captcha_link_regex.search(stage_two_response).group(1)
-            print(f"INFO: Captcha link found: {captcha_link}")
+            logger.debug("Captcha link found: %s", captcha_link)
         except:
-            print(f"ERROR: Could not get captcha link")
+            logger.warning("Could not get captcha link")
             captcha_link = ""
 
         captcha_info["CaptchaLink"] = captcha_link
@@ -98,14 +112,14 @@ class DropakInfo:
 
             try:
                 value = regex.search(stage_two_response).group(1)
-                print(f"INFO: {name} value found: {value}")
+                logger.debug("%s value found: %s", name, value)
             except:
-                print(f"ERROR: Could not get {name} value")
+                logger.warning("Could not get %s value", name)
                 value = ""
 
             captcha_info[name] = value
 
-        print(json.dumps(captcha_info, indent=2))
+        logger.debug("Captcha info: %s", captcha_info)
         return captcha_info
 
     def get_stage_two_response_captcha_link(self, download_link):
@@ -113,7 +127,7 @@ class DropakInfo:
         file_id = download_info.get("id")
 
         headers_dict = self.get_stage_two_headers(file_id)
-        requester = CurlRequests(self.cookies_dict, headers_dict=headers_dict)
+        requester = self.curl_requests(self.cookies_dict, headers_dict)
         curl_proxy = self.format_proxy()
         form_data = self.get_form_data_for_stage_two(download_info)
 
@@ -130,7 +144,7 @@ class DropakInfo:
         form_data = self.get_form_data_for_stage_three(captcha_info)
         curl_proxy = self.format_proxy()
 
-        requester = CurlRequests(self.cookies_dict, headers_dict=headers_dict)
+        requester = self.curl_requests(self.cookies_dict, headers_dict)
         response = requester.send_curl_request(download_link, proxy=curl_proxy, form_data=form_data)
 
         return response
@@ -144,9 +158,9 @@ class DropakInfo:
 
         try:
             final_link = link_regex.search(response.get("response")).group(1)
-            print(f"\nFINAL LINK: {final_link}")
+            logger.info("Final link: %s", final_link)
         except:
-            print(f"ERROR: :( Could not get final link")
+            logger.error("Could not get final link")
             final_link = ":("
 
         return final_link
@@ -156,14 +170,19 @@ class DropakInfo:
         Gets the final download link and downloads the file at the link
         """
         final_link = self.get_final_download_link(download_link)
-        curl = CurlRequests(cookies_dict=self.cookies_dict, headers_dict={})
+        curl = self.curl_requests(self.cookies_dict, {})
         curl.send_curl_request(request_url=final_link, download_file=True)
         return
 
     def show_image(self, image_link):
         """
-        Helper method. Opens the image link and displays it for the user
+        Helper method. Opens the image link and displays it for the user.
+        PIL and requests are only needed here, so they are imported on first use
         """
+        from io import BytesIO
+        import requests
+        from PIL import Image
+
         response = requests.get(image_link)
         Image.open(BytesIO(response.content)).show()
         return
@@ -180,11 +199,11 @@ class DropakInfo:
         if captcha_link:
             self.show_image(image_link=captcha_link)
             code = input(f"Enter the code from this image: (Image will be displayed) {captcha_link}\n:\t")
-            print(f"CODE ENTERED: {code}")
+            logger.debug("Code entered: %s", code)
             form_data = 'op={}&id={}&rand={}&referer=https%3A%2F%2Fdropapk.to%2F{}&method_free=Free+Download+%3E%3E&method_premium=&adblock_detected=0&code={}'.format(op, id, rand, id, code)
             return form_data
         else:
-            print(f"\nERROR: Download link might have expired!")
+            logger.error("Download link might have expired!")
             sys.exit(1)
 
     def get_form_data_for_stage_two(self, download_info):
@@ -196,7 +215,7 @@ class DropakInfo:
         file_id = download_info.get("id")
         fname = download_info.get("fname")
 
-        form_data = "'op={}&usr_login=&id={}&fname={}&referer=&method_free=Free+Download+%3E%3E'".format(op, file_id, fname)
+        form_data = "op={}&usr_login=&id={}&fname={}&referer=&method_free=Free+Download+%3E%3E".format(op, file_id, fname)
         return form_data
 
     def set_cookies_dict(self, download_link):
@@ -204,34 +223,17 @@ class DropakInfo:
         Does an initial generic curl request to get cookies
         :return:
         """
-        print(f"INFO: Fedex cookie not loaded from on disk. Will obtain new one from the site")
-        curl = CurlRequests(cookies_dict={}, headers_dict={})
+        logger.info("Obtaining cookies from the site")
+        curl = self.curl_requests({}, {})
         rnd_link = download_link
-        response = curl.send_curl_request(request_url=rnd_link, page_redirects=True, include=True)
-        cookie_regex = re.compile(r'Set-Cookie:\s(.+?=.+?);', flags=re.IGNORECASE)
-        cookies_list = cookie_regex.findall(str(response.get('response')))
-
-        cookie_dict_regex = re.compile(r'(.+?)=(.+)')
+        response = curl.send_request(request_url=rnd_link, page_redirects=True)
         self.cookies_dict = {}
-        for cookie in cookies_list:
-            try:
-                name = cookie_dict_regex.search(cookie).group(1).strip()
-                print(f"INFO: Found cookie: {name}")
-            except:
-                print(f"ERROR Extracting cookie name")
-                name = None
-
-            try:
-                value = cookie_dict_regex.search(cookie).group(2).strip()
-                print(f"INFO: Found value of cookie {name}: {value}")
-            except:
-                print(f"ERROR Extracting cookie value")
-                value = None
-
-            if name and value:
-                self.cookies_dict[name] = value
+        for cookie in response.set_cookies:
+            logger.debug("Found value of cookie %s: %s", cookie.name, cookie.value)
+            if cookie.value:
+                self.cookies_dict[cookie.name] = cookie.value
 
-        print(f"\nINFO: Cookies found\n\t{self.cookies_dict}")
+        logger.info("Cookies found: %s", list(self.cookies_dict))
 
     def get_stage_three_headers(self, captcha_info):
         """
@@ -1,4 +1,7 @@
 import json
+import logging
+from CoreLibrary.CurlLogging import configure_logging
+from CoreLibrary.PyCurlRequest import CurlRequests
 from TrackingSiteModules.FedexTrackingCurl import FedexTrackingApi
 from TrackingSiteModules.UPSTrackingCurl import UPSTrackingApi
 from DropapkModules.DropapkCurl import DropakInfo
@@ -30,6 +33,41 @@ def get_ups_tracking():
     print(f"\nRESULTS: {json.dumps(results_list, indent=2)}\n")
 
 
+def get_ups_tracking_concurrently():
+    """
+    Same as get_ups_tracking, but all the tracking requests are sent at once with send_many
+    :return:
+    """
+    tracking_list = ["1ZR302V40346943384", "1Z300WX00341127902"]
+    ups = UPSTrackingApi()
+
+    request_specs = []
+    for track_num in tracking_list:
+        request_specs.append({
+            "request_url": ups.tracking_api_url,
+            "data": ups.tracking_request_body_data(track_num),
+            "headers_dict": ups.base_headers_dict(track_num),
+            "proxy": ups.format_proxy()
+        })
+
+    curl = CurlRequests(cookies_dict=ups.cookies_dict, headers_dict=ups.base_headers_dict(tracking_list[0]), session_pool=ups.session_pool)
+    results_list = curl.send_many(request_specs, max_concurrency=4)
+
+    print(f"\nRESULTS: {json.dumps(results_list, indent=2)}\n")
+
+
+def get_ups_tracking_bulk():
+    """
+    Same as get_ups_tracking, but the tracking numbers are packed into as few requests as UPS accepts
+    :return:
+    """
+    tracking_list = ["1ZR302V40346943384", "1Z300WX00341127902"]
+    ups = UPSTrackingApi()
+    results = ups.send_bulk_tracking_query(tracking_list)
+
+    print(f"\nRESULTS: {json.dumps(results, indent=2)}\n")
+
+
 def download_file_dropapk():
     downloader = DropakInfo(cookies_dict={}, proxy=None)
     link = "https://dropapk.to/2yo0kibvx54t/TestVideo.1920x1080.webm_vp9.webm"
@@ -49,4 +87,5 @@ def get_file_download_link_dropapk():
 
 
 if __name__ == "__main__":
+    configure_logging(logging.INFO)
     get_ups_tracking()
@@ -0,0 +1,137 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_tracking_number(tracking_number):
+    """
+    :param tracking_number:
+    :return: Tracking number as carriers echo it back: upper case, without spaces
+    """
+    return str(tracking_number).replace(' ', '').upper()
+
+
+def chunk_tracking_numbers(tracking_numbers, chunk_size):
+    """
+    Splits tracking numbers into the chunks sent in each request. Duplicates are only sent once
+    :param tracking_numbers: Iterable of tracking numbers
+    :param chunk_size: Maximum tracking numbers per chunk
+    :return: List of lists of tracking numbers, in the order they were given
+    """
+    unique_numbers = []
+    seen = set()
+    for tracking_number in tracking_numbers:
+        tracking_number = str(tracking_number).strip()
+        key = normalize_tracking_number(tracking_number)
+        if tracking_number and key not in seen:
+            seen.add(key)
+            unique_numbers.append(tracking_number)
+
+    chunk_size = max(1, chunk_size)
+    return [unique_numbers[start:start + chunk_size] for start in range(0, len(unique_numbers), chunk_size)]
+
+
+def results_for_every_spelling(tracking_numbers, results):
+    """
+    Duplicates are only queried once, under the first spelling given. Every other spelling of the same tracking number
+    (eg: lower case or with spaces) gets its response too
+    :param tracking_numbers: Tracking numbers as given
+    :param results: dict of tracking number -> response, for the tracking numbers that were queried
+    :return: dict of every tracking number given -> response
+    """
+    results_by_key = {normalize_tracking_number(tracking_number): response for tracking_number, response in results.items()}
+    spelled_out = {}
+    for tracking_number in tracking_numbers:
+        key = normalize_tracking_number(str(tracking_number).strip())
+        if key in results_by_key:
+            spelled_out[tracking_number] = results_by_key[key]
+    return spelled_out
+
+
+def get_package_list(response, list_path):
+    """
+    :param response: dict returned by send_curl_request
+    :param list_path: Keys leading to the list of packages in the response, eg: ("TrackPackagesResponse", "packageList")
+    :return: The list of packages, or None if the response has none (error, timeout, unexpected format)
+    """
+    value = response
+    for key in list_path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, list) else None
+
+
+def with_package_list(response, list_path, packages):
+    """
+    :param response:
+    :param list_path:
+    :param packages:
+    :return: Copy of the response where the list of packages is replaced. Only the dicts along list_path are copied
+    """
+    response = dict(response)
+    parent = response
+    for key in list_path[:-1]:
+        parent[key] = dict(parent[key])
+        parent = parent[key]
+    parent[list_path[-1]] = packages
+    return response
+
+
+def split_bulk_response(response, tracking_numbers, list_path, number_key):
+    """
+    Maps the response of a multi number tracking request back to each tracking number. Every tracking number gets
+    the response as a single number query would have returned it: the same envelope, with only its own packages.
+    Packages are matched on the number the carrier echoes back, or by position if the carrier did not echo one.
+    If the response has no list of packages (timeout, error page ...), every tracking number gets the response as is
+    :param response: dict returned by send_curl_request
+    :param tracking_numbers: Tracking numbers sent in the request, in order
+    :param list_path: Keys leading to the list of packages in the response
+    :param number_key: Key of the tracking number in each package
+    :return: dict of tracking number -> response
+    """
+    packages = get_package_list(response, list_path)
+    if packages is None:
+        return {tracking_number: response for tracking_number in tracking_numbers}
+
+    keys = [normalize_tracking_number(tracking_number) for tracking_number in tracking_numbers]
+    packages_by_key = {key: [] for key in keys}
+    for position, package in enumerate(packages):
+        echoed = package.get(number_key) if isinstance(package, dict) else None
+        key = normalize_tracking_number(echoed) if echoed else None
+        if key not in packages_by_key and len(packages) == len(keys):
+            key = keys[position]
+        if key in packages_by_key:
+            packages_by_key[key].append(package)
+        else:
+            logger.debug("Package for %s was not asked for", echoed)
+
+    results = {}
+    for tracking_number, key in zip(tracking_numbers, keys):
+        if not packages_by_key[key]:
+            logger.warning("No package returned for %s", tracking_number)
+        results[tracking_number] = with_package_list(response, list_path, packages_by_key[key])
+    return results
+
+
+def tracking_result(carrier, client, tracking_number, response, error='No response', include_response=True):
+    """
+    Result of one tracking number, as the bulk tracking tools output it
+    :param carrier: "ups", "fedex" or "usps"
+    :param client: Client of the carrier, to read the status of the response
+    :param tracking_number:
+    :param response: Tracking response, None if the tracking number got none
+    :param error: Error reported when there is no response
+    :param include_response: Put the carrier response in the result, not only the status
+    :return: dict {"tracking_number": ..., "carrier": ..., "status": ..., "response": ...}, with "error" if the
+    tracking number could not be tracked
+    """
+    if not response:
+        return {'tracking_number': tracking_number, 'carrier': carrier, 'error': error}
+    result = {'tracking_number': tracking_number, 'carrier': carrier, 'status': client.tracking_status(response)}
+    if result['status'] is None:
+        # Timeout, error page, unknown tracking number...
+        result['error'] = 'No tracking status in the response'
+    if include_response:
+        result['response'] = response
+    return result
@@ -0,0 +1,343 @@
+import logging
+import time
+from CoreLibrary.PyCurlRequest import CurlRequests
+from CoreLibrary.CurlSessionPool import CurlSessionPool
+from CoreLibrary.CurlCookieJar import CookieJar
+from CoreLibrary.CurlProxyPool import proxy_key
+from CoreLibrary.CurlRateLimiter import RateLimiter
+from CoreLibrary.CurlRetry import RetryPolicy
+from TrackingSiteModules.BulkTracking import chunk_tracking_numbers, results_for_every_spelling, split_bulk_response
+from TrackingSiteModules.CarrierSessions import CarrierSession, CarrierSessionRegistry
+from TrackingSiteModules.TrackingCache import TrackingCache
+
+logger = logging.getLogger(__name__)
+
+
+class CarrierTrackingApi:
+    """
+    Session and cookie plumbing shared by the carrier tracking classes: cookies kept in the shared cookie jar,
+    bootstrapped from the carrier site when missing, the process wide CarrierSession, sticky proxies, and the
+    CurlRequests every query is sent with.
+    The tracking queries (single, bulk and asyncio) are sent, split and cached here too.
+    A carrier class sets carrier, cookie_domain, bootstrap_url and bulk_chunk_size, and defines static_headers_dict,
+    tracking_request_spec and tracking_status. It can derive tokens from the cookies with session_tokens
+    (eg: the UPS XSRF token)
+    """
+    carrier = None  # eg: "ups_curl"
+    cookie_domain = None
+    bootstrap_url = None  # Page of the carrier site that sets the session cookies
+    # Most tracking numbers the carrier site accepts in one request
+    bulk_chunk_size = 1
+    # Where the packages are in a tracking response, and the key of their tracking number. Only needed if bulk_chunk_size > 1
+    package_list_path = None
+    package_number_key = None
+
+    def __init__(self, cookies_dict=None, proxy=None, session_pool=None, cookie_jar=None, session_registry=None, tracking_cache=None, proxy_pool=None, sticky_proxy=False, rate_limiter=None, retry_policy=None, hedge_policy=None):
+        """
+        :param cookies_dict:
+        :param proxy: IP:PORT or HOST:PORT
+        :param session_pool: CurlSessionPool used for all requests. Defaults to the process wide pool, so connections
+        to the carrier site are reused across tracking numbers and instances
+        :param cookie_jar: CookieJar the session cookies are kept in. Defaults to the jar shared by all processes
+        :param session_registry: CarrierSessionRegistry sharing the session between instances. Defaults to the process wide registry
+        :param tracking_cache: TrackingCache in front of the tracking queries. Defaults to the process wide cache
+        :param proxy_pool: ProxyPool (see CoreLibrary.CurlProxyPool) each request draws its proxy from, when no proxy is given
+        :param sticky_proxy: Send all the requests of the session through one proxy of the pool, the one its cookies were
+        obtained through. A new session is started when that proxy gets quarantined
+        :param rate_limiter: RateLimiter pacing the requests to the carrier site. Defaults to the process wide limiter
+        :param retry_policy: RetryPolicy of the failed requests (see CoreLibrary.CurlRetry). Defaults to 3 attempts with backoff
+        :param hedge_policy: HedgePolicy sending the slowest tracking queries a second time. No hedging if None
+        """
+        self.cookies_dict = cookies_dict
+        self.proxy = proxy  # IP:PORT or HOST:PORT
+        self.session_pool = session_pool or CurlSessionPool.shared()
+        self.cookie_jar = cookie_jar or CookieJar.shared()
+        self.session_registry = session_registry or CarrierSessionRegistry.shared()
+        self.tracking_cache = tracking_cache or TrackingCache.shared()
+        self.proxy_pool = proxy_pool
+        self.sticky_proxy = sticky_proxy
+        self.rate_limiter = rate_limiter or RateLimiter.shared()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge_policy = hedge_policy
+
+        # Set the cookies for the request here. Only the first instance of the process loads them,
+        # the following ones reuse its session
+        self.session = None
+        self.current_session()
+
+    def curl_requests(self, session=None):
+        """
+        :param session: CarrierSession whose cookies and headers are sent. None for none, eg: to bootstrap the cookies
+        :return: CurlRequests sending the requests of the carrier
+        """
+        cookies_dict = session.cookies_dict if session is not None else {}
+        headers_dict = session.headers_dict if session is not None else {}
+        return CurlRequests(cookies_dict=cookies_dict, headers_dict=headers_dict, session_pool=self.session_pool, carrier=self.carrier, proxy_pool=self.proxy_pool,
+                            proxy_session=self.proxy_session_key(), rate_limiter=self.rate_limiter, retry_policy=self.retry_policy, hedge_policy=self.hedge_policy)
+
+    def load_cookie(self):
+        """
+        Loads the cookies of the carrier from the shared cookie jar, if they were saved less than a day ago
+        :return: dict of cookies, or None
+        """
+        cookie = self.cookie_jar.load(self.cookie_namespace(), max_age=86400) or None
+        if cookie:
+            logger.info("%s cookie loaded from the cookie jar", self.carrier)
+            self.cookies_dict = cookie
+        else:
+            logger.info("%s cookie missing or more than a day old. Will get new one", self.carrier)
+
+        return cookie
+
+    def saveCookie(self, cookies_dict):
+        """
+        Saves a dictionary of cookies to the shared cookie jar, which can be used for future requests
+        :param cookies_dict:
+        :return:
+        """
+        self.cookie_jar.save_dict(self.cookie_namespace(), cookies_dict, domain=self.cookie_domain)
+        logger.debug("%s cookie saved", self.carrier)
+
+    def set_cookies_dict(self, bootstrap=False):
+        """
+        The session cookies can only be obtained via a browser session, or a prior curl session.
+        Check if cookies are stored on local machine before trying to get a new one
+        :param bootstrap: Get new cookies from the site even if the cookie jar has some
+        :return: Unix time the cookies were obtained: when they were stored, for cookies of the cookie jar,
+        now for cookies just received from the site (or none received)
+        """
+        waiting_since = time.time()
+        namespace = self.cookie_namespace()
+        if not bootstrap:
+            cookie = self.load_cookie()
+            if cookie:
+                self.cookies_dict = cookie
+                return self.cookie_jar.last_saved(namespace)
+
+        # Only one process gets new cookies at a time. The others wait for it, then use the cookies it got
+        with self.cookie_jar.bootstrap_lock(namespace):
+            last_saved = self.cookie_jar.last_saved(namespace)
+            if last_saved is not None and last_saved >= waiting_since:
+                logger.info("%s cookie obtained by another process while waiting", self.carrier)
+                self.cookies_dict = self.cookie_jar.load(namespace)
+                return last_saved
+
+            logger.info("%s cookie not loaded from the cookie jar. Will obtain new one from %s", self.carrier, self.bootstrap_url)
+            response = self.curl_requests().send_request(request_url=self.bootstrap_url, page_redirects=True)
+            if not response.set_cookies:
+                # Keep the cookies other processes may still be using
+                logger.warning("No cookies received from %s", self.bootstrap_url)
+                self.cookies_dict = {}
+                return time.time()
+
+            # Stored with their domain, path and expiry, replacing the previous session
+            self.cookie_jar.store_response(namespace, response, self.bootstrap_url, replace=True)
+            self.cookies_dict = self.cookie_jar.load(namespace)
+            logger.info("Cookies found: %s", list(self.cookies_dict))
+        return time.time()
+
+    def session_tokens(self):
+        """
+        :return: dict of the values the tracking queries need that are derived from self.cookies_dict
+        """
+        return {}
+
+    def static_headers_dict(self):
+        """
+        :return: Headers sent with every tracking query
+        """
+        raise NotImplementedError
+
+    def create_session(self, bootstrap=False):
+        """
+        Loads the cookies (or gets new ones) and derives everything else the tracking queries need from them
+        :param bootstrap: Get new cookies from the site even if the cookie jar has some
+        :return: CarrierSession
+        """
+        # Not the last save of the cookie jar: when no cookies were received nothing is saved, and the session
+        # must still last EMPTY_SESSION_MAX_AGE from now rather than be born expired
+        created = self.set_cookies_dict(bootstrap)
+        tokens = self.session_tokens()
+        return CarrierSession(self.carrier, self.cookies_dict, tokens=tokens, headers_dict=self.static_headers_dict(), created=created, proxy=self.sticky_session_proxy())
+
+    def use_session(self, session):
+        """
+        :param session: CarrierSession
+        :return:
+        """
+        self.session = session
+        self.cookies_dict = session.cookies_dict
+
+    def current_session(self):
+        """
+        :return: Session of the process. Created by the first instance, and renewed once it expires or is refreshed
+        """
+        session = self.session_registry.get_or_create(self.carrier, self.create_session)
+        if session is not self.session:
+            self.use_session(session)
+        if self.sticky_proxy and self.proxy_pool is not None and session.proxy != self.sticky_session_proxy():
+            # The proxy of the session was quarantined. Its cookies are not sent from another address
+            logger.info("%s proxy changed from %s. Starting a new session", self.carrier, proxy_key(session.proxy) if session.proxy else None)
+            session = self.session_registry.refresh(self.carrier, self.create_session, session.generation)
+            self.use_session(session)
+        return session
+
+    async def current_session_async(self):
+        """
+        Asyncio version of current_session. Creating a session loads cookies from the cookie jar and may wait for
+        a bootstrap (or another process doing one), so it runs in the default executor, not on the event loop
+        :return: Session of the process
+        """
+        session = self.session_registry.get(self.carrier)
+        if session is not None and session is self.session and not self.sticky_proxy:
+            return session
+
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self.current_session)
+
+    def refresh_session(self):
+        """
+        Replaces the session of the process with new cookies from the site, eg: once the carrier rejects the current ones.
+        If several clients ask at the same time, only the first one gets new cookies and the others get its session
+        :return: CarrierSession
+        """
+        stale_generation = self.session.generation if self.session is not None else None
+        session = self.session_registry.refresh(self.carrier, lambda: self.create_session(bootstrap=True), stale_generation)
+        self.use_session(session)
+        return session
+
+    def format_proxy(self):
+        """
+        :return:
+        """
+        if self.proxy:
+            curl_proxy = f"http://{self.proxy}"  # IP:PORT or HOST:PORT
+            logger.debug("Proxy set for request: %s", curl_proxy)
+            return curl_proxy
+        return None
+
+    def proxy_session_key(self):
+        """
+        :return: Sticky session key of the requests in the proxy pool, None if each request can use any proxy
+        """
+        if self.sticky_proxy and self.proxy_pool is not None and not self.proxy:
+            return self.carrier
+        return None
+
+    def sticky_session_proxy(self):
+        """
+        :return: Proxy the pool pinned to the session of the carrier, None if proxies are not sticky
+        """
+        session_key = self.proxy_session_key()
+        return self.proxy_pool.choose(session_key) if session_key is not None else None
+
+    def cookie_namespace(self):
+        """
+        :return: Namespace of the cookies in the cookie jar. With sticky proxies, cookies are kept per proxy,
+        so the cookies obtained through a proxy are only ever sent through it, by any process.
+        The credentials of the proxy are not part of it
+        """
+        proxy = self.sticky_session_proxy()
+        return f"{self.carrier}@{proxy_key(proxy)}" if proxy else self.carrier
+
+    def tracking_request_spec(self, tracking_numbers):
+        """
+        :param tracking_numbers: Tracking numbers sent in one request, at most bulk_chunk_size
+        :return: send_curl_request arguments of the tracking request, eg: {"request_url": ..., "data": ..., "proxy": ...}
+        """
+        raise NotImplementedError
+
+    def tracking_status(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: Status of the package (one of the TrackingCache STATUS_ constants), or None if the response has none
+        """
+        raise NotImplementedError
+
+    def tracking_progress(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: The part of the response that changes when the shipment moves: its status and scan events.
+        The TrackingScheduler compares it between polls. Defaults to the whole response
+        """
+        return response
+
+    def split_tracking_response(self, response, tracking_numbers):
+        """
+        :param response: Response of a tracking request
+        :param tracking_numbers: Tracking numbers sent in the request
+        :return: dict of tracking number -> response, shaped like the response of a request for that number alone
+        """
+        if self.package_list_path is None:
+            return {tracking_number: response for tracking_number in tracking_numbers}
+        return split_bulk_response(response, tracking_numbers, self.package_list_path, self.package_number_key)
+
+    def send_tracking_query(self, tracking_number, bypass_cache=False):
+        """
+        Sends a tracking query to the carrier, unless the tracking cache has a response for the tracking number
+        :param tracking_number:
+        :param bypass_cache: Always query the carrier. The response still replaces the cached one
+        :return: tracking response (JSON format, or {"response": html})
+        """
+        cached = self.tracking_cache.lookup(self.carrier, tracking_number, bypass_cache)
+        if cached is not None:
+            return cached
+
+        session = self.current_session()
+        curl = self.curl_requests(session)
+        response = curl.send_curl_request(**self.tracking_request_spec([tracking_number]))
+        self.tracking_cache.put(self.carrier, tracking_number, response, self.tracking_status(response))
+
+        return response
+
+    async def send_tracking_query_async(self, tracking_number, bypass_cache=False):
+        """
+        Asyncio version of send_tracking_query
+        :param tracking_number:
+        :param bypass_cache: Always query the carrier. The response still replaces the cached one
+        :return: tracking response (JSON format, or {"response": html})
+        """
+        cached = self.tracking_cache.lookup(self.carrier, tracking_number, bypass_cache)
+        if cached is not None:
+            return cached
+
+        session = await self.current_session_async()
+        curl = self.curl_requests(session)
+        response = await curl.send_curl_request_async(**self.tracking_request_spec([tracking_number]))
+        self.tracking_cache.put(self.carrier, tracking_number, response, self.tracking_status(response))
+
+        return response
+
+    def send_bulk_tracking_query(self, tracking_numbers, chunk_size=None, max_concurrency=4, bypass_cache=False):
+        """
+        Sends tracking queries for many tracking numbers, packing up to bulk_chunk_size tracking numbers in each request.
+        The requests are sent concurrently. Cached tracking numbers are not sent
+        :param tracking_numbers: Iterable of tracking numbers. Duplicates (whatever their spelling) are only queried once
+        :param chunk_size: Tracking numbers per request. Defaults to bulk_chunk_size
+        :param max_concurrency: Maximum number of requests in flight at the same time
+        :param bypass_cache: Query every tracking number, even the ones with a cached response
+        :return: dict of tracking number -> tracking response, shaped like the response of send_tracking_query, for every tracking number given
+        """
+        chunk_size = min(chunk_size or self.bulk_chunk_size, self.bulk_chunk_size)
+        given_numbers = list(tracking_numbers)
+        tracking_numbers = [tracking_number for chunk in chunk_tracking_numbers(given_numbers, chunk_size) for tracking_number in chunk]
+
+        results = {}
+        for tracking_number in tracking_numbers:
+            cached = self.tracking_cache.lookup(self.carrier, tracking_number, bypass_cache)
+            if cached is not None:
+                results[tracking_number] = cached
+
+        chunks = chunk_tracking_numbers([tracking_number for tracking_number in tracking_numbers if tracking_number not in results], chunk_size)
+        if chunks:
+            session = self.current_session()
+            curl = self.curl_requests(session)
+            responses = curl.send_many([self.tracking_request_spec(chunk) for chunk in chunks], max_concurrency=max_concurrency)
+            logger.info("Sent %s tracking numbers to %s in %s requests", sum(len(chunk) for chunk in chunks), self.carrier, len(chunks))
+
+            for chunk, response in zip(chunks, responses):
+                for tracking_number, tracking_response in self.split_tracking_response(response, chunk).items():
+                    self.tracking_cache.put(self.carrier, tracking_number, tracking_response, self.tracking_status(tracking_response))
+                    results[tracking_number] = tracking_response
+
+        return results_for_every_spelling(given_numbers, results)
@@ -0,0 +1,162 @@
+import logging
+import re
+from TrackingSiteModules import get_carrier_class
+
+logger = logging.getLogger(__name__)
+
+UPS_REGEX = re.compile(r'1Z[0-9A-Z]{16}')
+S10_REGEX = re.compile(r'[A-Z]{2}\d{9}[A-Z]{2}')  # International mail, eg: EA123456789US
+# UPS check digits: letters count as (position in the alphabet + 1) % 10, eg: A -> 2
+UPS_LETTER_VALUES = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', bytes(ord('0') + (letter - 63) % 10 for letter in b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+S10_WEIGHTS = (8, 6, 4, 2, 3, 5, 9, 7)
+ZERO = ord('0')
+
+# The check digits are computed on the ASCII codes of the digits, summed by slices (in C) rather than digit by digit.
+# ZERO * count is then taken off each sum
+
+
+def mod10_valid(digits):
+    """
+    GS1 mod 10 check digit (USPS IMpb, Fedex Ground, SSCC): from the right, data digits are weighted 3, 1, 3, 1...
+    :param digits: Digits, check digit last
+    :return: True if the check digit matches
+    """
+    data = digits[:-1].encode()
+    odd = data[::-2]
+    even = data[-2::-2]
+    total = 3 * (sum(odd) - ZERO * len(odd)) + sum(even) - ZERO * len(even)
+    return (10 - total % 10) % 10 == ord(digits[-1]) - ZERO
+
+
+def fedex_express_valid(digits):
+    """
+    :param digits: 12 digit Fedex Express tracking number
+    :return: True if the check digit matches: from the right, data digits weighted 1, 3, 7... sum mod 11
+    """
+    data = digits[-2::-1].encode()
+    ones, threes, sevens = data[0::3], data[1::3], data[2::3]
+    total = sum(ones) - ZERO * len(ones) + 3 * (sum(threes) - ZERO * len(threes)) + 7 * (sum(sevens) - ZERO * len(sevens))
+    return total % 11 % 10 == ord(digits[-1]) - ZERO
+
+
+def ups_valid(tracking_number):
+    """
+    :param tracking_number: 1Z tracking number
+    :return: True if the check digit matches: the 15 characters after 1Z, every other one doubled, mod 10
+    """
+    data = tracking_number[2:18].encode().translate(UPS_LETTER_VALUES)
+    odd = data[0:15:2]
+    even = data[1:15:2]
+    total = sum(odd) - ZERO * len(odd) + 2 * (sum(even) - ZERO * len(even))
+    return (10 - total % 10) % 10 == data[15] - ZERO
+
+
+def s10_valid(tracking_number):
+    """
+    :param tracking_number: UPU S10 tracking number, eg: EA123456789US
+    :return: True if the check digit matches
+    """
+    total = sum((digit - ZERO) * weight for digit, weight in zip(tracking_number[2:10].encode(), S10_WEIGHTS))
+    check = 11 - total % 11
+    return {10: 0, 11: 5}.get(check, check) == ord(tracking_number[10]) - ZERO
+
+
+def detect_digits(number, strict):
+    """
+    :param number: Tracking number made of digits only
+    :param strict: Require a valid check digit
+    :return: Carrier, or None
+    """
+    length = len(number)
+    if length == 12:
+        return 'fedex' if not strict or fedex_express_valid(number) else None
+    if length == 15:
+        return 'fedex' if not strict or mod10_valid(number) else None
+    if length == 20:
+        # SSCC-18 behind its 00 application identifier (Fedex Ground), otherwise the former USPS format
+        carrier = 'fedex' if number.startswith('00') else 'usps'
+        return carrier if not strict or mod10_valid(number[2:] if carrier == 'fedex' else number) else None
+    if length == 22:
+        if number.startswith('96'):
+            # Fedex Ground 96 barcode, the tracking number is its last 15 digits
+            return 'fedex' if not strict or mod10_valid(number[7:]) else None
+        if number[0] == '9' and number[1] in '12345':
+            return 'usps' if not strict or mod10_valid(number) else None
+        return None
+    if length in (30, 34) and number.startswith('420'):
+        # USPS barcode with the destination ZIP code in front of the tracking number
+        return detect_digits(number[-22:], strict)
+    return None
+
+
+def detect_carrier(tracking_number, strict=True):
+    """
+    Identifies the carrier of a tracking number from its format and check digit:
+    1Z... for UPS, 12 and 15 digits, 20 digits starting with 00 and 22 digits starting with 96 for Fedex,
+    20 digits, 22 digits starting with 91 to 95 and international (EA123456789US) for USPS
+    :param tracking_number:
+    :param strict: Require a valid check digit. Otherwise the format is enough
+    :return: "ups", "fedex", "usps", or None if the tracking number matches no known format
+    """
+    number = tracking_number
+    if not number.isdigit():
+        number = number.replace(' ', '').upper()
+    if number.isdigit():
+        return detect_digits(number, strict)
+    if UPS_REGEX.fullmatch(number):
+        return 'ups' if not strict or ups_valid(number) else None
+    if S10_REGEX.fullmatch(number):
+        return 'usps' if not strict or s10_valid(number) else None
+    return None
+
+
+def classify_tracking_numbers(tracking_numbers, strict=True):
+    """
+    Groups tracking numbers by carrier
+    :param tracking_numbers: Iterable of tracking numbers
+    :param strict: Require a valid check digit
+    :return: dict of carrier -> list of tracking numbers, in the order they were given.
+    Tracking numbers of no known carrier are under None
+    """
+    groups = {}
+    for tracking_number in tracking_numbers:
+        carrier = detect_carrier(tracking_number, strict)
+        group = groups.get(carrier)
+        if group is None:
+            group = groups[carrier] = []
+        group.append(tracking_number)
+    return groups
+
+
+def track_many(tracking_numbers, clients=None, strict=True, max_concurrency=4, bypass_cache=False):
+    """
+    Tracks a mixed list of tracking numbers: each is routed to the send_bulk_tracking_query of its carrier.
+    The carriers are queried at the same time
+    :param tracking_numbers: Iterable of tracking numbers of any carrier
+    :param clients: dict of carrier -> client instance, eg: {"ups": UPSTrackingApi(proxy=proxy)}. Created if missing
+    :param strict: Require a valid check digit to route a tracking number
+    :param max_concurrency: Maximum number of requests in flight at the same time, per carrier
+    :param bypass_cache: Query every tracking number, even the ones with a cached response
+    :return: dict of tracking number -> tracking response. None for the tracking numbers of no known carrier
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    groups = classify_tracking_numbers(tracking_numbers, strict)
+    unknown = groups.pop(None, [])
+    if unknown:
+        logger.warning("Carrier of %s tracking numbers not recognized, eg: %s", len(unknown), unknown[0])
+
+    clients = dict(clients or {})
+    results = dict.fromkeys(unknown)
+    if not groups:
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = {}
+        for carrier, group in groups.items():
+            client = clients.get(carrier) or get_carrier_class(carrier)()
+            logger.info("Routing %s tracking numbers to %s", len(group), client.carrier)
+            futures[carrier] = executor.submit(client.send_bulk_tracking_query, group, max_concurrency=max_concurrency, bypass_cache=bypass_cache)
+        for carrier, future in futures.items():
+            results.update(future.result())
+    return results
@@ -0,0 +1,306 @@
+import copy
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Same age the cookie jar accepts for carrier cookies
+SESSION_MAX_AGE = 86400
+# Sessions without cookies (failed bootstrap) are only kept long enough to not retry on every instance
+EMPTY_SESSION_MAX_AGE = 60
+
+
+class CarrierSession:
+    """
+    Everything a carrier client needs to send tracking queries: the cookies, the tokens derived from them
+    (eg: the UPS XSRF token) and the headers profile.
+    Built once and shared by every client of the process. A session is never modified, refreshing replaces it
+    """
+
+    def __init__(self, carrier, cookies_dict, tokens=None, headers_dict=None, created=None, max_age=None, proxy=None):
+        """
+        :param carrier: eg: "ups_curl"
+        :param cookies_dict:
+        :param tokens: dict of values derived from the cookies
+        :param headers_dict: Headers sent with every tracking query
+        :param created: Unix time the cookies were obtained. Now if None
+        :param max_age: Seconds the session can be used for. Defaults to SESSION_MAX_AGE, or EMPTY_SESSION_MAX_AGE without cookies
+        :param proxy: Proxy of the pool the cookies were obtained through and the requests are sent through (sticky proxy).
+        None if requests can go through any proxy
+        """
+        self.carrier = carrier
+        self.cookies_dict = cookies_dict or {}
+        self.tokens = tokens or {}
+        self.headers_dict = headers_dict or {}
+        self.created = created or time.time()
+        if max_age is None:
+            max_age = SESSION_MAX_AGE if self.cookies_dict else EMPTY_SESSION_MAX_AGE
+        self.max_age = max_age
+        self.proxy = proxy
+        self.generation = 0  # Set by the registry, increases every time the session of the carrier is replaced
+
+    @property
+    def expires_at(self):
+        return self.created + self.max_age
+
+    def is_expired(self, now=None):
+        return (now or time.time()) >= self.expires_at
+
+    def __repr__(self):
+        return f"<CarrierSession {self.carrier} #{self.generation}>"
+
+
+class CarrierSessionRegistry:
+    """
+    Process wide cache of the current session of each carrier, so only the first client of a carrier
+    loads cookies and derives tokens. The following ones get the cached session.
+    Expired sessions are dropped, and replacing a session (refresh) is seen by every client on its next query
+    """
+    shared_registry = None
+    shared_registry_lock = threading.Lock()
+
+    def __init__(self):
+        self.sessions = {}  # carrier -> CarrierSession
+        self.generations = {}  # carrier -> generation of the last session put
+        self.lock = threading.Lock()
+        self.creation_locks = {}  # carrier -> lock held while a session of the carrier is created
+
+    @classmethod
+    def shared(cls):
+        """
+        Registry used by default by the carrier tracking classes
+        :return: CarrierSessionRegistry
+        """
+        with cls.shared_registry_lock:
+            if cls.shared_registry is None:
+                cls.shared_registry = cls()
+            return cls.shared_registry
+
+    def get(self, carrier):
+        """
+        :param carrier:
+        :return: Current session of the carrier, or None if there is none or it expired
+        """
+        with self.lock:
+            session = self.sessions.get(carrier)
+            if session is not None and session.is_expired():
+                logger.info("%s session expired", carrier)
+                del self.sessions[carrier]
+                session = None
+            return session
+
+    def put(self, session):
+        """
+        Makes a session the current session of its carrier
+        :param session: CarrierSession
+        :return: The session
+        """
+        with self.lock:
+            session.generation = self.generations.get(session.carrier, 0) + 1
+            self.generations[session.carrier] = session.generation
+            self.sessions[session.carrier] = session
+        logger.debug("New session for %s: %s", session.carrier, session)
+        return session
+
+    def invalidate(self, carrier):
+        """
+        Drops the session of a carrier, the next client creates a new one
+        :param carrier:
+        :return:
+        """
+        with self.lock:
+            self.sessions.pop(carrier, None)
+
+    def creation_lock(self, carrier):
+        with self.lock:
+            lock = self.creation_locks.get(carrier)
+            if lock is None:
+                lock = self.creation_locks[carrier] = threading.Lock()
+            return lock
+
+    def get_or_create(self, carrier, create_session):
+        """
+        Single flight: if several threads find no session, only the first one creates it, the others wait for it
+        and get the same session
+        :param carrier:
+        :param create_session: Function returning a new CarrierSession, called if the carrier has no current session
+        :return: CarrierSession
+        """
+        session = self.get(carrier)
+        if session is not None:
+            return session
+
+        with self.creation_lock(carrier):
+            # Created by another thread while this one was waiting
+            session = self.get(carrier)
+            if session is None:
+                session = self.put(create_session())
+        return session
+
+    def refresh(self, carrier, create_session, stale_generation=None):
+        """
+        Replaces the session of a carrier, unless it was already replaced since the caller got the one it found stale.
+        Threads refreshing together are coalesced like in get_or_create
+        :param carrier:
+        :param create_session: Function returning the new CarrierSession
+        :param stale_generation: Generation of the session the caller wants replaced. None to always replace it
+        :return: CarrierSession
+        """
+        with self.creation_lock(carrier):
+            session = self.get(carrier)
+            if session is not None and stale_generation is not None and session.generation > stale_generation:
+                logger.debug("%s session already refreshed", carrier)
+                return session
+            return self.put(create_session())
+
+
+class CarrierSessionRefresher:
+    """
+    Renews carrier sessions in a background thread before they expire, and swaps the new session into the registry
+    in one step. Tracking queries keep using the current session meanwhile, so they never wait for a bootstrap.
+    Each refresh happens at a random time within the jitter window before the margin, so workers started together
+    do not all hit the carrier site at the same moment.
+    eg: refresher = CarrierSessionRefresher()
+        refresher.watch(UPSTrackingApi())
+        refresher.start()
+    """
+
+    def __init__(self, session_registry=None, margin=3600, jitter=600, check_interval=60, retry_interval=300):
+        """
+        :param session_registry: Registry the sessions are swapped into. Defaults to the process wide registry
+        :param margin: Seconds before the expiry of a session at which it is renewed, at the latest
+        :param jitter: The renewal happens at a random time up to this many seconds before the margin
+        :param check_interval: Maximum seconds between two checks of the sessions
+        :param retry_interval: Seconds to wait before trying again after a failed renewal
+        """
+        self.session_registry = session_registry or CarrierSessionRegistry.shared()
+        self.margin = margin
+        self.jitter = jitter
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.clients = {}  # carrier -> client used to create the sessions
+        self.refresh_times = {}  # carrier -> (generation of the session, time to renew it)
+        self.retry_times = {}  # carrier -> time of the next attempt after a failure
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, client):
+        """
+        Keeps the session of the carrier of a client fresh
+        :param client: UPSTrackingApi, FedexTrackingApi or USPSTrackingApi instance.
+        A copy is used, so the client itself can keep being used by the caller
+        :return:
+        """
+        with self.lock:
+            self.clients[client.carrier] = copy.copy(client)
+        logger.info("Refreshing %s session in the background", client.carrier)
+
+    def unwatch(self, carrier):
+        with self.lock:
+            self.clients.pop(carrier, None)
+            self.refresh_times.pop(carrier, None)
+            self.retry_times.pop(carrier, None)
+
+    def start(self):
+        """
+        Starts the background thread
+        :return:
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='CarrierSessionRefresher', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background thread. A renewal in progress is completed first
+        :param timeout:
+        :return:
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        while not self.stopped.is_set():
+            wait = self.check_interval
+            with self.lock:
+                carriers = list(self.clients)
+            for carrier in carriers:
+                if self.stopped.is_set():
+                    return
+                try:
+                    wait = min(wait, self.refresh_if_due(carrier))
+                except Exception as e:
+                    logger.error("Error while refreshing %s session: %s", carrier, e)
+                    self.retry_times[carrier] = time.time() + self.retry_interval
+            self.stopped.wait(max(wait, 1))
+
+    def refresh_time(self, session):
+        """
+        :param session: CarrierSession
+        :return: Unix time the session should be renewed at. The same for as long as the session is current
+        """
+        planned = self.refresh_times.get(session.carrier)
+        if planned is None or planned[0] != session.generation:
+            refresh_at = session.expires_at - self.margin - random.uniform(0, self.jitter)
+            planned = (session.generation, refresh_at)
+            self.refresh_times[session.carrier] = planned
+        return planned[1]
+
+    def refresh_if_due(self, carrier):
+        """
+        Renews the session of a carrier if it is close to expiring
+        :param carrier:
+        :return: Seconds until the next renewal of the carrier is due
+        """
+        with self.lock:
+            client = self.clients.get(carrier)
+        if client is None:
+            return self.check_interval
+
+        now = time.time()
+        retry_at = self.retry_times.get(carrier, 0)
+        if now < retry_at:
+            return retry_at - now
+
+        session = self.session_registry.get(carrier)
+        if session is not None:
+            refresh_at = self.refresh_time(session)
+            if now < refresh_at:
+                return refresh_at - now
+
+        new_session = self.renew(client, session)
+        if new_session is None:
+            logger.warning("Could not renew %s session. Will try again in %s seconds", carrier, self.retry_interval)
+            self.retry_times[carrier] = now + self.retry_interval
+            return self.retry_interval
+
+        self.retry_times.pop(carrier, None)
+        with self.session_registry.creation_lock(carrier):
+            self.session_registry.put(new_session)
+        logger.info("%s session renewed in the background", carrier)
+        return max(self.refresh_time(new_session) - time.time(), 0)
+
+    def renew(self, client, session):
+        """
+        Gets the session that replaces the current one. Another process may already have renewed the cookies,
+        in which case they are taken from the cookie jar instead of bootstrapping again
+        :param client:
+        :param session: Current CarrierSession, None if there is none
+        :return: New CarrierSession, or None if no usable session could be obtained
+        """
+        current_expiry = session.expires_at if session is not None else 0
+        new_session = client.create_session()
+        if new_session.cookies_dict and new_session.expires_at - self.margin > max(current_expiry - self.margin, time.time()):
+            logger.debug("%s session was already renewed by another process", client.carrier)
+            return new_session
+
+        new_session = client.create_session(bootstrap=True)
+        if not new_session.cookies_dict:
+            return None
+        return new_session
@@ -1,112 +1,30 @@
-import os
-import re
-import pickle
-import time
-from CoreLibrary.PyCurlRequest import CurlRequests
+import json
+import logging
+from TrackingSiteModules.CarrierClient import CarrierTrackingApi
+from TrackingSiteModules.BulkTracking import get_package_list
+from TrackingSiteModules.TrackingCache import status_from_text, STATUS_DELIVERED, STATUS_EXCEPTION
 
+logger = logging.getLogger(__name__)
 
-class FedexTrackingApi:
+
+class FedexTrackingApi(CarrierTrackingApi):
     """
     Main purpose of this class is return the UPS specific curl_headers
     """
+    carrier = 'fedex_curl'
+    cookie_domain = 'fedex.com'
+    bootstrap_url = 'https://www.fedex.com/fedextrack/?tracknumbers=950548487353'
     tracking_api_url = 'https://www.fedex.com/trackingCal/track'
+    # Most tracking numbers the Fedex site accepts in one request
+    bulk_chunk_size = 30
+    # Where the packages are in a tracking response, and the key of their tracking number
+    package_list_path = ('TrackPackagesResponse', 'packageList')
+    package_number_key = 'trackingNbr'
 
-    def __init__(self, cookies_dict=None, proxy=None):
-        self.cookies_dict = cookies_dict
-        self.proxy = proxy # IP:PORT or HOST:PORT
-        self.carrier = 'fedex_curl'
-
-        # Set the cookies and the token for the request here
-        self.set_cookies_dict()
-
-    def load_cookie(self):
-        """
-        Loads cookies from disk if available, for sending requests
-        :return:
-        """
-        cookie = None
-        if os.path.exists(f'{self.carrier}.cookie'):
-            x = os.stat(f'{self.carrier}.cookie')
-            age = (time.time() - x.st_mtime)
-            if age < 86400:
-                print(f"INFO: Cookie on disk is less than a day old")
-                with open(f'{self.carrier}.cookie', 'rb') as cookie_store:
-                    cookie = pickle.load(cookie_store)
-                    if cookie:
-                        print("INFO: Cookie loaded from disk")
-                        self.cookies_dict = cookie
-            else:
-                print(f"INFO: Cookie is more than a day old. Will get new one")
-
-        return cookie
-
-    def saveCookie(self, cookies_dict):
-        """
-        Saves cookie  file to disk. To be used for sending tracking requests
-        :param cookies_dict:
-        :return:
-        """
-        with open(f'{self.carrier}.cookie', 'wb') as cookie_store:
-            pickle.dump(cookies_dict, cookie_store)
-            print("INFO: Cookie saved")
-
-    def set_cookies_dict(self):
-        """
-        This token can only be obtained via a browser session.
-        Check if cookies are stored on local machine before trying to get a new one
-        :return:
+    def static_headers_dict(self):
         """
-        cookie = self.load_cookie()
-        if cookie:
-            self.cookies_dict = cookie
-            return
-
-        print(f"INFO: Fedex cookie not loaded from on disk. Will obtain new one from Fedex site")
-        curl = CurlRequests(cookies_dict={}, headers_dict={})
-        rnd_link = 'https://www.fedex.com/fedextrack/?tracknumbers=950548487353'
-        response = curl.send_curl_request(request_url=rnd_link, page_redirects=True, include=True)
-        cookie_regex = re.compile(r'Set-Cookie:\s(.+?=.+?);', flags=re.IGNORECASE)
-        cookies_list = cookie_regex.findall(str(response.get('response')))
-
-        cookie_dict_regex = re.compile(r'(.+?)=(.+)')
-        self.cookies_dict = {}
-        for cookie in cookies_list:
-            try:
-                name = cookie_dict_regex.search(cookie).group(1).strip()
-                print(f"INFO: Found cookie: {name}")
-            except:
-                print(f"ERROR Extracting cookie name")
-                name = None
-
-            try:
-                value = cookie_dict_regex.search(cookie).group(2).strip()
-                print(f"INFO: Found value of cookie {name}: {value}")
-            except:
-                print(f"ERROR Extracting cookie value")
-                value = None
-
-            if name and value:
-                self.cookies_dict[name] = value
-
-        print(f"\nINFO: Cookies found\n\t{self.cookies_dict}")
-        self.saveCookie(self.cookies_dict)
-
-    def format_proxy(self):
-        """
-        :return:
-        """
-        if self.proxy:
-            curl_proxy = f"http://{self.proxy}"  # IP:PORT or HOST:PORT
-            print(f"INFO: Proxy set for request: {curl_proxy}")
-            return curl_proxy
-        return None
-
-
-
-    def base_headers_dict(self, tracking_number):
-        """
-        Defines and returns curl_headers for Costco API requests.
-        This is the base setting for headers. All other header request settings derive from this one.
+        Headers that are the same for every tracking request. They are compiled once into curl arguments
+        and reused, only the Referer header changes between tracking numbers (see referer_header)
         :return: dictionary of curl_headers
         """
 
@@ -122,33 +40,81 @@ class FedexTrackingApi:
             "Sec-Fetch-Site": "same-origin",
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Dest": "empty",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Referer": f"//www.fedex.com/apps/fedextrack/?tracknumbers={tracking_number}"
+            "Accept-Language": "en-US,en;q=0.9"
 
         }
         return headers_dict
 
-    def tracking_request_form_data(self, tracking_number):
+    def referer_header(self, tracking_number):
         """
-        Formats data used in Fedex tracking requests
-        :return:
+        :param tracking_number:
+        :return: Per request Referer header
         """
-        form_data = " 'data={\"TrackPackagesRequest\":{\"appType\":\"WTRK\",\"appDeviceType\":\"DESKTOP\",\"supportHTML\":true,\"supportCurrentLocation\":true,\"uniqueKey\":\"\",\"processingParameters\":{},\"trackingInfoList\":[{\"trackNumberInfo\":{\"trackingNumber\":\"%s\",\"trackingQualifier\":\"\",\"trackingCarrier\":\"\"}}]}}' -d 'action=trackpackages' -d 'locale=en_US' -d \"version=1\" -d \"format=json\"" % tracking_number
-        return form_data
+        return {"Referer": f"//www.fedex.com/apps/fedextrack/?tracknumbers={tracking_number}"}
 
-    def send_tracking_query(self, tracking_number):
+    def base_headers_dict(self, tracking_number):
         """
-        Sends a tracking query to Fedex. Gets a tracking response as a JSON response
-        :param tracking_number:
-        :return: tracking response (JSON format)
+        Defines and returns curl_headers for Costco API requests.
+        This is the base setting for headers. All other header request settings derive from this one.
+        :return: dictionary of curl_headers
         """
+        headers_dict = self.static_headers_dict()
+        headers_dict.update(self.referer_header(tracking_number))
+        return headers_dict
 
-        headers_dict = self.base_headers_dict(tracking_number)
-        form = self.tracking_request_form_data(tracking_number)
-        curl = CurlRequests(cookies_dict=self.cookies_dict, headers_dict=headers_dict)
+    def tracking_request_form_data(self, tracking_number):
+        """
+        Formats data used in Fedex tracking requests
+        :return: List of form fields, each sent with its own -d
+        """
+        return self.bulk_tracking_request_form_data([tracking_number])
 
-        proxy = self.format_proxy()
+    def bulk_tracking_request_form_data(self, tracking_numbers):
+        """
+        Formats data used in Fedex tracking requests for several tracking numbers at once
+        :param tracking_numbers: At most bulk_chunk_size tracking numbers
+        :return: List of form fields, each sent with its own -d
+        """
+        tracking_info_list = [{"trackNumberInfo": {"trackingNumber": tracking_number, "trackingQualifier": "", "trackingCarrier": ""}} for tracking_number in tracking_numbers]
+        request = {"TrackPackagesRequest": {"appType": "WTRK", "appDeviceType": "DESKTOP", "supportHTML": True, "supportCurrentLocation": True, "uniqueKey": "", "processingParameters": {},
+                                            "trackingInfoList": tracking_info_list}}
+        data = json.dumps(request, separators=(',', ':'))
+        return [f"data={data}", "action=trackpackages", "locale=en_US", "version=1", "format=json"]
 
-        response = curl.send_curl_request(request_url=self.tracking_api_url, form_data=form, proxy=proxy)
+    def tracking_request_spec(self, tracking_numbers):
+        """
+        :param tracking_numbers: Tracking numbers sent in one request, at most bulk_chunk_size
+        :return: send_curl_request arguments of the tracking request
+        """
+        return {
+            "request_url": self.tracking_api_url,
+            "form_data": self.bulk_tracking_request_form_data(tracking_numbers),
+            "proxy": self.format_proxy(),
+            "extra_headers": self.referer_header(','.join(tracking_numbers)),
+        }
 
-        return response
+    def tracking_status(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: Status of the package (one of the TrackingCache STATUS_ constants), or None if the response has none
+        """
+        packages = get_package_list(response, self.package_list_path)
+        if not packages or not isinstance(packages[0], dict):
+            return None
+        package = packages[0]
+        if package.get('isDelivered'):
+            return STATUS_DELIVERED
+        if package.get('isException') or package.get('isDelayed'):
+            return STATUS_EXCEPTION
+        return status_from_text(package.get('keyStatus'))
+
+    def tracking_progress(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: Status and scan events of the package, or None if the response has no package
+        """
+        packages = get_package_list(response, self.package_list_path)
+        if not packages or not isinstance(packages[0], dict):
+            return None
+        package = packages[0]
+        return {key: package.get(key) for key in ('keyStatus', 'isDelivered', 'isException', 'isDelayed', 'scanEventList')}
@@ -0,0 +1,301 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from TrackingSiteModules.BulkTracking import normalize_tracking_number
+
+logger = logging.getLogger(__name__)
+
+# Statuses the carrier classes parse from tracking responses (see their tracking_status method)
+STATUS_DELIVERED = 'delivered'
+STATUS_IN_TRANSIT = 'in_transit'
+STATUS_EXCEPTION = 'exception'
+STATUS_PENDING = 'pending'  # Label created, no scan yet
+
+# Seconds a response stays cached, by status. None: forever, a delivered package does not change anymore.
+# Responses without a status (errors, timeouts, unexpected pages) are never cached
+DEFAULT_TTLS = {
+    STATUS_DELIVERED: None,
+    STATUS_EXCEPTION: 3600,
+    STATUS_PENDING: 1800,
+    STATUS_IN_TRANSIT: 900,
+}
+
+# Markers of the status texts, lower case. Checked in this order, after delivered and exception
+# The carrier has no record of the tracking number (yet), or rejects it. Not a status of the package
+NOT_FOUND_TEXTS = ('not found', 'no record', 'invalid', 'unable to locate', 'could not locate', 'cannot locate', 'no information', 'not recognized')
+PENDING_TEXTS = ('label created', 'not available', 'pre-shipment', 'shipment information sent', 'initiated', 'awaiting item')
+IN_TRANSIT_TEXTS = ('transit', 'on the way', 'on its way', 'out for delivery', 'picked up', 'pickup', 'we have your package', 'in possession', 'accepted',
+                    'arrived', 'arriving', 'departed', 'scan', 'processed', 'processing', 'facility', 'moving through', 'forwarded', 'en route', 'shipped', 'loaded')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracking_cache (
+    carrier TEXT NOT NULL,
+    tracking_number TEXT NOT NULL,
+    status TEXT NOT NULL,
+    response TEXT NOT NULL,
+    stored REAL NOT NULL,
+    expires REAL,
+    PRIMARY KEY (carrier, tracking_number)
+)
+"""
+
+
+def status_from_text(text):
+    """
+    Classifies a status as the carrier sites display it, eg: "Delivered", "Out for Delivery", "Label Created"
+    :param text:
+    :return: One of the STATUS_ constants, or None if text is empty, says the tracking number is unknown to the carrier,
+    or is not recognized. Responses without a status are not cached
+    """
+    if not text:
+        return None
+    text = text.lower()
+    if any(marker in text for marker in NOT_FOUND_TEXTS):
+        return None
+    if 'not delivered' in text or 'undeliverable' in text or 'returned to sender' in text:
+        return STATUS_EXCEPTION
+    if 'delivered' in text:
+        return STATUS_DELIVERED
+    if 'exception' in text or 'delay' in text or 'alert' in text:
+        return STATUS_EXCEPTION
+    if any(marker in text for marker in PENDING_TEXTS):
+        return STATUS_PENDING
+    if any(marker in text for marker in IN_TRANSIT_TEXTS):
+        return STATUS_IN_TRANSIT
+    logger.debug("Status not recognized: %s", text)
+    return None
+
+
+class TrackingCache:
+    """
+    Cache of tracking responses in front of the send_tracking_query of the carrier classes, keyed by carrier
+    and tracking number. Recent responses are kept in memory (LRU), and optionally in a SQLite file shared by
+    every process of the machine. How long a response is kept depends on the status of the package:
+    forever once delivered, a few minutes while in transit (see DEFAULT_TTLS)
+    """
+    shared_cache = None
+    shared_cache_lock = threading.Lock()
+
+    def __init__(self, max_entries=10000, database_path=None, ttls=None, busy_timeout=30, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_entries: Responses kept in memory. The least recently used ones are dropped first
+        :param max_bytes: Size of the responses kept in memory, as JSON. Bounds the memory whatever the size of the
+        responses (eg: USPS tracking pages of ~60 KB each). Larger responses are only kept in the persistent tier
+        :param database_path: SQLite file of the persistent tier. Defaults to the TRACKING_CACHE_DB environment variable.
+        Memory only if neither is set
+        :param ttls: dict of status -> seconds (None for forever), overriding DEFAULT_TTLS
+        :param busy_timeout: Seconds to wait for another process holding the database locked
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_bytes = 0  # Size of the responses in self.entries
+        self.database_path = database_path or os.environ.get('TRACKING_CACHE_DB')
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.busy_timeout = busy_timeout
+        self.entries = OrderedDict()  # (carrier, tracking number) -> (status, response as JSON, expiry time or None)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.bypasses = 0
+
+    @classmethod
+    def shared(cls):
+        """
+        Process wide cache used by default by the carrier tracking classes
+        :return: TrackingCache
+        """
+        with cls.shared_cache_lock:
+            if cls.shared_cache is None:
+                cls.shared_cache = cls()
+            return cls.shared_cache
+
+    def connection(self):
+        """
+        :return: SQLite connection of the calling thread, or None without a persistent tier
+        """
+        if not self.database_path:
+            return None
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self.database_path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def ttl(self, status):
+        """
+        :param status:
+        :return: Seconds a response with this status is kept, None for forever
+        """
+        return self.ttls.get(status, self.ttls[STATUS_IN_TRANSIT])
+
+    def lookup(self, carrier, tracking_number, bypass=False):
+        """
+        Cached response to use instead of sending a tracking query
+        :param carrier: eg: "ups_curl"
+        :param tracking_number:
+        :param bypass: Always query the carrier. Counted, and the fresh response replaces the cached one once stored
+        :return: Cached response, or None
+        """
+        if bypass:
+            with self.lock:
+                self.bypasses += 1
+            return None
+        return self.get(carrier, tracking_number)
+
+    def get(self, carrier, tracking_number):
+        """
+        :param carrier:
+        :param tracking_number:
+        :return: Cached response, or None if there is none or it expired. A new copy every time
+        """
+        key = (carrier, normalize_tracking_number(tracking_number))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= now:
+                self.forget(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[1])
+
+        entry = self.load_persistent(key, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.persistent_hits += 1
+            self.remember(key, entry)
+        return json.loads(entry[1])
+
+    def load_persistent(self, key, now):
+        """
+        :param key: (carrier, normalized tracking number)
+        :param now:
+        :return: (status, response as JSON, expiry time) from the persistent tier, or None
+        """
+        connection = self.connection()
+        if connection is None:
+            return None
+        row = connection.execute('SELECT status, response, expires FROM tracking_cache WHERE carrier = ? AND tracking_number = ? AND (expires IS NULL OR expires > ?)', key + (now,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def remember(self, key, entry):
+        """
+        Adds an entry to the memory tier, dropping the least recently used ones over max_entries or max_bytes.
+        Lock held by the caller
+        :param key:
+        :param entry:
+        :return:
+        """
+        self.forget(key)
+        if len(entry[1]) > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.memory_bytes += len(entry[1])
+        while len(self.entries) > self.max_entries or self.memory_bytes > self.max_bytes:
+            self.forget(next(iter(self.entries)))
+
+    def forget(self, key):
+        """
+        Drops an entry of the memory tier, if it is there. Lock held by the caller
+        :param key:
+        :return:
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= len(entry[1])
+
+    def put(self, carrier, tracking_number, response, status):
+        """
+        Caches a tracking response
+        :param carrier:
+        :param tracking_number:
+        :param response: dict returned by send_tracking_query
+        :param status: One of the STATUS_ constants. None if it could not be parsed, in which case nothing is cached
+        :return: True if the response was cached
+        """
+        if status is None or not response:
+            return False
+
+        key = (carrier, normalize_tracking_number(tracking_number))
+        now = time.time()
+        ttl = self.ttl(status)
+        entry = (status, json.dumps(response), None if ttl is None else now + ttl)
+        with self.lock:
+            self.remember(key, entry)
+            self.stores += 1
+
+        connection = self.connection()
+        if connection is not None:
+            connection.execute('INSERT OR REPLACE INTO tracking_cache (carrier, tracking_number, status, response, stored, expires) VALUES (?, ?, ?, ?, ?, ?)', key + (status, entry[1], now, entry[2]))
+        logger.debug("Cached %s %s response (%s) for %s seconds", carrier, tracking_number, status, ttl)
+        return True
+
+    def invalidate(self, carrier, tracking_number):
+        """
+        :param carrier:
+        :param tracking_number:
+        :return:
+        """
+        key = (carrier, normalize_tracking_number(tracking_number))
+        with self.lock:
+            self.forget(key)
+        connection = self.connection()
+        if connection is not None:
+            connection.execute('DELETE FROM tracking_cache WHERE carrier = ? AND tracking_number = ?', key)
+
+    def purge_expired(self):
+        """
+        Removes the expired responses from both tiers
+        :return:
+        """
+        now = time.time()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[2] is not None and entry[2] <= now]:
+                self.forget(key)
+        connection = self.connection()
+        if connection is not None:
+            connection.execute('DELETE FROM tracking_cache WHERE expires IS NOT NULL AND expires <= ?', (now,))
+
+    def clear(self):
+        """
+        Empties both tiers and resets the counters
+        :return:
+        """
+        with self.lock:
+            self.entries.clear()
+            self.memory_bytes = 0
+            self.hits = self.persistent_hits = self.misses = self.stores = self.bypasses = 0
+        connection = self.connection()
+        if connection is not None:
+            connection.execute('DELETE FROM tracking_cache')
+
+    def stats(self):
+        """
+        :return: dict of counters, eg: {"hits": 10, "persistent_hits": 2, "misses": 3, "stores": 3, "bypasses": 0, "entries": 15, "memory_bytes": 81920, "hit_ratio": 0.8}
+        """
+        with self.lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                'hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'bypasses': self.bypasses,
+                'entries': len(self.entries),
+                'memory_bytes': self.memory_bytes,
+                'hit_ratio': (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,253 @@
+"""
+Bulk tracking from the command line. Reads tracking numbers from a file or stdin, one per line, optionally
+preceded by the carrier ("ups 1Z97015F0341620620" or "fedex,975082865344"). Lines without a carrier are routed
+by the format of the tracking number. Writes one JSON object per line (NDJSON) as each result arrives:
+    {"tracking_number": "...", "carrier": "ups", "status": "in_transit", "response": {...}}
+with "error" instead of "response" for the tracking numbers that could not be tracked.
+A throughput summary is printed to stderr at the end.
+
+The input is read as the results go out, so memory stays the same whatever the size of the input.
+
+Run from the main directory, eg:
+    python -m TrackingSiteModules.TrackingCli tracking_numbers.txt --concurrency 8 > results.ndjson
+    cat tracking_numbers.txt | python -m TrackingSiteModules.TrackingCli --no-response
+    python -m TrackingSiteModules.TrackingCli tracking_numbers.txt --processes 4 > results.ndjson
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from CoreLibrary.CurlLogging import configure_logging
+from CoreLibrary.CurlProxyPool import ProxyPool
+from TrackingSiteModules import get_carrier_class, CARRIER_CLASSES
+from TrackingSiteModules.BulkTracking import tracking_result
+from TrackingSiteModules.CarrierDetection import detect_carrier
+
+# Named explicitly, run with -m its __name__ is __main__
+logger = logging.getLogger('TrackingSiteModules.TrackingCli')
+
+
+def parse_input_line(line, default_carrier=None):
+    """
+    :param line: "tracking_number", "carrier tracking_number" or "carrier,tracking_number"
+    :param default_carrier: Carrier of the lines without one. Detected from the tracking number if None
+    :return: (carrier or None if unknown, tracking number), or None for blank lines and # comments
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = line.replace(',', ' ').replace('\t', ' ').split(None, 1)
+    if len(fields) == 2 and fields[0].lower().replace('_curl', '') in CARRIER_CLASSES:
+        return fields[0].lower().replace('_curl', ''), fields[1].replace(' ', '')
+    tracking_number = line.replace(' ', '')
+    return default_carrier or detect_carrier(tracking_number), tracking_number
+
+
+class BulkTracker:
+    """
+    Groups the tracking numbers of each carrier into batches of the size its bulk query accepts, and keeps at most
+    `concurrency` batches in flight. Results are written as soon as their batch completes, by the thread that sent it,
+    so they are not held back while the input is slow to come
+    """
+
+    def __init__(self, output, concurrency=8, bypass_cache=False, include_response=True, proxy=None, proxy_pool=None, processes=0, proxy_file=None):
+        """
+        :param output: Text stream the NDJSON lines are written to
+        :param concurrency: Batches in flight at the same time. A batch is one request, unless its responses are cached
+        :param bypass_cache: Query every tracking number, even the ones with a cached response
+        :param include_response: Write the carrier response in each line, not only the status
+        :param proxy: IP:PORT or HOST:PORT, for all the carriers
+        :param proxy_pool: ProxyPool the requests draw their proxy from, when there is no proxy
+        :param processes: Worker processes of each carrier (see TrackingWorkerPool). 0 to track in this process only
+        :param proxy_file: File of proxies each worker process loads its ProxyPool from, with processes
+        """
+        self.output = output
+        self.concurrency = max(1, concurrency)
+        self.bypass_cache = bypass_cache
+        self.include_response = include_response
+        self.proxy = proxy
+        self.proxy_pool = proxy_pool
+        self.processes = processes
+        self.proxy_file = proxy_file
+        self.clients = {}
+        self.batches = {}  # carrier -> tracking numbers waiting for a full batch
+        self.slots = threading.Semaphore(self.concurrency)  # One per batch in flight, released once its results are written
+        self.lock = threading.Lock()  # Output and counters, written by the threads of the batches
+        self.executor = None
+        self.counts = {'tracked': 0, 'errors': 0, 'unknown': 0, 'batches': 0}
+        self.carrier_counts = {}
+
+    def client(self, carrier):
+        client = self.clients.get(carrier)
+        if client is None:
+            client = self.clients[carrier] = get_carrier_class(carrier)(proxy=self.proxy, proxy_pool=self.proxy_pool)
+        return client
+
+    def batch_size(self, carrier):
+        """
+        :param carrier:
+        :return: Tracking numbers sent in one request to the carrier
+        """
+        return self.client(carrier).bulk_chunk_size
+
+    def run(self, lines, default_carrier=None):
+        """
+        :param lines: Iterable of input lines
+        :param default_carrier: Carrier of the lines without one
+        :return: dict of counters
+        """
+        if self.processes:
+            return self.run_processes(lines, default_carrier)
+
+        start = time.perf_counter()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            for line in lines:
+                parsed = parse_input_line(line, default_carrier)
+                if parsed is None:
+                    continue
+                carrier, tracking_number = parsed
+                if carrier is None:
+                    with self.lock:
+                        self.counts['unknown'] += 1
+                        self.write({'tracking_number': tracking_number, 'carrier': None, 'error': 'Carrier not recognized'})
+                        self.output.flush()
+                    continue
+
+                batch = self.batches.setdefault(carrier, [])
+                batch.append(tracking_number)
+                if len(batch) >= self.batch_size(carrier):
+                    self.submit(carrier, self.batches.pop(carrier))
+
+            for carrier in list(self.batches):
+                self.submit(carrier, self.batches.pop(carrier))
+            # All the slots are free once the last batches are written
+            for _ in range(self.concurrency):
+                self.slots.acquire()
+            for _ in range(self.concurrency):
+                self.slots.release()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+        self.counts['elapsed'] = time.perf_counter() - start
+        return self.counts
+
+    def run_processes(self, lines, default_carrier=None):
+        """
+        run, with the tracking numbers sharded over worker processes by carrier. Each worker keeps `concurrency`
+        requests in flight, and encodes its results itself
+        :param lines: Iterable of input lines
+        :param default_carrier: Carrier of the lines without one
+        :return: dict of counters
+        """
+        from TrackingSiteModules.TrackingWorkerPool import TrackingWorkerPool
+
+        start = time.perf_counter()
+        items = (parsed for parsed in (parse_input_line(line, default_carrier) for line in lines) if parsed is not None)
+        with TrackingWorkerPool(processes=self.processes, threads=self.concurrency, bypass_cache=self.bypass_cache, include_response=self.include_response,
+                                client_options={'proxy': self.proxy}, proxy_file=self.proxy_file) as pool:
+            for position, line in pool.imap(items, as_json=True):
+                self.output.write(line)
+                self.output.write('\n')
+                self.output.flush()
+        self.counts = pool.counts
+        self.carrier_counts = pool.carrier_counts
+        self.counts['elapsed'] = time.perf_counter() - start
+        return self.counts
+
+    def submit(self, carrier, batch):
+        """
+        Sends a batch, after waiting for a slot if `concurrency` batches are already in flight
+        :param carrier:
+        :param batch:
+        :return:
+        """
+        self.slots.acquire()
+        client = self.client(carrier)
+        with self.lock:
+            self.counts['batches'] += 1
+        future = self.executor.submit(client.send_bulk_tracking_query, batch, max_concurrency=1, bypass_cache=self.bypass_cache)
+        future.add_done_callback(lambda future: self.complete(future, carrier, batch))
+
+    def complete(self, future, carrier, batch):
+        """
+        Writes the results of a completed batch, and frees its slot
+        :param future: Completed future of the batch
+        :param carrier:
+        :param batch:
+        :return:
+        """
+        try:
+            if future.cancelled():
+                return
+            client = self.client(carrier)
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error("Error while tracking %s %s tracking numbers: %s", len(batch), carrier, e)
+                results = {}
+                error = str(e) or e.__class__.__name__
+            else:
+                error = 'No response'
+
+            with self.lock:
+                for tracking_number in batch:
+                    result = tracking_result(carrier, client, tracking_number, results.get(tracking_number), error, self.include_response)
+                    self.carrier_counts[carrier] = self.carrier_counts.get(carrier, 0) + 1
+                    self.counts['errors' if 'error' in result else 'tracked'] += 1
+                    self.write(result)
+                self.output.flush()
+        finally:
+            self.slots.release()
+
+    def write(self, result):
+        self.output.write(json.dumps(result, separators=(',', ':')))
+        self.output.write('\n')
+
+
+def print_summary(counts, carrier_counts, stream=sys.stderr):
+    elapsed = counts['elapsed']
+    total = counts['tracked'] + counts['errors'] + counts['unknown']
+    per_carrier = ', '.join(f"{carrier}: {count}" for carrier, count in sorted(carrier_counts.items()))
+    print(f"{total} tracking numbers in {elapsed:.2f} s ({total / elapsed if elapsed else 0:.1f}/s), "
+          f"{counts['batches']} batches. tracked: {counts['tracked']}, errors: {counts['errors']}, "
+          f"unrecognized: {counts['unknown']}. {per_carrier}", file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-', help='File of tracking numbers, one per line. - for stdin (default)')
+    parser.add_argument('--carrier', choices=sorted(CARRIER_CLASSES), help='Carrier of the lines without one, instead of detecting it')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at the same time')
+    parser.add_argument('--proxy', help='IP:PORT or HOST:PORT')
+    parser.add_argument('--proxy-file', help='File of proxies, one per line. Requests are spread over the healthy ones')
+    parser.add_argument('--processes', type=int, default=0, help='Worker processes of each carrier, to use several cores. '
+                                                                 'Each one keeps --concurrency requests in flight. 0 (default) for a single process')
+    parser.add_argument('--bypass-cache', action='store_true', help='Query every tracking number, even the ones with a cached response')
+    parser.add_argument('--no-response', action='store_true', help='Only write the status of each tracking number, not the carrier response')
+    parser.add_argument('--log-level', default='WARNING', help='eg: INFO, DEBUG. Logs go to stderr')
+    args = parser.parse_args()
+
+    configure_logging(getattr(logging, args.log_level.upper(), logging.WARNING))
+
+    proxy_pool = ProxyPool.from_file(args.proxy_file) if args.proxy_file else None
+    tracker = BulkTracker(sys.stdout, concurrency=args.concurrency, bypass_cache=args.bypass_cache, include_response=not args.no_response, proxy=args.proxy, proxy_pool=proxy_pool,
+                          processes=args.processes, proxy_file=args.proxy_file)
+    input_file = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        counts = tracker.run(input_file, default_carrier=args.carrier)
+    except KeyboardInterrupt:
+        # Results already written stay valid NDJSON
+        sys.exit(130)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+    print_summary(counts, tracker.carrier_counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from TrackingSiteModules.BulkTracking import normalize_tracking_number
+from TrackingSiteModules.TrackingCache import STATUS_DELIVERED, STATUS_EXCEPTION, STATUS_IN_TRANSIT, STATUS_PENDING
+
+logger = logging.getLogger(__name__)
+
+# status -> (seconds between polls right after the shipment changed, longest seconds between polls once it stopped changing).
+# None is for polls that gave no status (errors, timeouts). Delivered shipments are not polled anymore
+DEFAULT_INTERVALS = {
+    STATUS_PENDING: (3600, 6 * 3600),
+    STATUS_IN_TRANSIT: (1800, 6 * 3600),
+    STATUS_EXCEPTION: (900, 3 * 3600),
+    None: (600, 3 * 3600),
+}
+
+
+def response_fingerprint(response, client=None):
+    """
+    :param response: Tracking response
+    :param client: Client of the carrier. Only what its tracking_progress extracts (status and scan events) is digested,
+    not the whole response: the USPS page, for one, changes with every request
+    :return: Digest of the response, used to tell if the shipment changed since the previous poll
+    """
+    tracking_progress = getattr(client, 'tracking_progress', None)
+    if tracking_progress is not None:
+        response = tracking_progress(response)
+    return hashlib.sha1(json.dumps(response, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class TrackedShipment:
+    """
+    A shipment followed by the TrackingScheduler, and what its last polls found
+    """
+    # Hundreds of thousands of these can be tracked at once
+    __slots__ = ('carrier', 'tracking_number', 'key', 'status', 'fingerprint', 'interval', 'next_due', 'last_poll', 'last_change', 'polls', 'errors')
+
+    def __init__(self, carrier, tracking_number):
+        """
+        :param carrier: Carrier id of the client, eg: "ups_curl"
+        :param tracking_number:
+        """
+        self.carrier = carrier
+        self.tracking_number = tracking_number
+        self.key = (carrier, normalize_tracking_number(tracking_number))
+        self.status = None
+        self.fingerprint = None
+        self.interval = None  # Seconds until the next poll, as last computed
+        self.next_due = None  # Unix time of the next poll. None while the shipment is being polled
+        self.last_poll = None
+        self.last_change = None
+        self.polls = 0
+        self.errors = 0  # Polls in a row without a status
+
+    def __repr__(self):
+        return f"<TrackedShipment {self.carrier} {self.tracking_number} {self.status}>"
+
+
+class TrackingScheduler:
+    """
+    Polls many shipments with the send_tracking_query of the carrier classes, each at its own pace.
+    Shipments are kept in a priority queue by the time their next poll is due. A shipment that just changed is
+    polled again soon, one that did not change is polled less and less often (up to a maximum per status),
+    and a delivered shipment is not polled anymore. All the polls share one requests per second budget.
+    eg: scheduler = TrackingScheduler(requests_per_second=5, on_change=save_status)
+        scheduler.track("ups", "1Z97015F0341620620")
+        scheduler.start()
+    """
+
+    def __init__(self, requests_per_second=5, clients=None, intervals=None, backoff=2, jitter=0.1, fingerprint=None, on_change=None, max_concurrency=4):
+        """
+        :param requests_per_second: Tracking queries sent per second at most, all carriers together
+        :param clients: dict of carrier -> client instance, eg: {"ups": UPSTrackingApi(proxy=proxy)}.
+        Clients of the other carriers are created when a first shipment of the carrier is tracked
+        :param intervals: dict of status -> (interval after a change, longest interval) in seconds, overriding DEFAULT_INTERVALS
+        :param backoff: The interval is multiplied by this after each poll where the shipment did not change
+        :param jitter: Each interval is randomly lengthened or shortened by up to this fraction, to spread the polls
+        :param fingerprint: Function telling responses apart, called with the response. Defaults to response_fingerprint
+        with the client of the carrier
+        :param on_change: Called with (shipment, response) when a poll finds the shipment changed, delivery included
+        :param max_concurrency: Polling threads of start()
+        """
+        self.requests_per_second = requests_per_second
+        self.clients = {}
+        for carrier, client in (clients or {}).items():
+            self.clients[carrier] = self.clients[client.carrier] = client
+        self.intervals = dict(DEFAULT_INTERVALS)
+        self.intervals.update(intervals or {})
+        self.backoff = backoff
+        self.jitter = jitter
+        self.fingerprint = fingerprint
+        self.on_change = on_change
+        self.max_concurrency = max_concurrency
+
+        self.shipments = {}  # (carrier, normalized tracking number) -> TrackedShipment
+        self.queue = []  # heap of (due time, sequence, TrackedShipment). Entries of rescheduled shipments are skipped
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.clients_lock = threading.Lock()
+        self.budget_lock = threading.Lock()
+        self.next_send_time = 0
+        self.stopped = threading.Event()
+        self.threads = []
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+        self.delivered = 0
+
+    def client(self, carrier):
+        """
+        :param carrier: eg: "ups", "ups_curl"
+        :return: Client of the carrier, created on first use
+        """
+        with self.clients_lock:
+            client = self.clients.get(carrier)
+            if client is None:
+                from TrackingSiteModules import get_carrier_class
+                client = get_carrier_class(carrier)()
+                self.clients[carrier] = self.clients.setdefault(client.carrier, client)
+                client = self.clients[carrier]
+            return client
+
+    def track(self, carrier, tracking_number, due=None):
+        """
+        Starts polling a shipment. Tracking a shipment already tracked does nothing
+        :param carrier: eg: "ups"
+        :param tracking_number:
+        :param due: Unix time of the first poll. Now if None
+        :return: TrackedShipment
+        """
+        client = self.client(carrier)
+        key = (client.carrier, normalize_tracking_number(tracking_number))
+        with self.condition:
+            shipment = self.shipments.get(key)
+            if shipment is None:
+                shipment = self.shipments[key] = TrackedShipment(client.carrier, tracking_number)
+                self.schedule(shipment, time.time() if due is None else due)
+        return shipment
+
+    def untrack(self, carrier, tracking_number):
+        """
+        Stops polling a shipment
+        :param carrier:
+        :param tracking_number:
+        :return: The TrackedShipment, or None if it was not tracked
+        """
+        key = (self.client(carrier).carrier, normalize_tracking_number(tracking_number))
+        with self.condition:
+            return self.shipments.pop(key, None)
+
+    def schedule(self, shipment, due):
+        """
+        Queues the next poll of a shipment. Condition held by the caller
+        :param shipment:
+        :param due: Unix time
+        :return:
+        """
+        shipment.next_due = due
+        heapq.heappush(self.queue, (due, next(self.sequence), shipment))
+        self.condition.notify()
+
+    def is_current(self, entry):
+        """
+        :param entry: Queue entry
+        :return: False if the shipment was rescheduled, untracked or is being polled since the entry was queued
+        """
+        due, _, shipment = entry
+        return shipment.next_due == due and self.shipments.get(shipment.key) is shipment
+
+    def next_due_shipment(self, block=True):
+        """
+        Takes the shipment whose poll is due first out of the queue
+        :param block: Wait until a poll is due. Otherwise return None if none is due now
+        :return: TrackedShipment, or None if there is none due (or the scheduler was stopped while waiting)
+        """
+        with self.condition:
+            while not self.stopped.is_set():
+                while self.queue and not self.is_current(self.queue[0]):
+                    heapq.heappop(self.queue)
+
+                wait = None
+                if self.queue:
+                    due, _, shipment = self.queue[0]
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self.queue)
+                        shipment.next_due = None
+                        return shipment
+
+                if not block:
+                    return None
+                self.condition.wait(wait)
+        return None
+
+    def wait_for_budget(self):
+        """
+        Waits for the turn of the next request within requests_per_second
+        :return: False if the scheduler was stopped while waiting
+        """
+        with self.budget_lock:
+            now = time.monotonic()
+            send_at = max(now, self.next_send_time)
+            self.next_send_time = send_at + 1 / self.requests_per_second
+        if send_at > now:
+            return not self.stopped.wait(send_at - now)
+        return not self.stopped.is_set()
+
+    def poll(self, shipment):
+        """
+        Sends the tracking query of a shipment and schedules its next poll
+        :param shipment: TrackedShipment, out of the queue
+        :return: Tracking response, None if the query failed
+        """
+        client = self.client(shipment.carrier)
+        try:
+            # Always a fresh response. It still refreshes the tracking cache for everyone else
+            response = client.send_tracking_query(shipment.tracking_number, bypass_cache=True)
+        except Exception as e:
+            logger.error("Error while polling %s %s: %s", shipment.carrier, shipment.tracking_number, e)
+            response = None
+        status = client.tracking_status(response) if response else None
+        self.update(shipment, response, status)
+        return response
+
+    def update(self, shipment, response, status, now=None):
+        """
+        Records what a poll found, and schedules the next poll: soon after a change, later and later without one,
+        never once delivered
+        :param shipment:
+        :param response:
+        :param status: Status parsed from the response, None if it has none
+        :param now:
+        :return:
+        """
+        now = now or time.time()
+        shipment.polls += 1
+        shipment.last_poll = now
+        changed = False
+
+        if status is None:
+            shipment.errors += 1
+            first, longest = self.intervals[None]
+            interval = min(first * self.backoff ** (shipment.errors - 1), longest)
+        else:
+            shipment.errors = 0
+            if self.fingerprint is not None:
+                fingerprint = self.fingerprint(response)
+            else:
+                fingerprint = response_fingerprint(response, self.client(shipment.carrier))
+            first, longest = self.intervals.get(status, self.intervals[STATUS_IN_TRANSIT])
+            changed = status != shipment.status or fingerprint != shipment.fingerprint
+            if changed:
+                shipment.status = status
+                shipment.fingerprint = fingerprint
+                shipment.last_change = now
+                interval = first
+            else:
+                interval = min(max(shipment.interval * self.backoff, first), longest)
+        shipment.interval = interval
+
+        with self.condition:
+            self.polls += 1
+            self.errors += status is None
+            self.changes += changed
+            tracked = self.shipments.get(shipment.key) is shipment
+            if status == STATUS_DELIVERED:
+                self.delivered += 1
+                if tracked:
+                    del self.shipments[shipment.key]
+            elif tracked:
+                self.schedule(shipment, now + interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+        if changed and self.on_change is not None:
+            try:
+                self.on_change(shipment, response)
+            except Exception as e:
+                logger.error("Error in on_change for %s %s: %s", shipment.carrier, shipment.tracking_number, e)
+
+    def run_pending(self, max_polls=None):
+        """
+        Polls the shipments that are due now, within the requests per second budget, in the calling thread.
+        eg: from a cron job
+        :param max_polls: Stop after this many polls
+        :return: Number of shipments polled
+        """
+        polled = 0
+        while max_polls is None or polled < max_polls:
+            shipment = self.next_due_shipment(block=False)
+            if shipment is None:
+                break
+            if not self.wait_for_budget():
+                self.requeue(shipment)
+                break
+            self.poll(shipment)
+            polled += 1
+        return polled
+
+    def requeue(self, shipment):
+        with self.condition:
+            self.schedule(shipment, time.time())
+
+    def run(self):
+        """
+        Polling loop of each thread of start()
+        :return:
+        """
+        while not self.stopped.is_set():
+            shipment = self.next_due_shipment()
+            if shipment is None:
+                continue
+            if not self.wait_for_budget():
+                self.requeue(shipment)
+                return
+            self.poll(shipment)
+
+    def start(self):
+        """
+        Starts max_concurrency polling threads
+        :return:
+        """
+        if any(thread.is_alive() for thread in self.threads):
+            return
+        self.stopped.clear()
+        self.threads = [threading.Thread(target=self.run, name=f'TrackingScheduler-{index}', daemon=True) for index in range(max(1, self.max_concurrency))]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the polling threads. Polls in progress are completed first
+        :param timeout:
+        :return:
+        """
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def __len__(self):
+        return len(self.shipments)
+
+    def stats(self):
+        """
+        :return: dict of counters, eg: {"tracked": 1000, "polls": 250, "changes": 40, "errors": 2, "delivered": 12}
+        """
+        with self.condition:
+            return {'tracked': len(self.shipments), 'polls': self.polls, 'changes': self.changes, 'errors': self.errors, 'delivered': self.delivered}
@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+
+from TrackingSiteModules import get_carrier_class
+from TrackingSiteModules.BulkTracking import tracking_result
+from TrackingSiteModules.CarrierDetection import detect_carrier
+
+logger = logging.getLogger(__name__)
+
+# Client of the worker process, created by init_worker with the session handed over by the pool
+worker_client = None
+
+
+def init_worker(carrier, session, client_options, proxy_file=None, rate_limit_db=None):
+    """
+    Runs once in each worker process, before its first batch. The session obtained by the pool becomes the session
+    of the process, so the client starts warm: no cookie jar lookup, no bootstrap
+    :param carrier: "ups", "fedex" or "usps"
+    :param session: CarrierSession of the carrier
+    :param client_options: Keyword arguments of the client class
+    :param proxy_file: File of proxies the worker loads its ProxyPool from
+    :param rate_limit_db: SQLite file of the RateLimiter shared by the workers
+    :return:
+    """
+    global worker_client
+    from TrackingSiteModules.CarrierSessions import CarrierSessionRegistry
+
+    client_options = dict(client_options)
+    if proxy_file:
+        from CoreLibrary.CurlProxyPool import ProxyPool
+        client_options['proxy_pool'] = ProxyPool.from_file(proxy_file)
+    if rate_limit_db:
+        from CoreLibrary.CurlRateLimiter import RateLimiter
+        client_options['rate_limiter'] = RateLimiter(database_path=rate_limit_db)
+    CarrierSessionRegistry.shared().put(session)
+    worker_client = get_carrier_class(carrier)(**client_options)
+    logger.debug("Worker %s started for %s with %s", os.getpid(), carrier, session)
+
+
+def track_in_worker(carrier, tracking_numbers, threads, bypass_cache, include_response, as_json):
+    """
+    Tracks one batch in a worker process. The responses are decoded, parsed and, with as_json, encoded there,
+    the parent only gets the results
+    :param carrier:
+    :param tracking_numbers:
+    :param threads: Requests of the batch in flight at the same time
+    :param bypass_cache:
+    :param include_response: Put the carrier response in the results, not only the status
+    :param as_json: Return each result as its JSON line rather than a dict
+    :return: List of (tracked, result) in the order of tracking_numbers, tracked being False for errors
+    """
+    try:
+        responses = worker_client.send_bulk_tracking_query(tracking_numbers, max_concurrency=threads, bypass_cache=bypass_cache)
+        error = 'No response'
+    except Exception as e:
+        logger.error("Error while tracking %s %s tracking numbers: %s", len(tracking_numbers), carrier, e)
+        responses = {}
+        error = str(e) or e.__class__.__name__
+
+    results = []
+    for tracking_number in tracking_numbers:
+        result = tracking_result(carrier, worker_client, tracking_number, responses.get(tracking_number), error, include_response)
+        results.append(('error' not in result, json.dumps(result, separators=(',', ':')) if as_json else result))
+    return results
+
+
+class TrackingWorkerPool:
+    """
+    Tracks tracking numbers in several processes, so the decoding and parsing of the responses are spread over
+    the cores instead of being capped by one Python process.
+    The input is sharded by carrier: each carrier gets its own worker processes, which only import its client
+    and only hold its session. The session is obtained once, by the pool, and handed to every worker as it starts,
+    so the workers send tracking queries right away instead of each loading or bootstrapping cookies.
+    Results are yielded as their batch completes, with the position of their tracking number in the input.
+    Workers are started with spawn by default: forked workers would share the connections of the parent.
+    eg: with TrackingWorkerPool(processes=4) as pool:
+            for index, result in pool.imap(tracking_numbers):
+                print(index, result["status"])
+    """
+
+    def __init__(self, processes=None, threads=4, batch_size=None, max_pending=None, bypass_cache=False, include_response=True,
+                 client_options=None, proxy_file=None, rate_limit_db=None, start_method='spawn'):
+        """
+        :param processes: Worker processes of each carrier, or dict of carrier -> worker processes.
+        Defaults to the number of CPUs. The workers of a carrier are only started once it shows up in the input
+        :param threads: Requests in flight at the same time in each worker
+        :param batch_size: Tracking numbers sent to a worker at once. Defaults to one request per thread:
+        threads * bulk_chunk_size of the carrier
+        :param max_pending: Batches sent to the workers and not completed yet, all carriers together.
+        Reading the input waits past it, so memory stays bounded. Defaults to 2 per worker
+        :param bypass_cache: Query every tracking number, even the ones with a cached response
+        :param include_response: Put the carrier response in the results, not only the status
+        :param client_options: Keyword arguments of the client classes, eg: {"proxy": "IP:PORT"}. Must be picklable
+        :param proxy_file: File of proxies, one per line. Each worker loads its own ProxyPool from it
+        :param rate_limit_db: SQLite file of a RateLimiter shared by all the workers (see CoreLibrary.CurlRateLimiter).
+        Defaults to the CURL_RATE_LIMIT_DB environment variable. Without either, each worker paces its requests alone,
+        so the carrier site gets up to `processes` times the rate of one process
+        :param start_method: multiprocessing start method of the workers
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = max(1, threads)
+        self.fixed_batch_size = batch_size
+        self.max_pending = max_pending
+        self.bypass_cache = bypass_cache
+        self.include_response = include_response
+        self.client_options = dict(client_options or {})
+        self.proxy_file = proxy_file
+        self.rate_limit_db = rate_limit_db or os.environ.get('CURL_RATE_LIMIT_DB')
+        self.start_method = start_method
+        self.clients = {}  # carrier -> client of the pool, holding the session handed to the workers
+        self.executors = {}  # carrier -> ProcessPoolExecutor
+        self.counts = {'tracked': 0, 'errors': 0, 'unknown': 0, 'batches': 0}
+        self.carrier_counts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def worker_count(self, carrier):
+        if isinstance(self.processes, dict):
+            return max(1, self.processes.get(carrier, 1))
+        return max(1, self.processes)
+
+    def batch_size(self, carrier):
+        """
+        :param carrier:
+        :return: Tracking numbers sent to a worker of the carrier at once
+        """
+        if self.fixed_batch_size:
+            return self.fixed_batch_size
+        client = self.clients.get(carrier)
+        per_request = client.bulk_chunk_size if client is not None else 1
+        return self.threads * per_request
+
+    def pending_limit(self):
+        if self.max_pending:
+            return self.max_pending
+        return 2 * sum(self.worker_count(carrier) for carrier in self.executors)
+
+    def executor(self, carrier):
+        """
+        Worker processes of a carrier. Started on first use, after getting the session of the carrier
+        :param carrier:
+        :return: ProcessPoolExecutor
+        """
+        executor = self.executors.get(carrier)
+        if executor is not None:
+            return executor
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        client_options = dict(self.client_options)
+        if self.proxy_file:
+            from CoreLibrary.CurlProxyPool import ProxyPool
+            client_options['proxy_pool'] = ProxyPool.from_file(self.proxy_file)
+        client = self.clients[carrier] = get_carrier_class(carrier)(**client_options)
+        session = client.current_session()
+        workers = self.worker_count(carrier)
+        logger.info("Starting %s %s workers with %s", workers, carrier, session)
+        executor = self.executors[carrier] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(self.start_method), initializer=init_worker,
+                                                                 initargs=(carrier, session, self.client_options, self.proxy_file, self.rate_limit_db))
+        return executor
+
+    def route(self, item, default_carrier=None):
+        """
+        :param item: Tracking number, or (carrier, tracking number)
+        :param default_carrier: Carrier of the tracking numbers given alone. Detected if None
+        :return: (carrier or None if unknown, tracking number)
+        """
+        if isinstance(item, str):
+            return default_carrier or detect_carrier(item), item
+        carrier, tracking_number = item
+        return carrier or default_carrier or detect_carrier(tracking_number), tracking_number
+
+    def imap(self, items, default_carrier=None, as_json=False):
+        """
+        Tracks tracking numbers of any carrier in the worker processes. The input is read as the results go out
+        :param items: Iterable of tracking numbers, or of (carrier, tracking number)
+        :param default_carrier: Carrier of the tracking numbers given alone. Detected if None
+        :param as_json: Yield each result as its JSON line, encoded in the worker, rather than a dict
+        :return: Generator of (position in the input, result) as the batches complete, results shaped like
+        {"tracking_number": ..., "carrier": ..., "status": ..., "response": ...}, with "error" for the tracking numbers
+        that could not be tracked
+        """
+        pending = {}  # future -> (executor, carrier, positions, tracking numbers, as_json)
+        batches = {}  # carrier -> (positions, tracking numbers) waiting for a full batch
+        for index, item in enumerate(items):
+            carrier, tracking_number = self.route(item, default_carrier)
+            if carrier is None:
+                self.counts['unknown'] += 1
+                result = {'tracking_number': tracking_number, 'carrier': None, 'error': 'Carrier not recognized'}
+                yield index, json.dumps(result, separators=(',', ':')) if as_json else result
+                continue
+
+            # Gets the session of the carrier and starts its workers on its first tracking number
+            self.executor(carrier)
+            positions, batch = batches.setdefault(carrier, ([], []))
+            positions.append(index)
+            batch.append(tracking_number)
+            if len(batch) >= self.batch_size(carrier):
+                yield from self.submit(pending, carrier, *batches.pop(carrier), as_json=as_json)
+
+        for carrier in list(batches):
+            yield from self.submit(pending, carrier, *batches.pop(carrier), as_json=as_json)
+        yield from self.complete(pending, all_pending=True)
+
+    def submit(self, pending, carrier, positions, batch, as_json=False):
+        """
+        Sends a batch to the workers of its carrier, after yielding the results of completed batches
+        if max_pending batches are already pending
+        :return: Generator of (position in the input, result)
+        """
+        while pending and len(pending) >= self.pending_limit():
+            yield from self.complete(pending)
+        executor = self.executor(carrier)
+        future = executor.submit(track_in_worker, carrier, batch, self.threads, self.bypass_cache, self.include_response, as_json)
+        pending[future] = (executor, carrier, positions, batch, as_json)
+        self.counts['batches'] += 1
+
+    def complete(self, pending, all_pending=False):
+        """
+        Waits for at least one pending batch (every one with all_pending)
+        :return: Generator of (position in the input, result) of the completed batches
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        while pending:
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                executor, carrier, positions, batch, as_json = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # The worker died (eg: killed by the OS), the batch gets an error and the next ones a new worker
+                    logger.error("Worker of %s failed while tracking %s tracking numbers: %s", carrier, len(batch), e)
+                    self.restart(carrier, executor)
+                    error = str(e) or e.__class__.__name__
+                    results = []
+                    for tracking_number in batch:
+                        result = {'tracking_number': tracking_number, 'carrier': carrier, 'error': error}
+                        results.append((False, json.dumps(result, separators=(',', ':')) if as_json else result))
+
+                self.carrier_counts[carrier] = self.carrier_counts.get(carrier, 0) + len(results)
+                for position, (tracked, result) in zip(positions, results):
+                    self.counts['tracked' if tracked else 'errors'] += 1
+                    yield position, result
+            if not all_pending:
+                return
+
+    def restart(self, carrier, executor):
+        """
+        Drops the workers of a carrier once one of them died, the next batch starts new ones.
+        The other batches pending in the dead workers fail too
+        :param carrier:
+        :param executor: ProcessPoolExecutor the failed batch was sent to
+        :return:
+        """
+        if self.executors.get(carrier) is executor:
+            del self.executors[carrier]
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        """
+        Stops the worker processes. Batches not started yet are dropped
+        :return:
+        """
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.executors.clear()
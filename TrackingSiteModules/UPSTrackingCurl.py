@@ -1,110 +1,52 @@
+import json
+import logging
 import re
-import os
-import time
-from CoreLibrary.PyCurlRequest import CurlRequests
-import pickle
+from TrackingSiteModules.CarrierClient import CarrierTrackingApi
+from TrackingSiteModules.BulkTracking import get_package_list
+from TrackingSiteModules.TrackingCache import status_from_text, STATUS_DELIVERED, STATUS_EXCEPTION, STATUS_IN_TRANSIT, STATUS_PENDING
 
+logger = logging.getLogger(__name__)
 
-class UPSTrackingApi:
+# packageStatusType of the UPS tracking responses
+PACKAGE_STATUS_TYPES = {
+    'D': STATUS_DELIVERED,
+    'I': STATUS_IN_TRANSIT,
+    'P': STATUS_IN_TRANSIT,
+    'X': STATUS_EXCEPTION,
+    'M': STATUS_PENDING,
+}
+
+
+class UPSTrackingApi(CarrierTrackingApi):
     """
     Main purpose of this class is return the UPS specific curl_headers
     """
+    carrier = 'ups_curl'
+    cookie_domain = 'ups.com'
+    bootstrap_url = 'https://www.ups.com/track?loc=null&tracknum=1Z97015F0341620620&requester=WT/trackdetails'
     tracking_api_url = 'https://www.ups.com/track/api/Track/GetStatus?loc=en_US'
+    # Most tracking numbers the UPS site accepts in one request
+    bulk_chunk_size = 25
+    # Where the packages are in a tracking response, and the key of their tracking number
+    package_list_path = ('trackDetails',)
+    package_number_key = 'trackingNumber'
+    x_xsrf_token = None  # Derived from the cookies, sent with every tracking query
 
-    def __init__(self, cookies_dict=None, proxy=None):
-        self.cookies_dict = cookies_dict
-        self.proxy = proxy  # IP:PORT or HOST:PORT
-        self.carrier = 'ups_curl'
-
-        self.x_xsrf_token = None
-
-        # Set the cookies and the token for the request here
-        self.set_cookies_dict()
-        self.set_x_xsrf_token()
-
-    def load_cookie(self):
-        """
-        Loads cookies from a cookie pickle file saved to the disk
-        :return:
-        """
-        cookie = None
-        if os.path.exists(f'{self.carrier}.cookie'):
-            x = os.stat(f'{self.carrier}.cookie')
-            age = (time.time() - x.st_mtime)
-            if age < 86400:
-                print(f"INFO: Cookie on disk is less than a day old")
-                with open(f'{self.carrier}.cookie', 'rb') as cookie_store:
-                    cookie = pickle.load(cookie_store)
-                    if cookie:
-                        print("INFO: Cookie loaded from disk")
-                        self.cookies_dict = cookie
-            else:
-                print(f"INFO: Cookie is more than a day old. Will get new one")
-
-        return cookie
-
-    def saveCookie(self, cookies_dict):
-        """
-        Function to save a dictionary of cookies as a pickle to the disk, which can be used for future requests
-        :param cookies_dict:
-        :return:
-        """
-        with open(f'{self.carrier}.cookie', 'wb') as cookie_store:
-            pickle.dump(cookies_dict, cookie_store)
-            print("INFO: Cookie saved")
-
-    def set_cookies_dict(self):
+    def session_tokens(self):
         """
-        This token can only be obtained via a browser session, or a prior curl session. See below.
-        Check if cookies are stored on local machine before trying to get a new one
-        :return:
+        :return: dict of the values derived from the cookies: the XSRF token
         """
-        cookie = self.load_cookie()
-        if cookie:
-            self.cookies_dict = cookie
-            return
-
-        print(f"INFO: UPS cookie not loaded from on disk. Will obtain new one from UPS site")
-        curl = CurlRequests(cookies_dict={}, headers_dict={})
-        rnd_link = 'https://www.ups.com/track?loc=null&tracknum=1Z97015F0341620620&requester=WT/trackdetails'
-        response = curl.send_curl_request(request_url=rnd_link, page_redirects=True, include=True)
-        cookie_regex = re.compile(r'Set-Cookie:\s(.+?=.+?);', flags=re.IGNORECASE)
-        cookies_list = cookie_regex.findall(str(response.get('response')))
-
-        cookie_dict_regex = re.compile(r'(.+?)=(.+)')
-        self.cookies_dict = {}
-        for cookie in cookies_list:
-            try:
-                name = cookie_dict_regex.search(cookie).group(1).strip()
-                print(f"INFO: Found cookie: {name}")
-            except:
-                print(f"ERROR Extracting cookie name")
-                name = None
-
-            try:
-                value = cookie_dict_regex.search(cookie).group(2).strip()
-                print(f"INFO: Found value of cookie {name}: {value}")
-            except:
-                print(f"ERROR Extracting cookie value")
-                value = None
-
-            if name and value:
-                self.cookies_dict[name] = value
-
-        print(f"\nINFO: Cookies found\n\t{self.cookies_dict}")
-        self.saveCookie(self.cookies_dict)
-
-        return
+        self.x_xsrf_token = None
+        self.set_x_xsrf_token()
+        return {'x_xsrf_token': self.x_xsrf_token}
 
-    def format_proxy(self):
+    def use_session(self, session):
         """
+        :param session: CarrierSession
         :return:
         """
-        if self.proxy:
-            curl_proxy = f"http://{self.proxy}"  # IP:PORT or HOST:PORT
-            print(f"INFO: Proxy set for request: {curl_proxy}")
-            return curl_proxy
-        return None
+        super().use_session(session)
+        self.x_xsrf_token = session.tokens.get('x_xsrf_token')
 
     def set_x_xsrf_token(self):
         """
@@ -116,16 +58,16 @@ class UPSTrackingApi:
             x_xsrf_token_regex = re.compile("X-XSRF-TOKEN-ST':\s+'(.+?)'")
             try:
                 self.x_xsrf_token = x_xsrf_token_regex.search(str(self.cookies_dict)).group(1).strip()
-                print(f'INFO: Found X-XSRF-TOKEN : {self.x_xsrf_token}')
+                logger.debug("Found X-XSRF-TOKEN: %s", self.x_xsrf_token)
             except Exception as e:
-                print(f"ERROR: Error extracting X-XSRF-TOKEN from cookies dict. DETAILS {e}")
+                logger.error("Error extracting X-XSRF-TOKEN from cookies dict. DETAILS %s", e)
         else:
-            print(f"ERROR: No cookies dict to get X-XSRF-TOKEN- from.")
+            logger.error("No cookies dict to get X-XSRF-TOKEN from.")
 
-    def base_headers_dict(self, tracking_number):
+    def static_headers_dict(self):
         """
-        Defines and returns curl_headers for Costco API requests.
-        This is the base setting for headers. All other header request settings derive from this one.
+        Headers that are the same for every tracking request. They are compiled once into curl arguments
+        and reused, only the Referer header changes between tracking numbers (see referer_header)
         :return: dictionary of curl_headers
         """
 
@@ -141,32 +83,74 @@ class UPSTrackingApi:
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Dest": "empty",
             "Accept-Language": "en-US,en;q=0.9",
-            "Referer": f"https://www.ups.com/track?loc=null&tracknum={tracking_number}&requester=WT/trackdetails",
             "X-XSRF-TOKEN": self.x_xsrf_token
 
         }
         return headers_dict
 
+    def referer_header(self, tracking_number):
+        """
+        :param tracking_number:
+        :return: Per request Referer header
+        """
+        return {"Referer": f"https://www.ups.com/track?loc=null&tracknum={tracking_number}&requester=WT/trackdetails"}
+
+    def base_headers_dict(self, tracking_number):
+        """
+        Defines and returns curl_headers for Costco API requests.
+        This is the base setting for headers. All other header request settings derive from this one.
+        :return: dictionary of curl_headers
+        """
+        headers_dict = self.static_headers_dict()
+        headers_dict.update(self.referer_header(tracking_number))
+        return headers_dict
+
     def tracking_request_body_data(self, tracking_number):
         """
         Formats data used in UPS tracking requests
         :return:
         """
-        data = '{"Locale":"en_US","TrackingNumber":["%s"],"Requester":"wt","consumerHub":""}' % tracking_number
-        return data
+        return self.bulk_tracking_request_body_data([tracking_number])
 
-    def send_tracking_query(self, tracking_number):
+    def bulk_tracking_request_body_data(self, tracking_numbers):
         """
-        Sends a tracking query to UPS
-        :param tracking_number:
-        :return: tracking response (JSON format)
+        Formats data used in UPS tracking requests for several tracking numbers at once
+        :param tracking_numbers: At most bulk_chunk_size tracking numbers
+        :return:
         """
+        data = '{"Locale":"en_US","TrackingNumber":%s,"Requester":"wt","consumerHub":""}' % json.dumps(list(tracking_numbers))
+        return data
 
-        headers_dict = self.base_headers_dict(tracking_number)
-        data = self.tracking_request_body_data(tracking_number)
-        curl = CurlRequests(cookies_dict=self.cookies_dict, headers_dict=headers_dict)
-        proxy = self.format_proxy()
+    def tracking_request_spec(self, tracking_numbers):
+        """
+        :param tracking_numbers: Tracking numbers sent in one request, at most bulk_chunk_size
+        :return: send_curl_request arguments of the tracking request
+        """
+        return {
+            "request_url": self.tracking_api_url,
+            "data": self.bulk_tracking_request_body_data(tracking_numbers),
+            "proxy": self.format_proxy(),
+            "extra_headers": self.referer_header(','.join(tracking_numbers)),
+        }
 
-        response = curl.send_curl_request(request_url=self.tracking_api_url, data=data, proxy=proxy)
+    def tracking_status(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: Status of the package (one of the TrackingCache STATUS_ constants), or None if the response has none
+        """
+        packages = get_package_list(response, self.package_list_path)
+        if not packages or not isinstance(packages[0], dict):
+            return None
+        package = packages[0]
+        return PACKAGE_STATUS_TYPES.get(package.get('packageStatusType')) or status_from_text(package.get('packageStatus'))
 
-        return response
+    def tracking_progress(self, response):
+        """
+        :param response: Tracking response of a single tracking number
+        :return: Status and scan events of the package, or None if the response has no package
+        """
+        packages = get_package_list(response, self.package_list_path)
+        if not packages or not isinstance(packages[0], dict):
+            return None
+        package = packages[0]
+        return {key: package.get(key) for key in ('packageStatus', 'packageStatusType', 'shipmentProgressActivities')}
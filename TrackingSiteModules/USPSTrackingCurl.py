@@ -1,97 +1,19 @@
-import os
-import re
-import pickle
-import time
-from CoreLibrary.PyCurlRequest import CurlRequests
+import logging
+from TrackingSiteModules.CarrierClient import CarrierTrackingApi
+from TrackingSiteModules.USPSTrackingParser import parse_tracking_page
 
+logger = logging.getLogger(__name__)
 
-class USPSTrackingApi:
+
+class USPSTrackingApi(CarrierTrackingApi):
     """
     Main purpose of this class is return the USPS specific curl_headers and send requests
     """
+    carrier = 'usps_curl'
+    cookie_domain = 'usps.com'
+    bootstrap_url = 'https://tools.usps.com/go/TrackConfirmAction?qtc_tLabels1=92001901795912912884327069'
     tracking_api_url = 'https://tools.usps.com/go/TrackConfirmAction?qtc_tLabels1='  # Tracking number is appended to this
 
-    def __init__(self, cookies_dict=None, proxy=None):
-        self.cookies_dict = cookies_dict
-        self.proxy = proxy  # IP:PORT or HOST:PORT
-        self.carrier = 'usps_curl'
-
-        # Set the cookies and the token for the request here
-        self.set_cookies_dict()
-
-    def load_cookie(self):
-        cookie = None
-        if os.path.exists(f'{self.carrier}.cookie'):
-            x = os.stat(f'{self.carrier}.cookie')
-            age = (time.time() - x.st_mtime)
-            if age < 86400:
-                print(f"INFO: Cookie on disk is less than a day old")
-                with open(f'{self.carrier}.cookie', 'rb') as cookie_store:
-                    cookie = pickle.load(cookie_store)
-                    if cookie:
-                        print("INFO: Cookie loaded from disk")
-                        self.cookies_dict = cookie
-            else:
-                print(f"INFO: Cookie is more than a day old. Will get new one")
-
-        return cookie
-
-    def saveCookie(self, cookies_dict):
-        with open(f'{self.carrier}.cookie', 'wb') as cookie_store:
-            pickle.dump(cookies_dict, cookie_store)
-            print("INFO: Cookie saved")
-
-    def set_cookies_dict(self):
-        """
-        This token can only be obtained via a browser session
-        Check if cookies are stored on local machine before trying to get a new one
-        :return:
-        """
-        cookie = self.load_cookie()
-        if cookie:
-            self.cookies_dict = cookie
-            return
-
-        print(f"INFO: USPS cookie not loaded from on disk. Will obtain new one from USPS site")
-        curl = CurlRequests(cookies_dict={}, headers_dict={})
-        rnd_link = 'https://tools.usps.com/go/TrackConfirmAction?qtc_tLabels1=92001901795912912884327069'
-        response = curl.send_curl_request(request_url=rnd_link, page_redirects=True, include=True)
-        cookie_regex = re.compile(r'Set-Cookie:\s(.+?=.+?);', flags=re.IGNORECASE)
-        cookies_list = cookie_regex.findall(str(response.get('response')))
-
-        cookie_dict_regex = re.compile(r'(.+?)=(.+)')
-        self.cookies_dict = {}
-        for cookie in cookies_list:
-            try:
-                name = cookie_dict_regex.search(cookie).group(1).strip()
-                print(f"INFO: Found cookie: {name}")
-            except:
-                print(f"ERROR Extracting cookie name")
-                name = None
-
-            try:
-                value = cookie_dict_regex.search(cookie).group(2).strip()
-                print(f"INFO: Found value of cookie {name}: {value}")
-            except:
-                print(f"ERROR Extracting cookie value")
-                value = None
-
-            if name and value:
-                self.cookies_dict[name] = value
-
-        print(f"\nINFO: Cookies found\n\t{self.cookies_dict}")
-        self.saveCookie(self.cookies_dict)
-
-    def format_proxy(self):
-        """
-        :return:
-        """
-        if self.proxy:
-            curl_proxy = f"http://{self.proxy}"  # IP:PORT or HOST:PORT
-            print(f"INFO: Proxy set for request: {curl_proxy}")
-            return curl_proxy
-        return None
-
     def base_headers_dict(self):
         """
         Defines and returns curl_headers for Costco API requests.
@@ -116,19 +38,51 @@ class USPSTrackingApi:
         }
         return headers_dict
 
-    def send_tracking_query(self, tracking_number):
+    def static_headers_dict(self):
         """
-        Sends a tracking query to USPS.
-        The response is in html format. The tracking status and detailed information can be scraped from the html response
-        :param tracking_number:
-        :return: html response containing tracking details
+        :return: Headers sent with every tracking query: the USPS tracking page is requested like a browser loads it
         """
+        return self.base_headers_dict()
 
-        headers_dict = self.base_headers_dict()
-        curl = CurlRequests(cookies_dict=self.cookies_dict, headers_dict=headers_dict)
+    def tracking_request_spec(self, tracking_numbers):
+        """
+        :param tracking_numbers: The tracking number, the USPS tracking page is queried for one tracking number at a time
+        :return: send_curl_request arguments of the tracking request
+        """
+        return {"request_url": f"{self.tracking_api_url}{tracking_numbers[0]}", "proxy": self.format_proxy()}
 
-        proxy = self.format_proxy()
-        url = f"{self.tracking_api_url}{tracking_number}"
-        response = curl.send_curl_request(request_url=url, proxy=proxy)
+    def parse_tracking_response(self, response):
+        """
+        :param response: Tracking response, {"response": html}
+        :return: Structured tracking details (see USPSTrackingParser.parse_tracking_page), or None if the page has none
+        """
+        page = response.get('response') if isinstance(response, dict) else None
+        if not isinstance(page, str):
+            return None
+        return parse_tracking_page(page)
 
-        return response
+    def tracking_status(self, response):
+        """
+        :param response: Tracking response, {"response": html}
+        :return: Status of the package (one of the TrackingCache STATUS_ constants), or None if the page has none
+        """
+        tracking_details = self.parse_tracking_response(response)
+        return tracking_details['status_category'] if tracking_details else None
+
+    def tracking_progress(self, response):
+        """
+        :param response: Tracking response, {"response": html}
+        :return: Status and events parsed from the page, or None if the page has none.
+        The rest of the page has tokens that change with every request
+        """
+        tracking_details = self.parse_tracking_response(response)
+        return {key: tracking_details[key] for key in ('status', 'events')} if tracking_details else None
+
+    def send_parsed_tracking_query(self, tracking_number, bypass_cache=False):
+        """
+        Same as send_tracking_query, but returns the tracking details extracted from the page
+        :param tracking_number:
+        :param bypass_cache: Always query USPS. The response still replaces the cached one
+        :return: dict of status, events ... (see USPSTrackingParser.parse_tracking_page), or None if the page has no tracking details
+        """
+        return self.parse_tracking_response(self.send_tracking_query(tracking_number, bypass_cache))
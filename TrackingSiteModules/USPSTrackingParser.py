@@ -0,0 +1,115 @@
+import html as html_module
+import re
+from TrackingSiteModules.TrackingCache import status_from_text, STATUS_DELIVERED
+
+# The tracking section starts with the track bar and ends where the product information starts.
+# Nothing outside of it (menus, scripts, footer: most of the page) is scanned
+SECTION_START = 'class="track-bar-container"'
+SECTION_END = 'class="product_info"'
+
+TRACKING_NUMBER_REGEX = re.compile(r'<span class="tracking-number">(.*?)</span>', re.S)
+DELIVERY_STATUS_REGEX = re.compile(r'class="delivery_status".*?<strong>(.*?)</strong>', re.S)
+STATUS_FEED_REGEX = re.compile(r'class="status_feed".*?<p class="important">(.*?)</p>', re.S)
+# One pass over the tracking history: the start of each step, and the fields of the steps.
+# Both start with the same literal, which lets the regex engine skip quickly to the next candidate
+STEP_TOKEN_REGEX = re.compile(r'class="tb-(?:step[ "]|(status|status-detail|location|date)">(.*?)</p>)', re.S)
+DATE_REGEX = re.compile(r'([A-Za-z]+) (\d{1,2}), (\d{4})(?:,? (\d{1,2}):(\d{2}) ?([ap]m))?', re.I)
+TAG_REGEX = re.compile(r'<[^>]+>')
+
+MONTHS = {month: number for number, month in enumerate(('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december'), 1)}
+EVENT_FIELDS = {'status': 'category', 'status-detail': 'status', 'location': 'location', 'date': 'date'}
+
+
+def clean_text(text):
+    """
+    :param text: Inner html of an element
+    :return: Its text, tags removed, entities decoded and white space collapsed
+    """
+    if '<' in text:
+        text = TAG_REGEX.sub(' ', text)
+    if '&' in text:
+        text = html_module.unescape(text)
+    return ' '.join(text.split())
+
+
+def parse_event_date(text):
+    """
+    :param text: eg: "January 12, 2021, 11:07 am" or "January 12, 2021"
+    :return: ISO 8601 local time of the event location, eg: "2021-01-12T11:07:00", "2021-01-12" without time. None if not a date
+    """
+    match = DATE_REGEX.search(text)
+    if match is None:
+        return None
+    month_name, day, year, hour, minute, meridiem = match.groups()
+    month = MONTHS.get(month_name.lower())
+    if month is None:
+        return None
+    date = f"{year}-{month:02d}-{int(day):02d}"
+    if hour is None:
+        return date
+    hour = int(hour) % 12 + (12 if meridiem.lower() == 'pm' else 0)
+    return f"{date}T{hour:02d}:{minute}:00"
+
+
+def tracking_section(page):
+    """
+    :param page: html of the tracking page
+    :return: (start, end) positions of the tracking details in the page, or None if the page has none (eg: error page).
+    The patterns are run between these positions, the section is never copied out of the page
+    """
+    start = page.find(SECTION_START)
+    if start == -1:
+        return None
+    end = page.find(SECTION_END, start)
+    return start, end if end != -1 else len(page)
+
+
+def parse_tracking_page(page):
+    """
+    Extracts the tracking details from a USPS tracking page
+    :param page: html of the tracking page, as in the {"response": html} returned by send_tracking_query
+    :return: dict, eg:
+    {"tracking_number": "9405511899223197428490", "status": "Delivered, In/At Mailbox", "status_category": "delivered",
+     "delivered": True, "summary": "Your item was delivered in or at the mailbox at 11:07 am on ...",
+     "events": [{"status": "Delivered, In/At Mailbox", "category": "Delivered", "location": "SPRINGFIELD, IL 62704",
+                 "date": "January 12, 2021, 11:07 am", "timestamp": "2021-01-12T11:07:00"}, ...]}
+    Events are in the order of the page, latest first. None if the page has no tracking details
+    """
+    section = tracking_section(page)
+    if section is None:
+        return None
+    start, end = section
+
+    events = []
+    event = None
+    for match in STEP_TOKEN_REGEX.finditer(page, start, end):
+        field, value = match.groups()
+        if field is None:
+            event = {'status': None, 'category': None, 'location': None, 'date': None, 'timestamp': None}
+            events.append(event)
+        elif event is not None:
+            event[EVENT_FIELDS[field]] = clean_text(value) or None
+    # Steps without details, eg: the "See All Tracking History" toggle
+    events = [event for event in events if event['status'] or event['date']]
+    for event in events:
+        if event['date']:
+            event['timestamp'] = parse_event_date(event['date'])
+
+    tracking_number = TRACKING_NUMBER_REGEX.search(page, start, end)
+    delivery_status = DELIVERY_STATUS_REGEX.search(page, start, end)
+    status_feed = STATUS_FEED_REGEX.search(page, start, end)
+
+    status = clean_text(delivery_status.group(1)) if delivery_status else None
+    if not status and events:
+        status = events[0]['status']
+    # The category of the latest step tells more than the banner for some statuses, eg: "Alert"
+    category = events[0]['category'] if events else None
+    status_category = status_from_text(f"{category} {status}" if category and status else status)
+    return {
+        'tracking_number': clean_text(tracking_number.group(1)).replace(' ', '') if tracking_number else None,
+        'status': status,
+        'status_category': status_category,
+        'delivered': status_category == STATUS_DELIVERED,
+        'summary': clean_text(status_feed.group(1)) if status_feed else None,
+        'events': events,
+    }
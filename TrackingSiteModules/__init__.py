@@ -0,0 +1,64 @@
+import importlib
+import logging
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# Carrier clients, by carrier name. Their modules (and the curl machinery behind them) are only imported
+# when a carrier is first used, eg: TrackingSiteModules.UPSTrackingApi or get_carrier_class("ups")
+CARRIER_CLASSES = {
+    'ups': ('TrackingSiteModules.UPSTrackingCurl', 'UPSTrackingApi'),
+    'fedex': ('TrackingSiteModules.FedexTrackingCurl', 'FedexTrackingApi'),
+    'usps': ('TrackingSiteModules.USPSTrackingCurl', 'USPSTrackingApi'),
+}
+
+LAZY_ATTRIBUTES = {class_name: (module_name, class_name) for module_name, class_name in CARRIER_CLASSES.values()}
+LAZY_ATTRIBUTES.update({
+    'CarrierSession': ('TrackingSiteModules.CarrierSessions', 'CarrierSession'),
+    'CarrierSessionRegistry': ('TrackingSiteModules.CarrierSessions', 'CarrierSessionRegistry'),
+    'CarrierSessionRefresher': ('TrackingSiteModules.CarrierSessions', 'CarrierSessionRefresher'),
+    'TrackingCache': ('TrackingSiteModules.TrackingCache', 'TrackingCache'),
+    'TrackingScheduler': ('TrackingSiteModules.TrackingScheduler', 'TrackingScheduler'),
+    'TrackingWorkerPool': ('TrackingSiteModules.TrackingWorkerPool', 'TrackingWorkerPool'),
+    'detect_carrier': ('TrackingSiteModules.CarrierDetection', 'detect_carrier'),
+    'classify_tracking_numbers': ('TrackingSiteModules.CarrierDetection', 'classify_tracking_numbers'),
+    'track_many': ('TrackingSiteModules.CarrierDetection', 'track_many'),
+})
+
+
+def get_carrier_class(carrier):
+    """
+    :param carrier: "ups", "fedex" or "usps". The carrier ids of the clients ("ups_curl" ...) are accepted too
+    :return: Client class of the carrier, its module imported on first use
+    """
+    carrier = carrier.lower()
+    if carrier.endswith('_curl'):
+        carrier = carrier[:-len('_curl')]
+    try:
+        module_name, class_name = CARRIER_CLASSES[carrier]
+    except KeyError:
+        raise ValueError(f"Unknown carrier: {carrier}. Expected one of {', '.join(CARRIER_CLASSES)}") from None
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def track(carrier, tracking_number, **client_options):
+    """
+    Lightweight entry point: loads only the module of the carrier, and sends one tracking query
+    :param carrier: "ups", "fedex" or "usps"
+    :param tracking_number:
+    :param client_options: Passed to the client class, eg: proxy="IP:PORT"
+    :return: tracking response, as returned by send_tracking_query
+    """
+    return get_carrier_class(carrier)(**client_options).send_tracking_query(tracking_number)
+
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        module_name, attribute = LAZY_ATTRIBUTES[name]
+        value = getattr(importlib.import_module(module_name), attribute)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_ATTRIBUTES))